@@ -0,0 +1,169 @@
+"""End-to-end throughput of the mail clients against the in-process fake server.
+
+Reports messages/second, bytes on the wire and round trips for each phase of a
+run (connect, search, fetch, classify, move, expunge).
+
+Usage: python -m benchmarks.bench_e2e [--messages 10000] [--latency-ms 0]
+                                      [--protocol IMAP] [--no-move]
+                                      [--fetch-connections 1]
+                                      [--decode-workers 0]
+                                      [--compress off|on|both]
+
+With ``--compress both`` the same run is repeated with and without
+COMPRESS=DEFLATE and the bytes on the wire are compared.
+"""
+import argparse
+import imaplib
+import time
+
+import src.emails
+from benchmarks.fake_server import DEFAULT_CAPABILITIES, FakeMailbox, FakeMailServer
+from src.rules import SPAM_FOLDER, CompiledRuleSet, Rule
+
+RULES = [
+    {"action": "allow", "sender_top_level_domain": ".ac.jp"},
+    {"action": "deny", "subject_contains": "invoice"},
+    {"action": "deny", "subject_contains": "請求書"},
+    {"action": "deny", "body_contains": "claim your prize"},
+    {"action": "move", "move_to": "News", "subject_contains": "newsletter"},
+]
+
+
+class Phase:
+    """Measure time and server-side traffic of one benchmark phase."""
+
+    def __init__(self, server: FakeMailServer, name: str):
+        self.server = server
+        self.name = name
+        self.messages = 0
+
+    def __enter__(self):
+        self.start_stats = self.server.stats.snapshot()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        end_stats = self.server.stats.snapshot()
+        self.bytes_in, self.bytes_out, self.round_trips = (
+            end - start for start, end in zip(self.start_stats, end_stats))
+        return False
+
+    def report(self) -> str:
+        rate = self.messages / self.elapsed if self.elapsed else 0.0
+        return (
+            f"{self.name:<9}{self.elapsed:>9.3f}s{self.messages:>10}{rate:>12.0f}"
+            f"{self.bytes_out:>14,}{self.bytes_in:>12,}{self.round_trips:>8}"
+        )
+
+
+def run(args, compress: bool = False) -> list[Phase]:
+    capabilities = [c for c in DEFAULT_CAPABILITIES if not (
+        args.no_move and c == "MOVE")]
+    if compress:
+        capabilities.append("COMPRESS=DEFLATE")
+    mailbox = FakeMailbox(
+        args.messages,
+        seed=args.seed,
+        attachment_ratio=args.attachment_ratio,
+        delimiter=args.delimiter,
+    )
+    server = FakeMailServer(
+        mailbox, latency=args.latency_ms / 1000, capabilities=capabilities)
+
+    account = src.emails.EmailAccount(
+        imap_server="fake", email="bench@example.com", password="secret", protocol=args.protocol,
+        fetch_connections=args.fetch_connections, decode_workers=args.decode_workers)
+    client = src.emails.EmailClient.from_email_account(account)
+    client.imap_factory = server.imap4
+    client.pop3_factory = server.pop3
+    rules = CompiledRuleSet([Rule(**rule) for rule in RULES])
+    phases = []
+
+    with Phase(server, "connect") as phase:
+        client.connect_to_server()
+    phases.append(phase)
+
+    with Phase(server, "search") as phase:
+        email_ids = client.get_emails()
+        phase.messages = len(email_ids)
+    phases.append(phase)
+
+    with Phase(server, "fetch") as phase:
+        emails = list(client.get_emails_details_bulk(email_ids))
+        phase.messages = len(emails)
+    phases.append(phase)
+
+    move_folder_dict: dict[str, list] = {}
+    with Phase(server, "classify") as phase:
+        # same as process_emails: bodies that a rule will need are fetched per chunk
+        for email_data in client.prefetch_bodies(emails, rules.needs_body):
+            rule = rules.match(email_data)
+            if rule is not None and rule.action != "allow":
+                folder = rule.move_to if rule.action == "move" else SPAM_FOLDER
+                move_folder_dict.setdefault(
+                    folder, []).append(email_data["id"])
+        phase.messages = len(emails)
+    phases.append(phase)
+
+    moved = []
+    with Phase(server, "move") as phase:
+        client.prepare_folders(rules.destination_folders)
+        for folder, ids in move_folder_dict.items():
+            moved.extend(client.move_emails_to_folder(ids, folder) or [])
+        phase.messages = len(moved)
+    phases.append(phase)
+
+    with Phase(server, "expunge") as phase:
+        phase.messages = client.delete_emails(moved)
+    phases.append(phase)
+
+    client.logout()
+    return phases
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=10_000,
+                        help="mailbox size, e.g. 10000, 100000 or 1000000")
+    parser.add_argument("--latency-ms", type=float, default=0.0,
+                        help="latency injected into every round trip")
+    parser.add_argument("--protocol", choices=["IMAP", "POP3"], default="IMAP")
+    parser.add_argument("--no-move", action="store_true",
+                        help="do not advertise MOVE, forcing UID COPY + STORE")
+    parser.add_argument("--fetch-connections", type=int, default=1,
+                        help="connections used to fetch headers in parallel")
+    parser.add_argument("--decode-workers", type=int, default=0,
+                        help="worker processes used to parse the fetched headers (IMAP only)")
+    parser.add_argument("--delimiter", default="/",
+                        help="hierarchy delimiter reported by the fake server's LIST")
+    parser.add_argument("--compress", choices=["off", "on", "both"], default="off",
+                        help="advertise COMPRESS=DEFLATE (IMAP only); both compares the two")
+    parser.add_argument("--attachment-ratio", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # 大きなメールボックスではSEARCHの応答が1行で数MBになる
+    imaplib._MAXLINE = max(imaplib._MAXLINE, args.messages * 10)
+
+    modes = {"off": [False], "on": [True],
+             "both": [False, True]}[args.compress]
+    totals = []
+    for compress in modes:
+        phases = run(args, compress)
+        print(f"protocol={args.protocol} messages={args.messages} latency={args.latency_ms}ms"
+              f" compress={'on' if compress else 'off'}")
+        print(f"{'phase':<9}{'time':>10}{'messages':>10}{'msg/s':>12}{'bytes sent':>14}{'bytes recv':>12}{'rtts':>8}")
+        for phase in phases:
+            print(phase.report())
+        totals.append(
+            sum(phase.bytes_out + phase.bytes_in for phase in phases))
+        print()
+
+    if len(totals) == 2 and totals[1]:
+        print(f"bytes on the wire: {totals[0]:,} uncompressed, {totals[1]:,} compressed"
+              f" ({totals[0] / totals[1]:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Offline replay throughput over a synthetic mbox and Maildir.
+
+Writes N messages from the fake server's generator to an mbox file (LF line
+endings, as mail clients export them) and to a Maildir tree, then classifies
+both with ``src.replay`` using 1 worker and then more workers. Reports
+messages/second and MB/second per case, and checks that every case reaches
+the same decisions.
+
+Usage: python -m benchmarks.bench_replay [--messages 20000] [--workers 1,4]
+                                         [--attachment-ratio 0.3]
+                                         [--attachment-size 200000]
+"""
+import argparse
+import io
+import json
+import os
+import tempfile
+
+import src.replay
+from benchmarks.bench_e2e import RULES
+from benchmarks.fake_server import build_message
+
+
+def write_archives(root: str, messages: int, attachment_ratio: float, attachment_size: int):
+    mbox_path = os.path.join(root, "archive.mbox")
+    maildir = os.path.join(root, "Maildir")
+    for sub in ("cur", "new", "tmp"):
+        os.makedirs(os.path.join(maildir, sub))
+    with open(mbox_path, "wb") as mbox:
+        for key in range(1, messages + 1):
+            raw = build_message(1, key, attachment_ratio,
+                                attachment_size).render()
+            raw = raw.replace(b"\r\n", b"\n")
+            mbox.write(b"From MAILER-DAEMON Thu Jan  1 00:00:00 2026\n")
+            # mboxrd quoting of body lines that look like separators
+            mbox.write(raw.replace(b"\nFrom ", b"\n>From ") + b"\n")
+            with open(os.path.join(maildir, "cur", f"{key:08d}.fake:2,S"), "wb") as f:
+                f.write(raw)
+    return mbox_path, maildir
+
+
+def write_settings(root: str) -> None:
+    os.makedirs(os.path.join(root, "settings", "bench"))
+    with open(os.path.join(root, "settings", "bench", "email_account.yaml"), "w") as f:
+        f.write(
+            "imap_server: imap.example.com\nemail: bench@example.com\npassword: x\n")
+    with open(os.path.join(root, "settings", "bench", "filtering_rules.yaml"), "w") as f:
+        json.dump(RULES, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--workers", default=f"1,{os.cpu_count() or 1}")
+    parser.add_argument("--attachment-ratio", type=float, default=0.3)
+    parser.add_argument("--attachment-size", type=int, default=200_000)
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as root:
+        mbox_path, maildir = write_archives(
+            root, args.messages, args.attachment_ratio, args.attachment_size)
+        write_settings(root)
+        # settings/ and state/ are resolved relative to the working directory
+        os.chdir(root)
+        try:
+            print(f"{'source':<10}{'workers':>8}{'messages':>10}{'MB':>9}"
+                  f"{'seconds':>9}{'msg/s':>10}{'MB/s':>8}")
+            for name, source in [("mbox", mbox_path), ("maildir", maildir)]:
+                expected = None
+                for workers in [int(w) for w in args.workers.split(",")]:
+                    decisions = io.StringIO()
+                    report = src.replay.replay(
+                        "bench", [source], workers, decisions)
+                    actions = [json.loads(line)["rule_index"]
+                               for line in decisions.getvalue().splitlines()]
+                    if expected is None:
+                        expected = actions
+                    elif actions != expected:
+                        raise SystemExit(
+                            f"{name}: {workers} workers changed the decisions")
+                    elapsed = report["elapsed_seconds"]
+                    size = report["bytes"] / 1e6
+                    print(f"{name:<10}{workers:>8}{report['messages']:>10}{size:>9.1f}"
+                          f"{elapsed:>9.2f}{report['messages'] / elapsed:>10.0f}"
+                          f"{size / elapsed:>8.1f}")
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Incremental resync of ``process_emails`` against the in-process fake server.
+
+Runs ``main.process_emails`` over the same mailbox three times per protocol:
+a full first sync, a second sync with no new mail, and a third after new mail
+is delivered. Reports messages fetched and time per run, and exits with an
+error if a resync fetches messages it has already processed (for POP3 the
+UIDLs of classified messages must be recorded even though nothing is moved).
+
+Usage: python -m benchmarks.bench_resync [--messages 300] [--new 20]
+                                         [--protocol IMAP,POP3]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import src.emails
+import src.state
+from benchmarks.bench_e2e import RULES
+from benchmarks.fake_server import FakeMailbox, FakeMailServer
+from main import AccountResult, process_emails
+from src.rules import CompiledRuleSet, Rule
+
+
+def run(protocol: str, messages: int, new: int) -> list[tuple[int, float]]:
+    server = FakeMailServer(FakeMailbox(messages, seed=0))
+    account = src.emails.EmailAccount(
+        imap_server="fake", email="bench@example.com", password="secret", protocol=protocol)
+    rules = CompiledRuleSet([Rule(**rule) for rule in RULES])
+    setting_dir = f"bench-{protocol.lower()}"
+    runs = []
+    for delivered in (0, 0, new):
+        if delivered:
+            server.mailbox.deliver(delivered)
+        client = src.emails.EmailClient.from_email_account(account)
+        client.imap_factory = server.imap4
+        client.pop3_factory = server.pop3
+        client.connect_to_server()
+        result = AccountResult(setting_dir)
+        started = time.perf_counter()
+        process_emails(
+            client, setting_dir, rules, src.state.load_sync_state(setting_dir), None, result)
+        runs.append((result.fetched, time.perf_counter() - started))
+        client.logout()
+    return runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=300)
+    parser.add_argument("--new", type=int, default=20)
+    parser.add_argument("--protocol", default="IMAP,POP3")
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as root:
+        # state/ is resolved relative to the working directory
+        os.chdir(root)
+        try:
+            print(f"{'protocol':<10}{'run':>4}{'fetched':>10}{'seconds':>10}")
+            for protocol in args.protocol.split(","):
+                runs = run(protocol, args.messages, args.new)
+                for i, (fetched, elapsed) in enumerate(runs, 1):
+                    print(f"{protocol:<10}{i:>4}{fetched:>10}{elapsed:>10.3f}")
+                expected = [args.messages, 0, args.new]
+                if [fetched for fetched, _ in runs] != expected:
+                    raise SystemExit(
+                        f"{protocol}: expected {expected} messages per run")
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Compare the linear ``match_rule`` scan with ``CompiledRuleSet``.
+
+Usage: python -m benchmarks.bench_rules [--rules 2000] [--emails 5000]
+"""
+import argparse
+import random
+import string
+import time
+
+import src.rules
+from src.rules import CompiledRuleSet, Rule
+
+
+def random_word(rng: random.Random, length: int) -> str:
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def make_rules(rng: random.Random, count: int, vocabulary: list[str]) -> list[Rule]:
+    rules = []
+    for _ in range(count):
+        kind = rng.random()
+        action = rng.choice(["allow", "deny", "deny", "move"])
+        fields = {"action": action}
+        if action == "move":
+            fields["move_to"] = "Folder" + random_word(rng, 3)
+        if kind < 0.4:
+            fields["sender_top_level_domain"] = "." + \
+                random_word(rng, 5) + ".com"
+        elif kind < 0.7:
+            fields["subject_contains"] = rng.sample(
+                vocabulary, rng.randint(1, 2))
+        elif kind < 0.8:
+            fields["sender_name"] = rng.choice(vocabulary)
+        elif kind < 0.9:
+            fields["to_contains"] = rng.choice(vocabulary)
+        else:
+            fields["cc_contains"] = rng.choice(vocabulary)
+            fields["subject_contains"] = rng.choice(vocabulary)
+        rules.append(Rule(**fields))
+    return rules
+
+
+def make_emails(rng: random.Random, count: int, rules: list[Rule], vocabulary: list[str]) -> list[dict]:
+    domains = [
+        r.sender_top_level_domain for r in rules if r.sender_top_level_domain]
+    emails = []
+    for i in range(count):
+        if domains and rng.random() < 0.3:
+            domain = "mail" + rng.choice(domains)
+        else:
+            domain = random_word(rng, 6) + ".example"
+        name = " ".join(rng.sample(vocabulary, 2))
+        emails.append({
+            "id": str(i),
+            "subject": " ".join(rng.sample(vocabulary, 6)).title(),
+            "from": f"{name} <{random_word(rng, 5)}@{domain}>",
+            "to": f"{rng.choice(vocabulary)}@example.com",
+            "cc": "",
+            "date": "",
+        })
+    return emails
+
+
+def linear_match(rules: list[Rule], email_data: dict) -> Rule | None:
+    for rule in rules:
+        if src.rules.match_rule(rule, email_data):
+            return rule
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rules", type=int, default=2000)
+    parser.add_argument("--emails", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    vocabulary = [random_word(rng, rng.randint(4, 9)) for _ in range(5000)]
+    rules = make_rules(rng, args.rules, vocabulary)
+    emails = make_emails(rng, args.emails, rules, vocabulary)
+
+    start = time.perf_counter()
+    compiled = CompiledRuleSet(rules)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    expected = [linear_match(rules, email_data) for email_data in emails]
+    linear_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = [compiled.match(email_data) for email_data in emails]
+    compiled_time = time.perf_counter() - start
+
+    mismatches = sum(1 for a, b in zip(expected, actual) if a is not b)
+    matched = sum(1 for rule in expected if rule is not None)
+
+    print(f"rules={args.rules} emails={args.emails} matched={matched}")
+    print(
+        f"linear:   {linear_time:8.3f}s  {args.emails / linear_time:10.0f} emails/s")
+    print(f"compiled: {compiled_time:8.3f}s  {args.emails / compiled_time:10.0f} emails/s"
+          f"  (build {build_time:.3f}s)")
+    print(f"speedup:  {linear_time / compiled_time:8.1f}x")
+    if mismatches:
+        raise SystemExit(f"{mismatches} results differ from the linear scan")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Time from interpreter start until every account is ready to connect.
+
+Builds a throwaway ``settings/`` tree with N accounts and runs a fresh
+interpreter that imports ``main``, lists the accounts, loads each account's
+settings and rules and orders them in the scheduler. Each case is run several
+times and the fastest wall-clock time is reported:
+
+* ``baseline``: ``python -c pass``, the floor no change to this repo can beat
+* ``cold``: no config snapshot, so every YAML file is parsed and validated
+* ``warm``: the snapshot written by the previous run is reused
+
+Usage: python -m benchmarks.bench_startup [--accounts 50] [--rules 20]
+                                          [--repeat 7]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STARTUP = """
+import main
+import src.config
+import src.emails
+import src.rules
+import src.scheduler
+import src.settings
+
+setting_dirs = src.settings.get_setting_dirs()
+src.config.preload(setting_dirs)
+for setting_dir in setting_dirs:
+    src.emails.load_email_account(setting_dir)
+    src.rules.load_rules(setting_dir)
+src.scheduler.Scheduler(4, 2, 20.0).order(setting_dirs)
+"""
+
+
+def write_settings(root: str, accounts: int, rules: int) -> None:
+    os.makedirs(os.path.join(root, "settings", "default"))
+    with open(os.path.join(root, "settings", "default", "filtering_rules.yaml"), "w") as f:
+        f.write("- action: allow\n  sender_top_level_domain: .ac.jp\n")
+    for i in range(accounts):
+        account_dir = os.path.join(root, "settings", f"account{i:04d}")
+        os.makedirs(account_dir)
+        with open(os.path.join(account_dir, "email_account.yaml"), "w") as f:
+            f.write(
+                f"imap_server: imap{i % 5}.example.com\n"
+                f"email: user{i}@example.com\n"
+                f"password: secret{i}\n"
+            )
+        with open(os.path.join(account_dir, "filtering_rules.yaml"), "w") as f:
+            for j in range(rules):
+                f.write(
+                    f"- action: deny\n  subject_contains: [spam{j}, offer{j}]\n")
+            f.write(
+                "- action: move\n  move_to: News\n  subject_contains: newsletter\n")
+
+
+def time_run(code: str, cwd: str, repeat: int, before=None) -> float:
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    best = float("inf")
+    for _ in range(repeat):
+        if before:
+            before()
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code],
+                       cwd=cwd, env=env, check=True)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--accounts", type=int, default=50)
+    parser.add_argument("--rules", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=7)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        write_settings(root, args.accounts, args.rules)
+        snapshot = os.path.join(root, "state", "config_snapshot.json")
+
+        def remove_snapshot():
+            if os.path.exists(snapshot):
+                os.remove(snapshot)
+
+        baseline = time_run("pass", root, args.repeat)
+        cold = time_run(STARTUP, root, args.repeat, before=remove_snapshot)
+        time_run(STARTUP, root, 1)
+        warm = time_run(STARTUP, root, args.repeat)
+
+    print(f"{args.accounts} accounts, {args.rules + 1} rules each")
+    print(f"{'case':<10}{'wall':>10}{'over baseline':>16}")
+    for name, elapsed in [("baseline", baseline), ("cold", cold), ("warm", warm)]:
+        print(
+            f"{name:<10}{elapsed * 1000:>8.1f}ms{(elapsed - baseline) * 1000:>14.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
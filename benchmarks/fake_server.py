@@ -0,0 +1,1103 @@
+"""In-process fake IMAP4/POP3 server for benchmarks.
+
+The server speaks the wire protocol over a ``socket.socketpair``, so the real
+``imaplib``/``poplib`` clients and ``EmailClientIMAP``/``EmailClientPOP3`` can be
+exercised end to end without any network access:
+
+    server = FakeMailServer(FakeMailbox(10_000), latency=0.005)
+    client = EmailClientIMAP(account)
+    client.imap_factory = server.imap4
+
+Mailboxes are synthetic. Messages are generated deterministically from their
+key on demand, so even 1M-message mailboxes only cost a few arrays of UIDs.
+They carry realistic MIME structure: RFC 2047 encoded subjects and sender
+names, multipart/alternative bodies and base64 attachments.
+"""
+import base64
+import bisect
+import datetime
+import email.header
+import email.utils
+import functools
+import imaplib
+import poplib
+import quopri
+import random
+import re
+import select
+import socket
+import threading
+import time
+import zlib
+from array import array
+
+DEFAULT_CAPABILITIES = ("IMAP4rev1", "IDLE", "MOVE", "UIDPLUS")
+
+SUBJECTS = [
+    "お支払いのお知らせ",
+    "会議の議事録を共有します",
+    "請求書の送付について",
+    "【重要】アカウントの確認をお願いします",
+    "週報 第{n}週",
+    "Your invoice #{n} is ready",
+    "Meeting notes for project {n}",
+    "Weekly newsletter vol.{n}",
+    "You have won a prize!",
+    "Re: deployment schedule",
+]
+SENDER_NAMES = ["山田 太郎", "佐藤 花子", "カスタマーサポート",
+                "Billing Team", "Alice Smith", "Bob"]
+SENDER_DOMAINS = [
+    "example.com",
+    "example.co.jp",
+    "univ.ac.jp",
+    "lab.univ.ac.jp",
+    "spam.example",
+    "news.example.net",
+]
+BODY_LINES = [
+    "いつもご利用いただきありがとうございます。",
+    "詳細は添付のファイルをご確認ください。",
+    "Please find the details below.",
+    "Click the link to claim your prize.",
+    "This is an automated message, please do not reply.",
+    "Let me know if you have any questions.",
+]
+# 添付ファイルの本文（base64の1行57バイト分を繰り返す）
+_ATTACHMENT_LINE = base64.b64encode(bytes(range(57))) + b"\r\n"
+
+_NOW = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+
+
+class ServerStats:
+    """Bytes and round trips seen on the wire, summed over all sessions."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.round_trips = 0
+
+    def add(self, bytes_in=0, bytes_out=0, round_trips=0):
+        with self._lock:
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.round_trips += round_trips
+
+    def snapshot(self) -> tuple[int, int, int]:
+        with self._lock:
+            return self.bytes_in, self.bytes_out, self.round_trips
+
+
+class _Part:
+    """One MIME part of a synthetic message."""
+
+    __slots__ = ("media_type", "subtype", "params", "encoding",
+                 "headers", "body", "text", "children")
+
+    def __init__(self, media_type, subtype, params=None, encoding="7bit", headers=None, body=b"", text="", children=None):
+        self.media_type = media_type
+        self.subtype = subtype
+        self.params = params or {}
+        self.encoding = encoding
+        self.headers = headers or []
+        self.body = body
+        self.text = text
+        self.children = children
+
+    def header_bytes(self) -> bytes:
+        lines = [f"{name}: {value}\r\n" for name, value in self.headers]
+        return "".join(lines).encode() + b"\r\n"
+
+    def content(self) -> bytes:
+        if self.children is None:
+            return self.body
+        boundary = self.params["boundary"].encode()
+        chunks = []
+        for child in self.children:
+            chunks.append(b"--" + boundary + b"\r\n" +
+                          child.render() + b"\r\n")
+        chunks.append(b"--" + boundary + b"--\r\n")
+        return b"".join(chunks)
+
+    def render(self) -> bytes:
+        return self.header_bytes() + self.content()
+
+    def find(self, section: str):
+        """Return the part at an IMAP section number such as ``1.2``."""
+        part = self
+        for number in section.split("."):
+            index = int(number) - 1
+            if part.children is None:
+                # マルチパートでないメッセージの本文はパート1
+                if index != 0:
+                    return None
+                continue
+            if not 0 <= index < len(part.children):
+                return None
+            part = part.children[index]
+        return part
+
+    def texts(self):
+        if self.children is None:
+            if self.media_type == "text":
+                yield self.text
+            return
+        for child in self.children:
+            yield from child.texts()
+
+    def bodystructure(self) -> bytes:
+        if self.children is not None:
+            children = b"".join(child.bodystructure()
+                                for child in self.children)
+            return b'(%s "%s" ("BOUNDARY" "%s") NIL NIL)' % (
+                children, self.subtype.upper().encode(), self.params["boundary"].encode())
+        params = " ".join(f'"{k.upper()}" "{v}"' for k,
+                          v in self.params.items())
+        params = f"({params})" if params else "NIL"
+        content = self.content()
+        fields = (
+            f'"{self.media_type.upper()}" "{self.subtype.upper()}" {params} NIL NIL '
+            f'"{self.encoding.upper()}" {len(content)}'
+        )
+        if self.media_type == "text":
+            fields += f" {content.count(bytes([10]))}"
+        return f"({fields} NIL NIL NIL)".encode()
+
+
+def _encode_words(text: str, charset: str = "UTF-8") -> str:
+    """Encode non-ASCII text as RFC 2047 words of at most 45 source bytes."""
+    if text.isascii():
+        return text
+    words = []
+    chunk = ""
+    for char in text:
+        if len((chunk + char).encode(charset.lower())) > 45:
+            words.append(chunk)
+            chunk = ""
+        chunk += char
+    words.append(chunk)
+    encoded = [
+        f"=?{charset}?B?{base64.b64encode(word.encode(charset.lower())).decode()}?="
+        for word in words
+    ]
+    return " ".join(encoded)
+
+
+def _internal_date(key: int) -> datetime.datetime:
+    # すべて直近20時間以内に受信したことにする
+    return _NOW - datetime.timedelta(seconds=(key * 7919) % 72000)
+
+
+def _text_part(text: str, subtype: str, rng: random.Random) -> _Part:
+    raw = text.encode("utf-8")
+    if text.isascii() and rng.random() < 0.5:
+        encoding = "quoted-printable"
+        body = quopri.encodestring(raw).replace(b"\n", b"\r\n")
+    else:
+        encoding = "base64"
+        body = base64.encodebytes(raw).replace(b"\n", b"\r\n")
+    return _Part(
+        "text",
+        subtype,
+        {"charset": "utf-8"},
+        encoding,
+        [
+            ("Content-Type", f'text/{subtype}; charset="utf-8"'),
+            ("Content-Transfer-Encoding", encoding),
+        ],
+        body,
+        text,
+    )
+
+
+def build_message(seed: int, key: int, attachment_ratio: float, attachment_size: int) -> _Part:
+    """Generate the synthetic message with the given key."""
+    rng = random.Random(seed * 1_000_003 + key)
+
+    subject = rng.choice(SUBJECTS).format(n=key)
+    name = rng.choice(SENDER_NAMES)
+    domain = rng.choice(SENDER_DOMAINS)
+    charset = "ISO-2022-JP" if not subject.isascii() and rng.random() < 0.2 else "UTF-8"
+    headers = [
+        ("Subject", _encode_words(subject, charset)),
+        ("From", f"{_encode_words(name)} <user{key % 997}@{domain}>"),
+        ("To", f"member{rng.randint(1, 50)}@example.org"),
+        ("Date", email.utils.format_datetime(_internal_date(key))),
+        ("Message-ID", f"<{key}.{seed}@fake.example>"),
+        ("MIME-Version", "1.0"),
+    ]
+    if rng.random() < 0.2:
+        headers.insert(
+            3, ("Cc", f"dev-team@example.com, user{rng.randint(1, 9)}@example.org"))
+
+    text = "\r\n".join(rng.choice(BODY_LINES)
+                       for _ in range(rng.randint(3, 30)))
+    plain = _text_part(text, "plain", rng)
+
+    roll = rng.random()
+    if roll < attachment_ratio:
+        html = _text_part(
+            f"<html><body><p>{text}</p></body></html>", "html", rng)
+        alternative = _Part(
+            "multipart", "alternative", {"boundary": f"alt-{key}"},
+            headers=[
+                ("Content-Type", f'multipart/alternative; boundary="alt-{key}"')],
+            children=[plain, html],
+        )
+        lines = max(1, attachment_size // 57)
+        attachment = _Part(
+            "application", "pdf", {"name": f"document-{key}.pdf"}, "base64",
+            [
+                ("Content-Type",
+                 f'application/pdf; name="document-{key}.pdf"'),
+                ("Content-Transfer-Encoding", "base64"),
+                ("Content-Disposition",
+                 f'attachment; filename="document-{key}.pdf"'),
+            ],
+            _ATTACHMENT_LINE * lines,
+        )
+        message = _Part(
+            "multipart", "mixed", {"boundary": f"mix-{key}"},
+            headers=headers +
+            [("Content-Type", f'multipart/mixed; boundary="mix-{key}"')],
+            children=[alternative, attachment],
+        )
+    elif roll < 0.5 + attachment_ratio / 2:
+        html = _text_part(
+            f"<html><body><p>{text}</p></body></html>", "html", rng)
+        message = _Part(
+            "multipart", "alternative", {"boundary": f"alt-{key}"},
+            headers=headers +
+            [("Content-Type", f'multipart/alternative; boundary="alt-{key}"')],
+            children=[plain, html],
+        )
+    else:
+        message = plain
+        message.headers = headers + plain.headers
+    return message
+
+
+class _Folder:
+    """Messages of one mailbox folder, kept as parallel UID/key arrays."""
+
+    def __init__(self, name: str, uid_validity: int):
+        self.name = name
+        self.uid_validity = uid_validity
+        self.uids = array("q")
+        self.keys = array("q")
+        self.next_uid = 1
+        # UIDごとのフラグ（フラグのないメールは持たない）
+        self.flags: dict[int, set[str]] = {}
+        # CONDSTORE/QRESYNC（RFC 7162）: メールごとのMODSEQと、削除したUIDの記録
+        self.modseqs = array("q")
+        self.highest_modseq = 1
+        self.vanished: list[tuple[int, int]] = []
+
+    def append(self, key: int) -> int:
+        uid = self.next_uid
+        self.next_uid += 1
+        self.highest_modseq += 1
+        self.uids.append(uid)
+        self.keys.append(key)
+        self.modseqs.append(self.highest_modseq)
+        return uid
+
+    def touch(self, uid: int) -> None:
+        """Record a flag change of one message."""
+        index = self.position(uid)
+        if index is not None:
+            self.highest_modseq += 1
+            self.modseqs[index] = self.highest_modseq
+
+    def position(self, uid: int) -> int | None:
+        index = bisect.bisect_left(self.uids, uid)
+        if index < len(self.uids) and self.uids[index] == uid:
+            return index
+        return None
+
+    def remove(self, uids: set[int]) -> list[int]:
+        """Remove messages and return their sequence numbers, highest first."""
+        positions = sorted(
+            (p for p in map(self.position, uids) if p is not None), reverse=True)
+        if not positions:
+            return []
+        removed = set(positions)
+        self.highest_modseq += 1
+        self.vanished.extend(
+            (self.highest_modseq, self.uids[p]) for p in positions)
+        self.uids = array(
+            "q", (u for i, u in enumerate(self.uids) if i not in removed))
+        self.keys = array(
+            "q", (k for i, k in enumerate(self.keys) if i not in removed))
+        self.modseqs = array(
+            "q", (m for i, m in enumerate(self.modseqs) if i not in removed))
+        for uid in uids:
+            self.flags.pop(uid, None)
+        return [p + 1 for p in positions]
+
+
+class FakeMailbox:
+    """A synthetic account whose INBOX holds ``count`` generated messages."""
+
+    def __init__(
+        self,
+        count: int,
+        seed: int = 0,
+        attachment_ratio: float = 0.1,
+        attachment_size: int = 200_000,
+        delimiter: str = "/",
+        folders=("Spam",),
+    ):
+        self.seed = seed
+        self.attachment_ratio = attachment_ratio
+        self.attachment_size = attachment_size
+        self.delimiter = delimiter
+        self.lock = threading.RLock()
+        self._uid_validity = 1_700_000_000
+        self.folders: dict[str, _Folder] = {}
+        inbox = self.create("INBOX")
+        inbox.uids = array("q", range(1, count + 1))
+        inbox.keys = array("q", range(count))
+        inbox.modseqs = array("q", [1]) * count
+        inbox.next_uid = count + 1
+        self._next_key = count
+        for name in folders:
+            self.create(name)
+        # 生成したメールは少しだけキャッシュする
+        self.message = functools.lru_cache(maxsize=4096)(self._build_message)
+
+    def create(self, name: str) -> _Folder:
+        with self.lock:
+            self._uid_validity += 1
+            folder = _Folder(name, self._uid_validity)
+            self.folders[name] = folder
+            return folder
+
+    def deliver(self, count: int = 1) -> list[int]:
+        """Deliver new messages to INBOX and return their UIDs."""
+        with self.lock:
+            inbox = self.folders["INBOX"]
+            uids = []
+            for _ in range(count):
+                uids.append(inbox.append(self._next_key))
+                self._next_key += 1
+            return uids
+
+    def _build_message(self, key: int) -> _Part:
+        return build_message(self.seed, key, self.attachment_ratio, self.attachment_size)
+
+
+class FakeMailServer:
+    """Serve a FakeMailbox over IMAP4 and POP3 through in-process socket pairs."""
+
+    def __init__(self, mailbox: FakeMailbox, latency: float = 0.0, capabilities=DEFAULT_CAPABILITIES):
+        self.mailbox = mailbox
+        # 1往復ごとに応答を遅らせる秒数
+        self.latency = latency
+        self.capabilities = tuple(capabilities)
+        self.stats = ServerStats()
+
+    def imap4(self, host="", port=None, timeout=None) -> imaplib.IMAP4:
+        """Drop-in replacement for ``imaplib.IMAP4_SSL(host, timeout=...)``."""
+        return _FakeIMAP4(self, timeout)
+
+    def pop3(self, host="", port=None, timeout=None) -> poplib.POP3:
+        """Drop-in replacement for ``poplib.POP3_SSL(host, timeout=...)``."""
+        return _FakePOP3(self, timeout)
+
+    def _start(self, session_class, timeout) -> socket.socket:
+        client, remote = socket.socketpair()
+        if timeout is not None:
+            client.settimeout(timeout)
+        session = session_class(self, remote)
+        threading.Thread(target=session.run, daemon=True).start()
+        return client
+
+
+class _FakeIMAP4(imaplib.IMAP4):
+    def __init__(self, server: FakeMailServer, timeout=None):
+        self._fake_server = server
+        super().__init__("fake-imap", 143, timeout)
+
+    def _create_socket(self, timeout):
+        return self._fake_server._start(_IMAPSession, timeout)
+
+
+class _FakePOP3(poplib.POP3):
+    def __init__(self, server: FakeMailServer, timeout=None):
+        self._fake_server = server
+        super().__init__("fake-pop3", 110, timeout)
+
+    def _create_socket(self, timeout):
+        return self._fake_server._start(_POP3Session, timeout)
+
+
+class _Session:
+    """Line-oriented server side of one connection."""
+
+    def __init__(self, server: FakeMailServer, sock: socket.socket):
+        self.server = server
+        self.mailbox = server.mailbox
+        self.sock = sock
+        self.reader = sock.makefile("rb")
+        # COMPRESS DEFLATE後の圧縮・展開の状態（圧縮しない間はNone）
+        self._compressor = None
+        self._decompressor = None
+        self._inflated = bytearray()
+
+    def start_compression(self) -> None:
+        """Compress everything sent and received from now on (RFC 4978)."""
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def readline(self) -> bytes:
+        if self._decompressor is not None:
+            return self._read_inflated(lambda: self._inflated.find(b"\n") + 1)
+        line = self.reader.readline()
+        self.server.stats.add(bytes_in=len(line))
+        return line
+
+    def read(self, size: int) -> bytes:
+        if self._decompressor is not None:
+            return self._read_inflated(lambda: size if len(self._inflated) >= size else 0)
+        data = self.reader.read(size)
+        self.server.stats.add(bytes_in=len(data))
+        return data
+
+    def _read_inflated(self, available) -> bytes:
+        # available()は展開済みのデータから読める長さ（足りなければ0）
+        while not available():
+            data = self.reader.read1(65536)
+            if not data:
+                size = len(self._inflated)
+                break
+            self.server.stats.add(bytes_in=len(data))
+            self._inflated += self._decompressor.decompress(data)
+        else:
+            size = available()
+        chunk = bytes(self._inflated[:size])
+        del self._inflated[:size]
+        return chunk
+
+    def send(self, data: bytes) -> None:
+        if self._compressor is not None:
+            data = self._compressor.compress(
+                data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.server.stats.add(bytes_out=len(data))
+        self.sock.sendall(data)
+
+    def respond(self, data: bytes) -> None:
+        """Send the final response of a round trip, after the injected latency."""
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.server.stats.add(round_trips=1)
+        self.send(data)
+
+    def wait_readable(self, timeout: float) -> bool:
+        if self._inflated:
+            return True
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        return bool(readable)
+
+    def close(self) -> None:
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+_TOKEN_PATTERN = re.compile(
+    rb'\s*(?:"((?:\\.|[^"\\])*)"|(\()|(\))|([^\s()"]+))')
+_FETCH_ITEM_PATTERN = re.compile(
+    r"(BODY(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)(?:\.(\d+))?>)?|[A-Z0-9.]+)", re.IGNORECASE)
+_CHANGEDSINCE_PATTERN = re.compile(
+    r"\s*\(CHANGEDSINCE (\d+)( VANISHED)?\)\s*$", re.IGNORECASE)
+_FETCH_MACROS = {
+    "ALL": ["FLAGS", "INTERNALDATE", "RFC822.SIZE"],
+    "FAST": ["FLAGS", "INTERNALDATE", "RFC822.SIZE"],
+    "FULL": ["FLAGS", "INTERNALDATE", "RFC822.SIZE", "BODY"],
+}
+
+
+def _tokenize(data: bytes) -> list:
+    """Split command arguments into strings and nested lists."""
+    stack = [[]]
+    pos = 0
+    while pos < len(data):
+        match = _TOKEN_PATTERN.match(data, pos)
+        if not match:
+            break
+        pos = match.end()
+        quoted, open_paren, close_paren, atom = match.groups()
+        if quoted is not None:
+            stack[-1].append(re.sub(rb"\\(.)", rb"\1", quoted).decode())
+        elif open_paren:
+            stack.append([])
+        elif close_paren:
+            group = stack.pop()
+            stack[-1].append(group)
+        elif atom:
+            stack[-1].append(atom.decode())
+    while len(stack) > 1:
+        group = stack.pop()
+        stack[-1].append(group)
+    return stack[0]
+
+
+def _parse_set(text: str, largest: int) -> list[tuple[int, int]]:
+    ranges = []
+    for part in text.split(","):
+        first, _, last = part.partition(":")
+        lo = largest if first == "*" else int(first)
+        hi = lo if not last else (largest if last == "*" else int(last))
+        ranges.append((min(lo, hi), max(lo, hi)))
+    return ranges
+
+
+def _in_ranges(value: int, ranges) -> bool:
+    return any(lo <= value <= hi for lo, hi in ranges)
+
+
+def _quote(text: str) -> bytes:
+    return ('"' + text.replace("\\", "\\\\").replace('"', '\\"') + '"').encode()
+
+
+def _decoded_header(message: _Part, name: str) -> str:
+    values = [v for n, v in message.headers if n.lower() == name.lower()]
+    decoded = []
+    for value in values:
+        try:
+            decoded.append(str(email.header.make_header(
+                email.header.decode_header(value))))
+        except Exception:
+            decoded.append(value)
+    return " ".join(decoded)
+
+
+class _IMAPSession(_Session):
+    def run(self):
+        try:
+            self.send(b"* OK [CAPABILITY " + " ".join(self.server.capabilities).encode()
+                      + b"] fake IMAP4rev1 server ready\r\n")
+            while True:
+                line = self.readline()
+                if not line:
+                    break
+                line = self._read_literals(line)
+                tag, _, rest = line.rstrip(b"\r\n").partition(b" ")
+                command, _, args = rest.partition(b" ")
+                command = command.decode().upper()
+                uid = False
+                if command == "UID":
+                    uid = True
+                    command, _, args = args.partition(b" ")
+                    command = command.decode().upper()
+                handler = getattr(self, "cmd_" + command, None)
+                if handler is None:
+                    self.respond(tag + b" BAD unknown command\r\n")
+                    continue
+                self.raw_args = args.decode(errors="replace")
+                try:
+                    with self.mailbox.lock:
+                        result = handler(
+                            _tokenize(args), uid) if command != "IDLE" else None
+                    if command == "IDLE":
+                        result = self.cmd_IDLE([], False)
+                except Exception as e:
+                    result = b"BAD " + str(e).encode()
+                self.respond(tag + b" " + result + b"\r\n")
+                if command == "COMPRESS" and result.startswith(b"OK"):
+                    self.start_compression()
+                if command == "LOGOUT":
+                    break
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.close()
+
+    def _read_literals(self, line: bytes) -> bytes:
+        # クライアントからのリテラル {n} は引用文字列に置き換える
+        while True:
+            match = re.search(rb"\{(\d+)\+?\}\r\n$", line)
+            if not match:
+                return line
+            self.send(b"+ go ahead\r\n")
+            data = self.read(int(match.group(1)))
+            quoted = b'"' + \
+                data.replace(b"\\", b"\\\\").replace(b'"', b'\\"') + b'"'
+            line = line[:match.start()] + quoted + self.readline()
+
+    # --- 接続・メールボックス ---
+
+    folder: _Folder | None = None
+    reported_exists = 0
+    qresync = False
+
+    @property
+    def condstore(self) -> bool:
+        return "CONDSTORE" in self.server.capabilities or "QRESYNC" in self.server.capabilities
+
+    def cmd_CAPABILITY(self, args, uid):
+        self.send(b"* CAPABILITY " +
+                  " ".join(self.server.capabilities).encode() + b"\r\n")
+        return b"OK CAPABILITY completed"
+
+    def cmd_COMPRESS(self, args, uid):
+        if "COMPRESS=DEFLATE" not in self.server.capabilities:
+            return b"BAD COMPRESS not supported"
+        if self._compressor is not None:
+            return b"NO [COMPRESSIONACTIVE] DEFLATE active via COMPRESS"
+        if not args or str(args[0]).upper() != "DEFLATE":
+            return b"BAD unknown compression mechanism"
+        return b"OK DEFLATE active"
+
+    def cmd_ENABLE(self, args, uid):
+        enabled = [name for name in args if name.upper()
+                   in self.server.capabilities]
+        if "QRESYNC" in (name.upper() for name in enabled):
+            self.qresync = True
+        self.send(b"* ENABLED" + b"".join(b" " + name.encode()
+                  for name in enabled) + b"\r\n")
+        return b"OK ENABLE completed"
+
+    def cmd_LOGIN(self, args, uid):
+        return b"OK LOGIN completed"
+
+    def cmd_LOGOUT(self, args, uid):
+        self.send(b"* BYE logging out\r\n")
+        return b"OK LOGOUT completed"
+
+    def cmd_NOOP(self, args, uid):
+        self._report_exists()
+        return b"OK NOOP completed"
+
+    def _report_exists(self):
+        if self.folder is not None and len(self.folder.uids) != self.reported_exists:
+            self.reported_exists = len(self.folder.uids)
+            self.send(b"* %d EXISTS\r\n" % self.reported_exists)
+
+    def cmd_SELECT(self, args, uid):
+        folder = self.mailbox.folders.get(args[0])
+        if folder is None:
+            return b"NO mailbox does not exist"
+        self.folder = folder
+        self.reported_exists = len(folder.uids)
+        self.send(
+            b"* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)\r\n"
+            b"* %d EXISTS\r\n* 0 RECENT\r\n"
+            b"* OK [UIDVALIDITY %d] UIDs valid\r\n"
+            b"* OK [UIDNEXT %d] Predicted next UID\r\n"
+            % (len(folder.uids), folder.uid_validity, folder.next_uid)
+        )
+        if self.condstore:
+            self.send(b"* OK [HIGHESTMODSEQ %d] Highest\r\n" %
+                      folder.highest_modseq)
+        return b"OK [READ-WRITE] SELECT completed"
+
+    cmd_EXAMINE = cmd_SELECT
+
+    def cmd_LIST(self, args, uid):
+        delimiter = self.mailbox.delimiter.encode()
+        for name in self.mailbox.folders:
+            self.send(b'* LIST (\\HasNoChildren) "' +
+                      delimiter + b'" ' + _quote(name) + b"\r\n")
+        return b"OK LIST completed"
+
+    def cmd_CREATE(self, args, uid):
+        if args[0] in self.mailbox.folders:
+            return b"NO mailbox already exists"
+        self.mailbox.create(args[0])
+        return b"OK CREATE completed"
+
+    def cmd_IDLE(self, args, uid):
+        self.send(b"+ idling\r\n")
+        while True:
+            if self.wait_readable(0.05):
+                line = self.readline()
+                if not line or line.strip().upper() == b"DONE":
+                    break
+            with self.mailbox.lock:
+                self._report_exists()
+        return b"OK IDLE terminated"
+
+    # --- 検索・取得 ---
+
+    def _messages(self, set_text: str, uid: bool):
+        """Yield (seq, uid, key) for a sequence set or UID set."""
+        folder = self.folder
+        if not folder.uids:
+            return
+        if uid:
+            for lo, hi in _parse_set(set_text, folder.uids[-1]):
+                start = bisect.bisect_left(folder.uids, lo)
+                end = bisect.bisect_right(folder.uids, hi)
+                for i in range(start, end):
+                    yield i + 1, folder.uids[i], folder.keys[i]
+        else:
+            for lo, hi in _parse_set(set_text, len(folder.uids)):
+                for i in range(max(lo, 1) - 1, min(hi, len(folder.uids))):
+                    yield i + 1, folder.uids[i], folder.keys[i]
+
+    def cmd_SEARCH(self, args, uid):
+        folder = self.folder
+        if args and str(args[0]).upper() == "CHARSET":
+            args = args[2:]
+        predicate = self._parse_criteria(list(args))
+        results = [
+            (u if uid else i + 1)
+            for i, (u, key) in enumerate(zip(folder.uids, folder.keys))
+            if predicate(i + 1, u, key)
+        ]
+        self.send(b"* SEARCH" + b"".join(b" %d" %
+                  n for n in results) + b"\r\n")
+        return b"OK SEARCH completed"
+
+    def _parse_criteria(self, tokens: list):
+        predicates = []
+        while tokens:
+            predicates.append(self._parse_key(tokens))
+        return lambda seq, uid, key: all(p(seq, uid, key) for p in predicates)
+
+    def _parse_key(self, tokens: list):
+        token = tokens.pop(0)
+        if isinstance(token, list):
+            return self._parse_criteria(list(token))
+        name = token.upper()
+        folder = self.folder
+        if name == "ALL":
+            return lambda seq, uid, key: True
+        if name == "UID":
+            ranges = _parse_set(tokens.pop(
+                0), folder.uids[-1] if folder.uids else 0)
+            return lambda seq, uid, key: _in_ranges(uid, ranges)
+        if name in ("SINCE", "BEFORE", "ON"):
+            day = datetime.datetime.strptime(tokens.pop(0), "%d-%b-%Y").date()
+            compare = {
+                "SINCE": lambda d: d >= day,
+                "BEFORE": lambda d: d < day,
+                "ON": lambda d: d == day,
+            }[name]
+            return lambda seq, uid, key: compare(_internal_date(key).date())
+        if name == "NOT":
+            inner = self._parse_key(tokens)
+            return lambda seq, uid, key: not inner(seq, uid, key)
+        if name == "OR":
+            left = self._parse_key(tokens)
+            right = self._parse_key(tokens)
+            return lambda seq, uid, key: left(seq, uid, key) or right(seq, uid, key)
+        if name in ("DELETED", "UNDELETED", "SEEN", "UNSEEN"):
+            flag = "\\" + name.removeprefix("UN").capitalize()
+            expected = not name.startswith("UN")
+            return lambda seq, uid, key: (flag in folder.flags.get(uid, ())) == expected
+        if name in ("SUBJECT", "FROM", "TO", "CC", "BCC", "HEADER"):
+            field = tokens.pop(0) if name == "HEADER" else name
+            needle = tokens.pop(0).lower()
+            return lambda seq, uid, key: needle in _decoded_header(
+                self.mailbox.message(key), field).lower()
+        if name in ("BODY", "TEXT"):
+            needle = tokens.pop(0).lower()
+
+            def match_text(seq, uid, key):
+                message = self.mailbox.message(key)
+                text = " ".join(message.texts())
+                if name == "TEXT":
+                    text = message.header_bytes().decode(errors="replace") + text
+                return needle in text.lower()
+            return match_text
+        if re.fullmatch(r"[\d:*,]+", token):
+            ranges = _parse_set(token, len(folder.uids))
+            return lambda seq, uid, key: _in_ranges(seq, ranges)
+        raise ValueError(f"unsupported search key {token}")
+
+    def cmd_FETCH(self, args, uid):
+        set_text, _, items_text = self.raw_args.partition(" ")
+        changed_since = None
+        modifier = _CHANGEDSINCE_PATTERN.search(items_text)
+        if modifier and self.condstore:
+            changed_since = int(modifier.group(1))
+            items_text = items_text[:modifier.start()]
+            if modifier.group(2):
+                if not (uid and self.qresync):
+                    return b"BAD VANISHED requires UID FETCH and QRESYNC"
+                self._report_vanished(set_text, changed_since)
+        items = [m.group(0) for m in _FETCH_ITEM_PATTERN.finditer(items_text)]
+        if len(items) == 1 and items[0].upper() in _FETCH_MACROS:
+            items = _FETCH_MACROS[items[0].upper()]
+        if uid and not any(item.upper() == "UID" for item in items):
+            items.insert(0, "UID")
+        if changed_since is not None and not any(item.upper() == "MODSEQ" for item in items):
+            items.append("MODSEQ")
+        for seq, message_uid, key in self._messages(set_text, uid):
+            if changed_since is not None and self.folder.modseqs[seq - 1] <= changed_since:
+                continue
+            chunks = [self._fetch_item(item, message_uid, key)
+                      for item in items]
+            self.send(b"* %d FETCH (" % seq + b" ".join(chunks) + b")\r\n")
+        return b"OK FETCH completed"
+
+    def _fetch_item(self, item: str, uid: int, key: int) -> bytes:
+        name = item.upper()
+        if name == "UID":
+            return b"UID %d" % uid
+        if name == "FLAGS":
+            return b"FLAGS (" + " ".join(sorted(self.folder.flags.get(uid, ()))).encode() + b")"
+        if name == "MODSEQ":
+            return b"MODSEQ (%d)" % self.folder.modseqs[self.folder.position(uid)]
+        if name == "INTERNALDATE":
+            date = _internal_date(key).strftime("%d-%b-%Y %H:%M:%S +0000")
+            return b'INTERNALDATE "' + date.encode() + b'"'
+        message = self.mailbox.message(key)
+        if name == "RFC822.SIZE":
+            return b"RFC822.SIZE %d" % len(message.render())
+        if name in ("BODYSTRUCTURE", "BODY"):
+            return name.encode() + b" " + message.bodystructure()
+        if name == "RFC822":
+            return _literal(b"RFC822", message.render())
+        if name == "RFC822.HEADER":
+            return _literal(b"RFC822.HEADER", message.header_bytes())
+
+        match = _FETCH_ITEM_PATTERN.fullmatch(item)
+        section = match.group(2)
+        data = self._section(message, section)
+        label = b"BODY[" + section.encode() + b"]"
+        if match.group(3) is not None:
+            start = int(match.group(3))
+            length = int(match.group(4)) if match.group(4) else len(data)
+            data = data[start:start + length]
+            label += b"<%d>" % start
+        return _literal(label, data)
+
+    def _section(self, message: _Part, section: str) -> bytes:
+        upper = section.upper()
+        if not section:
+            return message.render()
+        if upper == "HEADER":
+            return message.header_bytes()
+        if upper == "TEXT":
+            return message.content()
+        if upper.startswith("HEADER.FIELDS"):
+            fields = {f.lower() for f in re.findall(
+                r"[\w-]+", upper[len("HEADER.FIELDS"):])}
+            negate = upper.startswith("HEADER.FIELDS.NOT")
+            if negate:
+                fields.discard("not")
+            lines = [
+                f"{name}: {value}\r\n" for name, value in message.headers
+                if (name.lower() in fields) != negate
+            ]
+            return "".join(lines).encode() + b"\r\n"
+        part = message.find(section)
+        return part.content() if part is not None else b""
+
+    # --- 変更 ---
+
+    def cmd_STORE(self, args, uid):
+        set_text, operation, flags = args[0], args[1].upper(), args[2]
+        flags = set(flags if isinstance(flags, list) else [flags])
+        silent = operation.endswith(".SILENT")
+        for seq, message_uid, key in list(self._messages(set_text, uid)):
+            current = self.folder.flags.setdefault(message_uid, set())
+            if operation.startswith("+"):
+                current |= flags
+            elif operation.startswith("-"):
+                current -= flags
+            else:
+                current.clear()
+                current |= flags
+            self.folder.touch(message_uid)
+            if not silent:
+                self.send(b"* %d FETCH (UID %d FLAGS (%s))\r\n" % (
+                    seq, message_uid, " ".join(sorted(current)).encode()))
+        return b"OK STORE completed"
+
+    def _copy(self, args, uid):
+        target = self.mailbox.folders.get(args[1])
+        if target is None:
+            return None, None
+        source_uids, target_uids = [], []
+        for _, message_uid, key in list(self._messages(args[0], uid)):
+            source_uids.append(message_uid)
+            target_uids.append(target.append(key))
+        code = b""
+        if "UIDPLUS" in self.server.capabilities and source_uids:
+            code = b"[COPYUID %d %s %s] " % (
+                target.uid_validity,
+                ",".join(map(str, source_uids)).encode(),
+                ",".join(map(str, target_uids)).encode(),
+            )
+        return source_uids, code
+
+    def cmd_COPY(self, args, uid):
+        source_uids, code = self._copy(args, uid)
+        if source_uids is None:
+            return b"NO [TRYCREATE] mailbox does not exist"
+        return b"OK " + code + b"COPY completed"
+
+    def cmd_MOVE(self, args, uid):
+        if "MOVE" not in self.server.capabilities:
+            return b"BAD MOVE not supported"
+        source_uids, code = self._copy(args, uid)
+        if source_uids is None:
+            return b"NO [TRYCREATE] mailbox does not exist"
+        if code:
+            self.send(b"* OK " + code + b"\r\n")
+        self._expunge(set(source_uids))
+        return b"OK MOVE completed"
+
+    def cmd_EXPUNGE(self, args, uid):
+        deleted = {u for u, flags in self.folder.flags.items()
+                   if "\\Deleted" in flags}
+        if uid:
+            ranges = _parse_set(
+                args[0], self.folder.uids[-1] if self.folder.uids else 0)
+            deleted = {u for u in deleted if _in_ranges(u, ranges)}
+        self._expunge(deleted)
+        return b"OK EXPUNGE completed"
+
+    def _expunge(self, uids: set[int]) -> None:
+        # 番号がずれないように大きい番号から通知する
+        removed = sorted(
+            uid for uid in uids if self.folder.position(uid) is not None)
+        sequence_numbers = self.folder.remove(uids)
+        if sequence_numbers and self.qresync:
+            # QRESYNCを有効にした接続ではEXPUNGEの代わりにVANISHEDで通知する
+            self.send(b"* VANISHED " + _uid_set(removed) + b"\r\n")
+        elif sequence_numbers:
+            self.send(b"".join(b"* %d EXPUNGE\r\n" %
+                      n for n in sequence_numbers))
+        self.reported_exists -= len(sequence_numbers)
+
+    def _report_vanished(self, set_text: str, changed_since: int) -> None:
+        folder = self.folder
+        ranges = _parse_set(set_text, folder.next_uid - 1)
+        uids = sorted(
+            uid for modseq, uid in folder.vanished
+            if modseq > changed_since and _in_ranges(uid, ranges))
+        if uids:
+            self.send(b"* VANISHED (EARLIER) " + _uid_set(uids) + b"\r\n")
+
+
+def _uid_set(uids: list[int]) -> bytes:
+    """Compress sorted UIDs into a "1:3,5" style set."""
+    parts = []
+    for uid in uids:
+        if parts and parts[-1][1] == uid - 1:
+            parts[-1][1] = uid
+        else:
+            parts.append([uid, uid])
+    return ",".join(f"{lo}:{hi}" if lo != hi else str(lo) for lo, hi in parts).encode()
+
+
+def _literal(label: bytes, data: bytes) -> bytes:
+    return label + b" {%d}\r\n" % len(data) + data
+
+
+class _POP3Session(_Session):
+    def run(self):
+        inbox = self.mailbox.folders["INBOX"]
+        # セッション開始時点のメールだけが見える
+        with self.mailbox.lock:
+            self.uids = list(inbox.uids)
+            self.keys = list(inbox.keys)
+        self.deleted: set[int] = set()
+        try:
+            self.send(b"+OK fake POP3 server ready\r\n")
+            while True:
+                line = self.readline()
+                if not line:
+                    break
+                command, _, args = line.strip().partition(b" ")
+                command = command.decode().upper()
+                handler = getattr(self, "cmd_" + command, None)
+                if handler is None:
+                    self.respond(b"-ERR unknown command\r\n")
+                    continue
+                try:
+                    self.respond(handler(args.decode().split()))
+                except (IndexError, ValueError) as e:
+                    self.respond(b"-ERR " + str(e).encode() + b"\r\n")
+                if command == "QUIT":
+                    break
+        except OSError:
+            pass
+        finally:
+            self.close()
+
+    def _message(self, number: str) -> tuple[int, _Part]:
+        index = int(number) - 1
+        if not 0 <= index < len(self.keys) or index in self.deleted:
+            raise ValueError("no such message")
+        return index, self.mailbox.message(self.keys[index])
+
+    def _size(self, index: int) -> int:
+        return len(self.mailbox.message(self.keys[index]).render())
+
+    def _multiline(self, status: bytes, data: bytes) -> bytes:
+        lines = data.split(b"\r\n")
+        if lines and lines[-1] == b"":
+            lines.pop()
+        # ドットで始まる行はドットを重ねる
+        lines = [
+            b"." + line if line.startswith(b".") else line for line in lines]
+        return b"+OK " + status + b"\r\n" + b"".join(line + b"\r\n" for line in lines) + b".\r\n"
+
+    def _alive(self):
+        return [i for i in range(len(self.keys)) if i not in self.deleted]
+
+    def cmd_CAPA(self, args):
+        return self._multiline(b"capabilities", b"USER\r\nTOP\r\nUIDL\r\n")
+
+    def cmd_USER(self, args):
+        return b"+OK\r\n"
+
+    def cmd_PASS(self, args):
+        return b"+OK logged in\r\n"
+
+    def cmd_NOOP(self, args):
+        return b"+OK\r\n"
+
+    def cmd_STAT(self, args):
+        alive = self._alive()
+        return b"+OK %d %d\r\n" % (len(alive), sum(self._size(i) for i in alive))
+
+    def cmd_LIST(self, args):
+        if args:
+            index, message = self._message(args[0])
+            return b"+OK %d %d\r\n" % (index + 1, len(message.render()))
+        lines = b"".join(b"%d %d\r\n" % (i + 1, self._size(i))
+                         for i in self._alive())
+        return self._multiline(b"scan listing", lines)
+
+    def cmd_UIDL(self, args):
+        if args:
+            index, _ = self._message(args[0])
+            return b"+OK %d %d-%d\r\n" % (index + 1, self.mailbox.seed, self.keys[index])
+        lines = b"".join(
+            b"%d %d-%d\r\n" % (i + 1, self.mailbox.seed, self.keys[i]) for i in self._alive())
+        return self._multiline(b"unique-id listing", lines)
+
+    def cmd_TOP(self, args):
+        _, message = self._message(args[0])
+        body_lines = message.content().split(b"\r\n")[:int(args[1])]
+        return self._multiline(b"top", message.header_bytes() + b"".join(
+            line + b"\r\n" for line in body_lines))
+
+    def cmd_RETR(self, args):
+        _, message = self._message(args[0])
+        return self._multiline(b"message follows", message.render())
+
+    def cmd_DELE(self, args):
+        index, _ = self._message(args[0])
+        self.deleted.add(index)
+        return b"+OK deleted\r\n"
+
+    def cmd_RSET(self, args):
+        self.deleted.clear()
+        return b"+OK\r\n"
+
+    def cmd_QUIT(self, args):
+        with self.mailbox.lock:
+            self.mailbox.folders["INBOX"].remove(
+                {self.uids[i] for i in self.deleted})
+        return b"+OK bye\r\n"
@@ -1,140 +1,702 @@
-import logging
-from logging.handlers import RotatingFileHandler
-from pathlib import Path
+import argparse
+import signal
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
 
 from loguru import logger
 
+import src.classification_cache
+import src.config
+import src.decision_log
 import src.emails
+import src.headers
+import src.metrics
+import src.ratelimit
+import src.reputation
 import src.rules
+import src.scheduler
 import src.settings
+import src.state
 
+LOG_FORMAT = (
+    "<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | "
+    "<level>{level: <8}</level> | "
+    "<magenta>{extra[setting_dir]}</magenta> | "
+    "<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - "
+    "<level>{message}</level>"
+)
 
-def create_filter_decision_logger() -> logging.Logger | None:
-    log_path = Path("logs/filter_decisions.log")
+# 常駐モードでIDLEをやり直す間隔（サーバーは29分で切断してよい）
+IDLE_TIMEOUT_SECONDS = 25 * 60
+# IDLEを使えない場合に新着を確認する間隔
+POLL_INTERVAL_SECONDS = 60
+# 再接続までの待ち時間
+RECONNECT_MIN_SECONDS = 5
+RECONNECT_MAX_SECONDS = 300
+# マッチしたメールがこの件数たまるごとに移動・削除して進捗を保存する
+ACTION_FLUSH_SIZE = 500
+# 何もしないメールもこの件数ごとに進捗を保存する
+PROGRESS_SAVE_SIZE = 5000
+
+
+def create_filter_decision_logger(
+    compress: bool = False,
+) -> src.decision_log.DecisionLog | None:
     try:
-        log_path.parent.mkdir(parents=True, exist_ok=True)
-        decision_logger = logging.getLogger("filter_decisions")
-        if decision_logger.handlers:
-            return decision_logger
-
-        handler = RotatingFileHandler(
-            log_path,
-            maxBytes=1 * 1024 * 1024,
-            backupCount=3,
-            encoding="utf-8",
-        )
-        formatter = logging.Formatter(
-            "%(asctime)s | setting=%(setting_dir)s | email_id=%(email_id)s | action=%(action)s | to=%(to_folder)s | from=%(sender)s | reason=%(reason)s | subject=%(subject)s"
-        )
-        handler.setFormatter(formatter)
-        decision_logger.addHandler(handler)
-        decision_logger.setLevel(logging.INFO)
-        decision_logger.propagate = False
-        return decision_logger
+        return src.decision_log.DecisionLog(compress=compress)
     except Exception as e:
         logger.warning(f"振り分けログの初期化に失敗しました: {e}")
         return None
 
 
-def to_one_line(value) -> str:
-    if value is None:
-        return ""
-    if isinstance(value, (bytes, bytearray)):
-        value = value.decode("utf-8", errors="replace")
-    return str(value).replace("\n", " ").replace("\r", " ")
-
-
 def log_filter_decision(
-    decision_logger: logging.Logger | None,
+    decision_logger: src.decision_log.DecisionLog | None,
     setting_dir: str,
     email_id,
     action: str,
     folder: str,
-    rule,
+    rule_index: int | None,
     email_data: dict,
 ) -> None:
     if not decision_logger:
         return
-    try:
-        decision_logger.info(
-            "matched",
-            extra={
-                "setting_dir": to_one_line(setting_dir),
-                "email_id": to_one_line(email_id),
-                "action": action,
-                "to_folder": to_one_line(folder),
-                "sender": to_one_line(email_data.get("from", "")),
-                "reason": to_one_line(rule) if rule else "",
-                "subject": to_one_line(email_data.get("subject", "")),
-            },
-        )
-    except Exception as e:
-        logger.warning(f"振り分けログの書き込みに失敗しました: {e}")
+    decision_logger.log(
+        setting_dir,
+        email_id,
+        email_data.get("message_id"),
+        rule_index,
+        action,
+        folder,
+        email_data.get("from"),
+        email_data.get("subject"),
+    )
 
 
-def main():
-    setting_dirs = src.settings.get_setting_dirs()
-    decision_logger = create_filter_decision_logger()
+@dataclass
+class AccountResult:
+    setting_dir: str
+    email: str = ""
+    fetched: int = 0
+    moved: int = 0
+    action_counts: dict[str, int] = field(default_factory=dict)
+    error: str | None = None
+    # サーバーに制限された（間隔を空けて処理し直す）
+    throttled: bool = False
+
+
+class PendingActions:
+    """マッチしたメールを移動先ごとにためておき、まとめて移動・削除する"""
+
+    def __init__(self, email_client: src.emails.EmailClient, result: AccountResult):
+        self.email_client = email_client
+        self.result = result
+        self.move_folder_dict: dict[str, list] = {}
+        self.count = 0
+        metrics = email_client.metrics
+        stats = email_client.connection_stats
+        # 移動と削除は判定の合間に何度も行うので時間を積算する
+        self.move = metrics.accumulator("move", stats)
+        self.expunge = metrics.accumulator("expunge", stats)
+
+    def add(self, folder: str, email_id) -> None:
+        self.move_folder_dict.setdefault(folder, []).append(email_id)
+        self.count += 1
+
+    def flush(self) -> list:
+        """ためたメールを移動し、移動できたものを削除して、処理済みのメールIDを返す"""
+        if not self.count:
+            return []
+        logger.info(f"移動フォルダ: {self.move_folder_dict}")
+        delete_email_ids = []
+        with self.move:
+            for folder, email_ids in self.move_folder_dict.items():
+                success_email_ids = self.email_client.move_emails_to_folder(
+                    email_ids, folder)
+                delete_email_ids.extend(success_email_ids)
+            self.move.messages += len(delete_email_ids)
+        self.result.moved += len(delete_email_ids)
+
+        # コピーしたメールを削除
+        # メールIDがずれるので、移動後に削除する
+        if delete_email_ids:
+            with self.expunge:
+                self.expunge.messages += self.email_client.delete_emails(
+                    delete_email_ids)
+
+        moved_ids = delete_email_ids
+        if not self.email_client.supports_move:
+            # POP3は移動できないので、判定して記録したメールを処理済みとする
+            # （処理済みにしないと同期状態が進まず、毎回すべて取得し直す）
+            moved_ids = [
+                email_id for email_ids in self.move_folder_dict.values() for email_id in email_ids]
+        self.move_folder_dict = {}
+        self.count = 0
+        return moved_ids
+
+    def record(self) -> None:
+        self.move.record()
+        self.expunge.record()
+
+
+def advance_checkpoint(emails: list, checkpoint: int, done: set) -> int:
+    """emails[checkpoint:]のうち先頭から続けて処理済みのメールの次の位置を返す
+
+    取得・移動に失敗したメールより後には進めないので、失敗したメールは
+    次回処理し直す（その後の何もしなかったメールは判定キャッシュで除く）。
+    """
+    while checkpoint < len(emails) and emails[checkpoint] in done:
+        checkpoint += 1
+    return checkpoint
+
+
+def check_search_misses(
+    email_client: src.emails.EmailClient,
+    search_plan: src.rules.SearchPlan,
+    misses: list,
+    reputation: src.reputation.SenderReputation | None,
+) -> list:
+    """サーバー側の検索でマッチしなかったメールのうち、取得して判定するものを返す
+
+    検索したヘッダーだけを取得し、ASCIIの平文でないもの（デコードや結合文字の除去で
+    ローカルの判定と結果が変わりうるもの）と、取得できなかったものを返す。
+    残りは何もしないメールとして送信者の評判に記録する（記録しないと拒否の割合が
+    実際より高くなる）。
+    """
+    if not misses:
+        return []
+    fields = search_plan.fields
+    if reputation and "FROM" not in fields:
+        fields = fields + ["FROM"]
+    raw_headers = email_client.get_header_fields(misses, fields)
+    local = []
+    for msg_id in misses:
+        raw_header = raw_headers.get(msg_id)
+        if raw_header is None or not search_plan.is_exact(raw_header):
+            local.append(msg_id)
+        elif reputation:
+            reputation.record(src.headers.parse_email_details(
+                msg_id, raw_header), None)
+    if local:
+        logger.debug(f"サーバー側の検索と結果が変わりうる{len(local)}件を取得して判定します。")
+    return local
+
+
+def save_progress(
+    email_client: src.emails.EmailClient,
+    setting_dir: str,
+    sync_state: src.state.SyncState,
+    cache: src.classification_cache.ClassificationCache | None,
+    reputation: src.reputation.SenderReputation | None,
+    processed_ids,
+    kept_decisions: list,
+    complete: bool = False,
+) -> None:
+    """ここまでに処理したメールを同期状態と判定キャッシュ・送信者の評判に保存する"""
+    # 処理済みのUIDを記録して次回は新着メールのみを対象にする
+    email_client.advance_sync_state(sync_state, processed_ids, complete)
+    src.state.save_sync_state(setting_dir, sync_state)
+    if reputation:
+        try:
+            reputation.commit()
+        except Exception as e:
+            logger.warning(f"送信者の評判の保存に失敗しました: {e}")
+    if cache and sync_state.uid_validity == email_client.uid_validity:
+        try:
+            # 同期状態より前のメールは次回検索されないので、その先のものだけを記録する
+            last_uid = sync_state.last_uid
+            cache.add(
+                email_client.uid_validity,
+                [decision for decision in kept_decisions if int(
+                    decision[0]) > last_uid],
+            )
+            cache.forget(email_client.uid_validity, [(1, last_uid)])
+            cache.commit()
+        except Exception as e:
+            logger.warning(f"判定キャッシュの保存に失敗しました: {e}")
+    kept_decisions.clear()
+
+
+def process_emails(
+    email_client: src.emails.EmailClient,
+    setting_dir: str,
+    rules: src.rules.CompiledRuleSet,
+    sync_state: src.state.SyncState,
+    decision_logger: src.decision_log.DecisionLog | None,
+    result: AccountResult,
+) -> None:
+    """接続済みのクライアントで未処理のメールを振り分ける
+
+    取得・判定・移動を1通ずつ流し、マッチしたメールがACTION_FLUSH_SIZE件
+    たまるごとに移動・削除して進捗を保存する。途中で中断しても、
+    それまでに移動したメールは次回処理し直さない。取得や移動に失敗した
+    メールがあれば、同期状態はその手前までしか進めない。
+    """
+    metrics = email_client.metrics
+    stats = email_client.connection_stats
+    uid_validity = email_client.uid_validity
+    cache = None
+    if uid_validity is not None:
+        cache = src.classification_cache.open_classification_cache(
+            setting_dir, rules.fingerprint)
+    # 同じ結果が続いている送信者は、評判と違う結果になるルールだけを評価して判定する
+    # （閾値の指定がなければ記録だけ）
+    reputation = src.reputation.open_sender_reputation(
+        setting_dir, rules.fingerprint, email_client.email_account.reputation_threshold)
+    # 評判の判定ごとに、それと違う結果になるルール
+    masks = rules.action_masks
+    verdict_masks = {
+        "allow": masks["deny"] | masks["move"],
+        "deny": masks["allow"] | masks["move"],
+    }
+    # 何もしないと判定したメールのUIDとマッチしたルールの位置
+    kept_decisions = []
+    # 何もしないと判定したか、移動できたメール（同期状態を進めてよいもの）
+    done = set()
+    with metrics.phase("search", stats) as phase:
+        emails = email_client.get_emails(sync_state)
+        phase.messages = len(emails)
+        targets = emails
+        if cache and email_client.vanished:
+            # 他のクライアントが削除したメールの記録は使われないので消しておく
+            try:
+                cache.forget(uid_validity, email_client.vanished)
+            except Exception as e:
+                logger.warning(f"判定キャッシュの更新に失敗しました: {e}")
+        if cache and targets:
+            # 同じルールで何もしないと判定済みのメールは取得しない
+            known = cache.lookup(uid_validity, targets)
+            if known:
+                logger.info(f"判定済みの{len(known)}件を対象外にしました。")
+                done.update(uid for uid in targets if int(uid) in known)
+                targets = [uid for uid in targets if int(uid) not in known]
+        search_plan = rules.search_plan
+        if email_client.email_account.server_search and search_plan.criteria and targets:
+            # どのルールにもマッチしえないメールはヘッダーも取得しない
+            hits = email_client.search_emails(search_plan.criteria, targets)
+            if hits is not None:
+                hit_set = set(hits)
+                misses = [uid for uid in targets if uid not in hit_set]
+                hit_set.update(check_search_misses(
+                    email_client, search_plan, misses, reputation))
+                misses = [uid for uid in misses if uid not in hit_set]
+                logger.info(f"サーバー側の検索で{len(misses)}件を対象外にしました。")
+                kept_decisions.extend((uid, None) for uid in misses)
+                done.update(misses)
+                targets = [uid for uid in targets if uid in hit_set]
+    result.fetched += len(emails)
+    logger.info(f"{len(emails)}件のメールを取得しました。")
+
+    if targets:
+        # 移動の途中でLISTやCREATEを繰り返さないように、先に移動先を用意する
+        with metrics.phase("folders", stats):
+            email_client.prepare_folders(rules.destination_folders)
+
+    pending = PendingActions(email_client, result)
+    action_counts: dict[str, int] = {}
+    # emailsのうち同期状態に保存済みの位置
+    checkpoint = 0
+    # 取得・判定・移動は交互に進むので、それぞれの時間を積算する
+    fetch = metrics.accumulator("fetch", stats)
+    classify = metrics.accumulator("classify", stats)
+    details = email_client.get_emails_details_bulk(targets)
+    if rules.spam_model is not None:
+        # 取得したヘッダーをチャンクごとにまとめて統計モデルで判定する
+        details = rules.spam_model.score_stream(
+            details, src.emails.FETCH_CHUNK_SIZE)
+    if rules.has_body_rules:
+        # 本文の条件まで判定が進むメールの本文はチャンクごとにまとめて取得する
+        details = email_client.prefetch_bodies(details, rules.needs_body)
+    details = iter(details)
+    # フィルタリングルールを適用して移動するメールを特定
+    while True:
+        with fetch:
+            email_data = next(details, None)
+        if email_data is None:
+            break
+        fetch.messages += 1
+        email_id = email_data["id"]
+
+        with classify:
+            verdict = reputation.verdict(email_data) if reputation else None
+            if verdict:
+                # 評判と同じ結果になるルールは省き、違う結果になるルールだけを評価する
+                differing = verdict_masks[verdict]
+                rule_index = rules.match_index(email_data, differing)
+                if rule_index is not None:
+                    # ルールで判定する（それより前の、評判と同じ結果のルールを優先する）
+                    verdict = None
+                    earlier = rules.match_index(
+                        email_data, ~differing & ((1 << rule_index) - 1))
+                    if earlier is not None:
+                        rule_index = earlier
+            else:
+                rule_index = rules.match_index(email_data)
+            classify.messages += 1
+        if verdict:
+            metrics.inc("reputation_verdicts_total", verdict=verdict)
+        elif reputation:
+            # 評判で判定したメールは数えない（誤った判定が自分を強めないように）
+            reputation.record(
+                email_data, None if rule_index is None else rules[rule_index].action)
+
+        if verdict == "deny":
+            logger.info(
+                f"送信者の評判で拒否しました: {email_data['from']}:{email_data['subject']}")
+            folder = src.rules.SPAM_FOLDER
+            pending.add(folder, email_id)
+            log_filter_decision(
+                decision_logger, setting_dir, email_id, "deny", folder, None, email_data
+            )
+            action_counts["deny"] = action_counts.get("deny", 0) + 1
+            metrics.inc("actions_total", action="deny")
+        elif rule_index is None:
+            kept_decisions.append((email_id, None))
+            done.add(email_id)
+        else:
+            rule = rules[rule_index]
+            logger.info(f"ルールにマッチしました: {rule}:{email_data['subject']}")
+            if rule.action == "allow":
+                kept_decisions.append((email_id, rule_index))
+                done.add(email_id)
+            elif rule.action == "deny":
+                folder = src.rules.SPAM_FOLDER
+                pending.add(folder, email_id)
+                log_filter_decision(
+                    decision_logger, setting_dir, email_id, "deny", folder, rule_index, email_data
+                )
+            elif rule.action == "move":
+                folder = rule.move_to
+                pending.add(folder, email_id)
+                log_filter_decision(
+                    decision_logger, setting_dir, email_id, "move", folder, rule_index, email_data
+                )
+            action_counts[rule.action] = action_counts.get(
+                rule.action, 0) + 1
+            metrics.inc("actions_total", action=rule.action)
+
+        if pending.count >= ACTION_FLUSH_SIZE or len(kept_decisions) >= PROGRESS_SAVE_SIZE:
+            # 移動してから保存する（未移動のメールを処理済みにしない）
+            done.update(pending.flush())
+            end = advance_checkpoint(emails, checkpoint, done)
+            save_progress(
+                email_client, setting_dir, sync_state, cache, reputation,
+                emails[checkpoint:end], kept_decisions,
+            )
+            checkpoint = end
+
+    done.update(pending.flush())
+    end = advance_checkpoint(emails, checkpoint, done)
+    if email_client.failed_ids:
+        logger.warning(f"{len(email_client.failed_ids)}件のメールを取得できませんでした。")
+    # 取得したメールのうち処理できなかったもの（次回処理し直す）
+    remaining = sum(1 for uid in emails[end:] if uid not in done)
+    if remaining:
+        logger.warning(f"{remaining}件のメールは次回処理し直します。")
+    if not email_client.throttled:
+        # サーバーに制限されずに最後まで処理した場合だけ記録する
+        # （制限された場合は前回の時刻のままにして、次回は早めに処理する）
+        sync_state.last_run_at = time.time()
+        sync_state.backlog = remaining
+    save_progress(
+        email_client, setting_dir, sync_state, cache, reputation,
+        emails[checkpoint:end], kept_decisions, complete=end == len(emails),
+    )
+    fetch.record()
+    classify.record()
+    pending.record()
+    logger.info(f"振り分け結果: {action_counts}")
+    for action, count in action_counts.items():
+        result.action_counts[action] = result.action_counts.get(
+            action, 0) + count
 
-    for setting_dir in setting_dirs:
-        email_account = src.emails.load_email_account(setting_dir)
-        rules = src.rules.load_rules(setting_dir)
+    if cache:
+        try:
+            cache.close()
+        except Exception as e:
+            logger.warning(f"判定キャッシュの保存に失敗しました: {e}")
+    if reputation:
+        try:
+            reputation.close()
+        except Exception as e:
+            logger.warning(f"送信者の評判の保存に失敗しました: {e}")
 
+
+def process_account(
+    setting_dir: str,
+    decision_logger: src.decision_log.DecisionLog | None,
+    budget: src.ratelimit.HostBudget,
+    metrics: src.metrics.Metrics | src.metrics.NullMetrics,
+) -> AccountResult:
+    """1つのアカウントのメールを振り分ける"""
+    result = AccountResult(setting_dir)
+    email_account = src.emails.load_email_account(setting_dir)
+    rules = src.rules.load_rules(setting_dir)
+    result.email = email_account.email
+
+    # アカウントごとに専用のクライアントを使う
+    email_client = src.emails.EmailClient.from_email_account(email_account)
+    email_client.metrics = metrics.bind(account=setting_dir)
+    email_client.budget = budget
+    with budget.connection():
         logger.info(f"{email_account.email}に接続します。")
-        email_client = src.emails.EmailClient.from_email_account(email_account)
-        ret = email_client.connect_to_server()
+        with email_client.metrics.phase("connect", email_client.connection_stats):
+            ret = email_client.connect_to_server()
         if not ret:
             logger.error("メールサーバーに接続できませんでした。")
-            continue
+            result.error = "メールサーバーに接続できませんでした。"
+            result.throttled = email_client.throttled
+            return result
 
-        emails = email_client.get_emails()
-        logger.info(f"{len(emails)}件のメールを取得しました。")
+        try:
+            sync_state = src.state.load_sync_state(setting_dir)
+            process_emails(
+                email_client, setting_dir, rules, sync_state, decision_logger, result
+            )
+        finally:
+            email_client.logout()
+            result.throttled = email_client.throttled
 
-        # 移動フォルダとメールIDのdict
-        move_folder_dict: dict[str, list[int]] = {}
-        delete_email_ids = []
-        action_counts: dict[str, int] = {}
-        # フィルタリングルールを適用して削除するメールを特定
-        for email_id in emails:
-            email_data = email_client.get_email_details(email_id)
-            if not email_data:
-                logger.error(f"メールの詳細を取得できませんでした: {email_id}")
-                continue
-            for rule in rules:
-                if src.rules.match_rule(rule, email_data):
-                    logger.info(f"ルールにマッチしました: {rule}:{email_data['subject']}")
-                    if rule.action == "deny":
-                        folder = "Spam"
-                        move_folder_dict.setdefault(
-                            folder, []).append(email_id)
-                        log_filter_decision(
-                            decision_logger, setting_dir, email_id, "deny", folder, rule, email_data
-                        )
-                    elif rule.action == "move":
-                        folder = rule.move_to
-                        move_folder_dict.setdefault(
-                            folder, []).append(email_id)
-                        log_filter_decision(
-                            decision_logger, setting_dir, email_id, "move", folder, rule, email_data
+    return result
+
+
+def run_daemon_account(
+    setting_dir: str,
+    decision_logger: src.decision_log.DecisionLog | None,
+    metrics: src.metrics.Metrics | src.metrics.NullMetrics,
+    stop_event: threading.Event,
+) -> None:
+    """接続を維持したまま新着メールを待ち受けて振り分ける
+
+    IDLE（非対応のサーバーではNOOPによるポーリング）で新着を待ち、
+    新しいUIDのメールだけを振り分ける。切断された場合は間隔を
+    空けながら再接続する。
+    """
+    backoff = RECONNECT_MIN_SECONDS
+    with logger.contextualize(setting_dir=setting_dir):
+        while not stop_event.is_set():
+            result = AccountResult(setting_dir)
+            email_client = None
+            try:
+                email_account = src.emails.load_email_account(setting_dir)
+                rules = src.rules.load_rules(setting_dir)
+                result.email = email_account.email
+
+                logger.info(f"{email_account.email}に接続します。")
+                email_client = src.emails.EmailClient.from_email_account(
+                    email_account)
+                email_client.metrics = metrics.bind(account=setting_dir)
+                if not email_client.connect_to_server():
+                    raise ConnectionError("メールサーバーに接続できませんでした。")
+                backoff = RECONNECT_MIN_SECONDS
+
+                sync_state = src.state.load_sync_state(setting_dir)
+                changed = True
+                while not stop_event.is_set():
+                    if changed:
+                        process_emails(
+                            email_client, setting_dir, rules, sync_state, decision_logger, result
                         )
-                    action_counts[rule.action] = action_counts.get(
-                        rule.action, 0) + 1
-                    break
+                    if not email_client.supports_idle:
+                        # POP3は接続中に届いたメールが見えないので接続し直す
+                        stop_event.wait(POLL_INTERVAL_SECONDS)
+                        break
+                    # 29分でタイムアウトされる前にIDLEをやり直す
+                    changed = email_client.wait_for_changes(
+                        IDLE_TIMEOUT_SECONDS, stop_event)
+            except Exception as e:
+                logger.warning(f"接続が切れました。{backoff}秒後に再接続します: {e}")
+                stop_event.wait(backoff)
+                backoff = min(backoff * 2, RECONNECT_MAX_SECONDS)
+            finally:
+                if email_client:
+                    email_client.logout()
 
-        logger.info(f"移動フォルダ: {move_folder_dict}")
-        logger.info(f"振り分け結果: {action_counts}")
 
-        # メールを指定フォルダに移動
-        for folder, email_ids in move_folder_dict.items():
-            success_email_ids = email_client.move_emails_to_folder(
-                email_ids, folder)
-            delete_email_ids.extend(success_email_ids)
+def run_daemon(
+    setting_dirs: list[str],
+    decision_logger: src.decision_log.DecisionLog | None,
+    metrics: src.metrics.Metrics | src.metrics.NullMetrics,
+) -> None:
+    """すべてのアカウントを常駐して監視する"""
+    stop_event = threading.Event()
 
-        # コピーしたメールを削除
-        # メールIDがずれるので、移動後に削除する
-        email_client.delete_emails(delete_email_ids)
+    def stop(signum, frame):
+        logger.info("終了します。")
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    # 接続を張り続けるのでアカウントごとにスレッドを割り当てる
+    threads = [
+        threading.Thread(
+            target=run_daemon_account,
+            args=(setting_dir, decision_logger, metrics, stop_event),
+            name=f"daemon-{setting_dir}",
+            daemon=True,
+        )
+        for setting_dir in setting_dirs
+    ]
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        for thread in threads:
+            thread.join(timeout=1)
+
+
+def run_account(
+    setting_dir: str,
+    decision_logger: src.decision_log.DecisionLog | None,
+    budget: src.ratelimit.HostBudget,
+    metrics: src.metrics.Metrics | src.metrics.NullMetrics,
+) -> AccountResult:
+    """アカウントを処理し、例外は結果として返す"""
+    with logger.contextualize(setting_dir=setting_dir):
+        try:
+            return process_account(
+                setting_dir, decision_logger, budget, metrics)
+        except Exception as e:
+            logger.exception(f"アカウントの処理に失敗しました: {e}")
+            return AccountResult(
+                setting_dir, error=str(e),
+                throttled=src.ratelimit.is_throttling_response(e))
 
-        email_client.logout()
+
+def run_accounts(
+    setting_dirs: list[str],
+    decision_logger: src.decision_log.DecisionLog | None,
+    concurrency: int,
+    per_server_limit: int,
+    commands_per_second: float,
+    max_attempts: int,
+    metrics: src.metrics.Metrics | src.metrics.NullMetrics,
+) -> list[AccountResult]:
+    """複数のアカウントをサーバーごとの予算の範囲で並行して処理する"""
+    scheduler = src.scheduler.Scheduler(
+        concurrency, per_server_limit, commands_per_second, max_attempts)
+    return scheduler.run(
+        setting_dirs,
+        lambda setting_dir, budget: run_account(
+            setting_dir, decision_logger, budget, metrics),
+    )
+
+
+def report_results(results: list[AccountResult]) -> None:
+    """アカウントごとの処理結果をまとめて出力する"""
+    for result in results:
+        if result.error:
+            logger.error(f"{result.setting_dir}: 失敗しました: {result.error}")
+        else:
+            logger.info(
+                f"{result.setting_dir}: {result.fetched}件取得, "
+                f"{result.moved}件移動, 振り分け結果: {result.action_counts}"
+            )
+    failed = sum(1 for result in results if result.error)
+    logger.info(f"{len(results)}アカウントを処理しました（失敗: {failed}件）。")
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="IMAP spam cleaner")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="同時に処理するアカウント数",
+    )
+    parser.add_argument(
+        "--per-server-limit",
+        type=int,
+        default=2,
+        help="同じサーバーへの同時接続数の上限",
+    )
+    parser.add_argument(
+        "--commands-per-second",
+        type=float,
+        default=20.0,
+        help="同じサーバーに送るコマンドの速度の上限（0で制限しない）",
+    )
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=src.scheduler.MAX_ATTEMPTS,
+        help="サーバーに制限された場合にアカウントを処理し直す回数の上限",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        help="処理ごとの時間・転送量の集計をJSONで書き出すパス",
+    )
+    parser.add_argument(
+        "--metrics-prom",
+        help="同じ集計をPrometheusのtextfile形式で書き出すパス",
+    )
+    parser.add_argument(
+        "--compress-decision-log",
+        action="store_true",
+        help="ローテーションした振り分けログをgzipで圧縮する",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="常駐してIDLEで新着メールを待ち受ける",
+    )
+    return parser.parse_args(argv)
+
+
+def configure_logging() -> None:
+    """並行処理中でもどのアカウントのログか分かるようにする"""
+    logger.configure(extra={"setting_dir": "-"})
+    logger.remove()
+    logger.add(sys.stderr, format=LOG_FORMAT)
+
+
+def write_metrics(metrics, args: argparse.Namespace) -> None:
+    """集計したメトリクスを指定されたパスに書き出す"""
+    if not metrics.enabled:
+        return
+    try:
+        if args.metrics_json:
+            metrics.write_json(args.metrics_json)
+        if args.metrics_prom:
+            metrics.write_prometheus(args.metrics_prom)
+    except Exception as e:
+        logger.warning(f"メトリクスの書き出しに失敗しました: {e}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_logging()
+
+    setting_dirs = src.settings.get_setting_dirs()
+    # 変わった設定ファイルだけを検証し、スナップショットを更新しておく
+    src.config.preload(setting_dirs)
+    decision_logger = create_filter_decision_logger(args.compress_decision_log)
+    # 書き出し先が指定されていなければ計測しない
+    if args.metrics_json or args.metrics_prom:
+        metrics = src.metrics.Metrics()
+    else:
+        metrics = src.metrics.NULL_METRICS
+
+    try:
+        if args.daemon:
+            run_daemon(setting_dirs, decision_logger, metrics)
+            return
+
+        results = run_accounts(
+            setting_dirs,
+            decision_logger,
+            args.concurrency,
+            args.per_server_limit,
+            args.commands_per_second,
+            args.max_attempts,
+            metrics,
+        )
+        report_results(results)
+    finally:
+        if decision_logger:
+            decision_logger.close()
+        write_metrics(metrics, args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,124 @@
+import os
+import sqlite3
+import time
+
+from loguru import logger
+
+# 保持する件数の上限（古いものから削除する）
+MAX_ENTRIES = 200_000
+# これより古い判定は削除する（秒）
+MAX_AGE_SECONDS = 90 * 24 * 60 * 60
+
+
+class ClassificationCache:
+    """振り分けで何もしなかったメールの記録
+
+    UIDVALIDITYとUIDでメールを、ルール全体のハッシュでルールの版を識別する。
+    取得や移動に失敗したメールがあると同期状態はその手前で止まり、次回は
+    その先のメールも検索し直すので、そのうち何もしなかったメールを記録して
+    おき、次回は取得せずに済ませる（同期状態より前のメールは検索されないので
+    記録しない）。ルールを変更するとハッシュが変わるので以前の記録は使われなくなる。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        fingerprint: str,
+        max_entries: int = MAX_ENTRIES,
+        max_age: float = MAX_AGE_SECONDS,
+    ):
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._connection = sqlite3.connect(path)
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS decisions (
+                uid_validity INTEGER NOT NULL,
+                uid INTEGER NOT NULL,
+                fingerprint TEXT NOT NULL,
+                rule_index INTEGER,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (uid_validity, uid, fingerprint)
+            ) WITHOUT ROWID
+            """
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS decisions_created_at ON decisions (created_at)"
+        )
+
+    def lookup(self, uid_validity: int, uids) -> set[int]:
+        """uidsのうち記録済みのUIDを返す"""
+        uids = [int(uid) for uid in uids]
+        if not uids:
+            return set()
+        rows = self._connection.execute(
+            "SELECT uid FROM decisions"
+            " WHERE uid_validity = ? AND fingerprint = ? AND uid BETWEEN ? AND ?",
+            (uid_validity, self.fingerprint, min(uids), max(uids)),
+        )
+        return {uid for uid, in rows}.intersection(uids)
+
+    def add(self, uid_validity: int, decisions) -> None:
+        """(UID, マッチしたルールの位置)の組を記録する（マッチしない場合はNone）"""
+        now = time.time()
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO decisions VALUES (?, ?, ?, ?, ?)",
+            (
+                (uid_validity, int(uid), self.fingerprint, rule_index, now)
+                for uid, rule_index in decisions
+            ),
+        )
+
+    def forget(self, uid_validity: int, ranges) -> None:
+        """削除されたメールの記録を(最初, 最後)のUIDの範囲で削除する"""
+        self._connection.executemany(
+            "DELETE FROM decisions WHERE uid_validity = ? AND uid BETWEEN ? AND ?",
+            ((uid_validity, first, last) for first, last in ranges),
+        )
+
+    def commit(self) -> None:
+        self._connection.commit()
+
+    def prune(self) -> None:
+        """ルールの変更で使われなくなった記録と、古い記録を削除する"""
+        connection = self._connection
+        connection.execute(
+            "DELETE FROM decisions WHERE fingerprint != ?", (self.fingerprint,))
+        connection.execute(
+            "DELETE FROM decisions WHERE created_at < ?", (time.time() - self.max_age,))
+        count, = connection.execute(
+            "SELECT COUNT(*) FROM decisions").fetchone()
+        if count > self.max_entries:
+            connection.execute(
+                """
+                DELETE FROM decisions WHERE (uid_validity, uid) IN (
+                    SELECT uid_validity, uid FROM decisions
+                    ORDER BY created_at, uid LIMIT ?
+                )
+                """,
+                (count - self.max_entries,),
+            )
+
+    def close(self) -> None:
+        """古い記録を削除して保存する"""
+        try:
+            self.prune()
+            self._connection.commit()
+        finally:
+            self._connection.close()
+
+
+def get_cache_path(setting_dir: str) -> str:
+    return f"state/{setting_dir}/classification_cache.sqlite3"
+
+
+def open_classification_cache(setting_dir: str, fingerprint: str) -> ClassificationCache | None:
+    """アカウントの判定キャッシュを開く（開けない場合はNone）"""
+    path = get_cache_path(setting_dir)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return ClassificationCache(path, fingerprint)
+    except sqlite3.Error as e:
+        logger.warning(f"判定キャッシュを開けませんでした: {e}")
+        return None
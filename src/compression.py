@@ -0,0 +1,96 @@
+import imaplib
+import zlib
+
+# imaplibはCOMPRESSを知らないので、使える状態を登録しておく
+imaplib.Commands.setdefault("COMPRESS", ("AUTH", "SELECTED"))
+
+# 1回に受信する圧縮データの大きさ
+RECV_SIZE = 64 * 1024
+# 送信するデータの圧縮レベル（コマンドは短いので速さを優先する）
+COMPRESS_LEVEL = 1
+
+
+def enable_deflate(connection) -> None:
+    """COMPRESS DEFLATE（RFC 4978）が成功した接続の送受信を圧縮・展開する
+
+    imaplibはself.fileから読み、self.sock.sendallで送るので、
+    その2つを差し替えるだけで以降のコマンドはそのまま使える。
+    """
+    reader = DeflateReader(connection.sock)
+    connection.file = reader
+    connection.sock = DeflateSocket(connection.sock, reader)
+
+
+class DeflateReader:
+    """受信した圧縮データを展開しながら読むファイルの代わり"""
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._buffer = bytearray()
+
+    @property
+    def buffered(self) -> int:
+        """展開済みでまだ読んでいないバイト数"""
+        return len(self._buffer)
+
+    def read(self, size: int) -> bytes:
+        while len(self._buffer) < size and self._fill():
+            pass
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def readline(self, limit: int = -1) -> bytes:
+        start = 0
+        while True:
+            end = self._buffer.find(b"\n", start)
+            if end != -1:
+                size = end + 1
+                break
+            if 0 <= limit <= len(self._buffer):
+                size = limit
+                break
+            start = len(self._buffer)
+            if not self._fill():
+                size = len(self._buffer)
+                break
+        if limit >= 0:
+            size = min(size, limit)
+        line = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return line
+
+    def close(self) -> None:
+        # ソケットはimaplibがself.sockとして閉じる
+        self._buffer.clear()
+
+    def _fill(self) -> bool:
+        data = self._sock.recv(RECV_SIZE)
+        if not data:
+            return False
+        self._buffer += self._decompressor.decompress(data)
+        return True
+
+
+class DeflateSocket:
+    """送信するデータを圧縮するソケットの代わり（それ以外は元のソケットに任せる）"""
+
+    def __init__(self, sock, reader: DeflateReader):
+        self._sock = sock
+        self._reader = reader
+        self._compressor = zlib.compressobj(
+            COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def sendall(self, data: bytes) -> None:
+        # コマンドごとにフラッシュしないとサーバーが読めない
+        self._sock.sendall(
+            self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def pending(self) -> int:
+        """すぐに読めるデータの量（select()で待つ前に確認する）"""
+        pending = getattr(self._sock, "pending", None)
+        return self._reader.buffered + (pending() if pending else 0)
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
@@ -0,0 +1,170 @@
+"""設定ファイルの検証済みスナップショット
+
+settings/以下のYAMLの解析とpydanticによる検証は、起動のたびに行うには重い。
+検証した結果をアカウントごとに state/config_snapshot.json に保存し、
+元のファイルの更新時刻とサイズが変わっていなければそちらを使う。
+スナップショットの読み込みにはYAMLもpydanticも使わない。
+パスワードはスナップショットに書き出さず、必要になったときにYAMLから読む。
+"""
+import functools
+import json
+import os
+import threading
+
+from loguru import logger
+
+SNAPSHOT_PATH = "state/config_snapshot.json"
+# スナップショットの形式を変えたら上げる（古いものは使わない）
+SNAPSHOT_VERSION = 2
+
+_lock = threading.Lock()
+# アカウントごとの検証済みの設定（読み込むまではNone）
+_accounts: dict[str, dict] | None = None
+_dirty = False
+
+
+def get_account_config(setting_dir: str) -> dict:
+    """検証済みのアカウントの設定（"account"）とルール（"rules"）を返す
+
+    設定ファイルが変わっていればYAMLから読み直して検証する。
+    """
+    global _dirty
+    with _lock:
+        accounts = _load_snapshot()
+        entry = accounts.get(setting_dir)
+        if entry is None or not _is_fresh(entry["sources"]):
+            entry = _compile_account(setting_dir)
+            accounts[setting_dir] = entry
+            _dirty = True
+        return entry
+
+
+def preload(setting_dirs: list[str]) -> None:
+    """すべてのアカウントの設定を読み込み、読み直したものがあれば保存する"""
+    for setting_dir in setting_dirs:
+        try:
+            get_account_config(setting_dir)
+        except Exception as e:
+            # 設定の誤りはアカウントを処理するときにエラーとして報告する
+            logger.debug(f"{setting_dir}: 設定を読み込めませんでした: {e}")
+    save_snapshot()
+
+
+def save_snapshot() -> None:
+    """読み直した設定があればスナップショットを書き出す"""
+    global _dirty
+    with _lock:
+        if not _dirty:
+            return
+        data = json.dumps(
+            {"version": SNAPSHOT_VERSION, "accounts": _accounts}, ensure_ascii=False)
+        try:
+            os.makedirs(os.path.dirname(SNAPSHOT_PATH), exist_ok=True)
+            # パスワードは含まないが、サーバーとアドレスも本人だけが読めるようにする
+            tmp_path = f"{SNAPSHOT_PATH}.tmp"
+            fd = os.open(tmp_path, os.O_WRONLY |
+                         os.O_CREAT | os.O_TRUNC, 0o600)
+            with open(fd, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp_path, SNAPSHOT_PATH)
+            _dirty = False
+        except OSError as e:
+            logger.warning(f"設定のスナップショットを保存できませんでした: {e}")
+
+
+def get_password(setting_dir: str) -> str:
+    """アカウントのパスワードをemail_account.yamlから読む（スナップショットにはない）"""
+    import yaml
+
+    # LibYAMLがあれば速いローダーを使う
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    with open(f"settings/{setting_dir}/email_account.yaml", "r", encoding="utf-8") as f:
+        return str(yaml.load(f, Loader=loader)["password"])
+
+
+def get_rules_path(setting_dir: str) -> str:
+    """アカウントのルールのファイル（なければデフォルトのもの）のパスを返す"""
+    path_template = "settings/{setting_dir}/filtering_rules.yaml"
+    path = path_template.format(setting_dir=setting_dir)
+    # settings/{setting_dir}/filtering_rules.yamlが存在するか確認
+    if not os.path.exists(path):
+        # デフォルトの設定を使用
+        path = path_template.format(setting_dir="default")
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Settings file not found: {path}")
+    return path
+
+
+def _load_snapshot() -> dict[str, dict]:
+    global _accounts
+    if _accounts is None:
+        _accounts = {}
+        try:
+            with open(SNAPSHOT_PATH, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == SNAPSHOT_VERSION:
+                _accounts = data["accounts"]
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            # 壊れたスナップショットは使わずに作り直す
+            logger.warning(f"設定のスナップショットを読み込めませんでした: {e}")
+    return _accounts
+
+
+def _source_paths(setting_dir: str) -> list[str]:
+    # アカウントのルールのファイルは、後から作られた場合に気付けるように
+    # 存在しなくても記録する
+    return [
+        f"settings/{setting_dir}/email_account.yaml",
+        f"settings/{setting_dir}/filtering_rules.yaml",
+        "settings/default/filtering_rules.yaml",
+    ]
+
+
+def _stat(path: str) -> list[int] | None:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _is_fresh(sources: dict) -> bool:
+    return all(_stat(path) == stat for path, stat in sources.items())
+
+
+def _compile_account(setting_dir: str) -> dict:
+    """YAMLを読み込んで検証する"""
+    # YAMLとpydanticは設定ファイルが変わった場合だけ必要なので、ここで読み込む
+    import yaml
+
+    from src.emails import EmailAccount
+    from src.rules import Rule
+
+    # 読み込み中に書き換えられても次回に読み直すように、先に記録する
+    sources = {path: _stat(path) for path in _source_paths(setting_dir)}
+
+    with open(f"settings/{setting_dir}/email_account.yaml", "r", encoding="utf-8") as f:
+        account = _validate(EmailAccount, yaml.safe_load(f))
+    # パスワードは平文でファイルに残さない（load_email_accountでYAMLから読む）
+    del account["password"]
+
+    with open(get_rules_path(setting_dir), "r", encoding="utf-8") as f:
+        rules = [_validate(Rule, rule) for rule in yaml.safe_load(f)]
+    for rule in rules:
+        Rule(**rule).validate()
+
+    return {"sources": sources, "account": account, "rules": rules}
+
+
+def _validate(record_class, data) -> dict:
+    return _schema(record_class)(**data).model_dump()
+
+
+@functools.cache
+def _schema(record_class):
+    """RecordのFIELDSから検証用のpydanticのモデルを作る"""
+    import pydantic
+
+    return pydantic.create_model(record_class.__name__, **record_class.FIELDS)
@@ -0,0 +1,143 @@
+import gzip
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+from loguru import logger
+
+DECISION_LOG_PATH = "logs/filter_decisions.jsonl"
+
+# 1回の書き込みでまとめる件数の上限
+BATCH_SIZE = 512
+
+_STOP = object()
+
+
+class DecisionLog:
+    """振り分け結果をJSON Linesで書き出すログ
+
+    log()はキューに積むだけで、整形と書き込みは専用のスレッドで行う。
+    キューに溜まった分をまとめて1回で書き込むので、大量に振り分けても
+    ファイルへの書き込み回数は増えない。
+    """
+
+    def __init__(
+        self,
+        path: str = DECISION_LOG_PATH,
+        max_bytes: int = 10 * 1024 * 1024,
+        backup_count: int = 5,
+        compress: bool = False,
+        batch_size: int = BATCH_SIZE,
+    ):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.batch_size = batch_size
+        self._handler = RotatingFileHandler(
+            path,
+            maxBytes=max_bytes,
+            backupCount=backup_count,
+            encoding="utf-8",
+        )
+        if compress:
+            # ローテーションした古いファイルはgzipで圧縮する
+            self._handler.namer = lambda name: f"{name}.gz"
+            self._handler.rotator = _gzip_rotator
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread = threading.Thread(
+            target=self._run, name="decision-log", daemon=True)
+        self._thread.start()
+
+    def log(
+        self,
+        account: str,
+        uid,
+        message_id,
+        rule_index: int | None,
+        action: str,
+        folder: str,
+        sender=None,
+        subject=None,
+    ) -> None:
+        """振り分け結果を1件記録する（書き込みは待たない）"""
+        self._queue.put((
+            time.time(), account, uid, message_id, rule_index,
+            action, folder, sender, subject,
+        ))
+
+    def close(self) -> None:
+        """キューに残った分を書き込んでファイルを閉じる"""
+        if not self._thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._handler.close()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = any(entry is _STOP for entry in batch)
+            lines = [format_decision(entry)
+                     for entry in batch if entry is not _STOP]
+            if lines:
+                try:
+                    self._write("".join(lines))
+                except Exception as e:
+                    # ログの書き込み失敗で振り分けを止めない
+                    logger.warning(f"振り分けログの書き込みに失敗しました: {e}")
+            if stop:
+                return
+
+    def _write(self, data: str) -> None:
+        handler = self._handler
+        if handler.stream is None:
+            handler.stream = handler._open()
+        if handler.maxBytes > 0:
+            handler.stream.seek(0, 2)
+            size = handler.stream.tell()
+            if size and size + len(data.encode("utf-8")) > handler.maxBytes:
+                handler.doRollover()
+                if handler.stream is None:
+                    handler.stream = handler._open()
+        handler.stream.write(data)
+        handler.stream.flush()
+
+
+def format_decision(entry: tuple) -> str:
+    """キューに積んだ1件をJSON Linesの1行にする"""
+    created, account, uid, message_id, rule_index, action, folder, sender, subject = entry
+    record = {
+        "time": datetime.fromtimestamp(created).astimezone().isoformat(timespec="milliseconds"),
+        "account": account,
+        "uid": _to_text(uid),
+        "message_id": _to_text(message_id),
+        "rule_index": rule_index,
+        "action": action,
+        "folder": folder,
+        "from": _to_text(sender),
+        "subject": _to_text(subject),
+    }
+    return json.dumps(record, ensure_ascii=False) + "\n"
+
+
+def _to_text(value) -> str | None:
+    if value is None:
+        return None
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode("utf-8", errors="replace")
+    return str(value)
+
+
+def _gzip_rotator(source: str, dest: str) -> None:
+    with open(source, "rb") as src_file, gzip.open(dest, "wb") as dest_file:
+        shutil.copyfileobj(src_file, dest_file)
+    os.remove(source)
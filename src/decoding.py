@@ -0,0 +1,191 @@
+"""ヘッダーの解析のワーカープロセスへの分散
+
+ヘッダーのデコード（RFC 2047のデコードと結合文字の除去）はPythonで行うので、
+大量のメールを取得すると1つのCPUを使い切り、その間は通信が止まる。
+decode_workersを指定したアカウントでは、取得したヘッダーをチャンクごとに
+1つのバイト列にまとめてワーカーのプロセスに送り、解析した値だけを受け取る。
+接続とメールの順序、移動はメインのプロセスのまま変わらない。
+
+ワーカーのプロセスはすべてのアカウントで共有する（プロセス数は最初に
+要求された数で、CPUの数を上限にする）。スレッドを使うメインのプロセスを
+forkしないように、forkserver（使えない環境ではspawn）で起動する。
+
+本文のデコード（途中までしか取得していない本文の転送エンコーディングと
+文字コードのデコード）もここに置き、サーバーのメールと保存してあるメール
+（src.replay）の両方で使う。
+"""
+import binascii
+import codecs
+import email
+import multiprocessing
+import os
+import threading
+from collections import deque
+
+from loguru import logger
+
+from src.headers import EmailDetails, parse_email_details
+
+# 解析を待つチャンクの数の上限（ワーカー1つあたり）
+MAX_PENDING_PER_WORKER = 2
+
+_lock = threading.Lock()
+_pool = None
+
+
+def get_pool(workers: int):
+    """共有のプロセスプールを返す（起動できない場合はNone）"""
+    global _pool
+    with _lock:
+        if _pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+
+            methods = multiprocessing.get_all_start_methods()
+            method = "forkserver" if "forkserver" in methods else "spawn"
+            try:
+                _pool = ProcessPoolExecutor(
+                    min(workers, os.cpu_count() or 1),
+                    mp_context=multiprocessing.get_context(method),
+                )
+            except (OSError, ValueError) as e:
+                logger.warning(f"解析用のプロセスを起動できませんでした: {e}")
+                return None
+        return _pool
+
+
+def _discard_pool(pool) -> None:
+    """壊れたプロセスプールを捨てる（次のget_poolで起動し直す）"""
+    global _pool
+    with _lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def parse_header_batch(data: bytes, ends: list[int]) -> list[tuple | None]:
+    """ワーカーでdataを区切ったヘッダーを解析し、EmailDetailsの値を返す
+
+    dataはヘッダーをつなげたもので、endsはそれぞれの終わりの位置。
+    解析できなかったものはNoneにする。
+    """
+    results = []
+    start = 0
+    for end in ends:
+        try:
+            email_data = parse_email_details(None, data[start:end])
+            results.append((
+                email_data.subject, email_data.sender, email_data.to,
+                email_data.cc, email_data.date, email_data.message_id,
+            ))
+        except Exception:
+            results.append(None)
+        start = end
+    return results
+
+
+def parse_headers(batches, workers: int, parse, failed: list):
+    """[(メールID, ヘッダー)]のバッチをワーカーで解析し、EmailDetailsを順に返す
+
+    バッチはワーカーの数のMAX_PENDING_PER_WORKER倍まで先に送るので、
+    ワーカーが解析している間に次のバッチを取得できる。
+    parseはメインのプロセスが解析を待った時間の積算に使い、
+    解析できなかったメールIDはfailedに加える。
+    プロセスプールが使えない場合はこのプロセスで解析する。
+    """
+    pool = get_pool(workers)
+    limit = max(workers, 1) * MAX_PENDING_PER_WORKER
+    pending = deque()
+    for batch in batches:
+        if not batch:
+            continue
+        data, ends = _join(batch)
+        future = None
+        if pool is not None:
+            try:
+                future = pool.submit(parse_header_batch, data, ends)
+            except RuntimeError as e:
+                # 異常終了したか、ほかのスレッドが捨てたプロセスプール
+                logger.warning(f"ヘッダーの解析をこのプロセスで行います: {e}")
+                _discard_pool(pool)
+                pool = None
+        pending.append((batch, data, ends, future, pool))
+        if len(pending) >= limit:
+            yield from _collect(*pending.popleft(), parse, failed)
+    while pending:
+        yield from _collect(*pending.popleft(), parse, failed)
+
+
+def _join(batch) -> tuple[bytes, list[int]]:
+    """ヘッダーを1つのバイト列にまとめる（メールごとのオブジェクトをpickleしない）"""
+    ends = []
+    size = 0
+    for _, raw_email in batch:
+        size += len(raw_email)
+        ends.append(size)
+    return b"".join(raw_email for _, raw_email in batch), ends
+
+
+def _collect(batch, data, ends, future, pool, parse, failed):
+    with parse:
+        results = None
+        if future is not None:
+            try:
+                results = future.result()
+            except Exception as e:
+                # ワーカーが異常終了した場合は、このバッチをこのプロセスで解析する
+                logger.warning(f"ヘッダーの解析をこのプロセスで行います: {e}")
+                _discard_pool(pool)
+        if results is None:
+            results = parse_header_batch(data, ends)
+    for (msg_id, _), fields in zip(batch, results):
+        if fields is None:
+            logger.debug(f"メール解析エラー: メッセージID {msg_id}")
+            failed.append(msg_id)
+            continue
+        parse.messages += 1
+        yield EmailDetails(msg_id, *fields)
+
+
+def decode_message_body(raw_email: bytes, max_bytes: int) -> str:
+    """メールの先頭部分から最初のtext/plainパートの本文をデコードする
+
+    本文はmax_bytesまでで、途中で切れた文字は捨てる。
+    """
+    msg = email.message_from_bytes(raw_email)
+    for part in msg.walk():
+        if part.get_content_type() == "text/plain":
+            break
+    else:
+        part = None
+
+    if part is None or isinstance(part.get_payload(), list):
+        # 見つからない場合はヘッダーの後をそのまま本文として扱う
+        _, _, raw_body = raw_email.partition(b"\r\n\r\n")
+        return decode_partial_body(raw_body[:max_bytes], "7bit", "utf-8")
+
+    # 8bitの本文はsurrogateescapeで保持されているので元のバイト列に戻す
+    raw_body = part.get_payload().encode("ascii", errors="surrogateescape")
+    encoding = part.get("Content-Transfer-Encoding", "7bit").strip().lower()
+    charset = part.get_content_charset() or "utf-8"
+    return decode_partial_body(raw_body[:max_bytes], encoding, charset)
+
+
+def decode_partial_body(raw_body: bytes, encoding: str, charset: str) -> str:
+    """途中で切れた本文を転送エンコーディングと文字コードに従ってデコードする"""
+    if encoding == "base64":
+        data = b"".join(raw_body.split())
+        # 4文字単位で途中のものは捨てる
+        data = binascii.a2b_base64(data[:len(data) - len(data) % 4])
+    elif encoding == "quoted-printable":
+        # 途中で切れたエスケープ（"=" や "=X"）は捨てる
+        cut = raw_body.rfind(b"=", max(0, len(raw_body) - 2))
+        data = binascii.a2b_qp(raw_body[:cut] if cut >= 0 else raw_body)
+    else:
+        data = raw_body
+
+    try:
+        decoder = codecs.getincrementaldecoder(charset)(errors="replace")
+    except LookupError:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    # final=Falseにすると途中で切れたマルチバイト文字は出力されない
+    return decoder.decode(data, final=False)
@@ -1,93 +1,464 @@
 import datetime
-import email
-import imaplib
-import poplib
-import unicodedata
-from email.header import decode_header
-from typing import Literal
-
-import pydantic
-import yaml
-from loguru import logger
-from pydantic import SecretStr
+import functools
+import queue
+import re
+import select
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Literal, NamedTuple
 
+from loguru import logger
 
-class EmailAccount(pydantic.BaseModel):
-    imap_server: str
-    email: str
-    password: SecretStr
-    protocol: Literal["IMAP", "POP3"] = "IMAP"
+import src.config
+from src.decoding import decode_message_body, decode_partial_body
+from src.folders import FolderRegistry, quote_mailbox_name
+from src.headers import parse_email_details, remove_combining_characters
+from src.metrics import NULL_METRICS, ConnectionStats, instrument_connection
+from src.ratelimit import HostBudget, is_throttling_response, limit_commands
+from src.record import Record
+
+if TYPE_CHECKING:
+    import imaplib
+
+# 一括取得時に1回のFETCHで扱うメール数
+FETCH_CHUNK_SIZE = 500
+
+# 振り分けに必要なヘッダーのみを取得する
+HEADER_FIELDS = "SUBJECT FROM TO CC DATE MESSAGE-ID"
+
+# 1回のUID COPY/MOVE/STOREで扱うメール数
+COMMAND_CHUNK_SIZE = 1000
+
+# 本文ルールの判定に使う本文の最大バイト数
+BODY_FETCH_BYTES = 64 * 1024
+# ヘッダーの並列取得に使う接続数の上限（プロバイダーの同時接続数の制限対策）
+MAX_FETCH_CONNECTIONS = 4
+# POP3のTOPで本文を行数で指定する際の1行あたりのバイト数の目安
+# （base64やquoted-printableの1行は76文字）
+BODY_LINE_BYTES = 76
+
+# IDLEが使えない場合にNOOPで新着を確認する間隔（秒）
+NOOP_POLL_INTERVAL = 30
+
+FETCH_UID_PATTERN = re.compile(rb"\bUID (\d+)")
+FETCH_START_PATTERN = re.compile(rb"^\d+ \(")
+FETCH_MODSEQ_PATTERN = re.compile(rb"\bMODSEQ \((\d+)\)")
+VANISHED_PATTERN = re.compile(rb"^(?:\(EARLIER\) )?([\d:,]+)")
+NEW_MAIL_PATTERN = re.compile(rb"^\* \d+ (EXISTS|RECENT)\b", re.IGNORECASE)
+COPYUID_PATTERN = re.compile(rb"^\d+ ([\d:,]+) [\d:,]+")
+
+
+class EmailAccount(Record):
+    FIELDS = {
+        "imap_server": (str, ...),
+        "email": (str, ...),
+        "password": (str, ...),
+        "protocol": (Literal["IMAP", "POP3"], "IMAP"),
+        # 応答のないサーバーで処理が止まらないようにするタイムアウト（秒）
+        "timeout": (float | None, 60.0),
+        # 振り分けルールをサーバー側のSEARCHで絞り込んでから取得する（IMAPのみ）
+        "server_search": (bool, False),
+        # ヘッダーの取得に使う接続数（2以上の場合は読み取り専用の接続を別に開いて
+        # 並列に取得する。上限はMAX_FETCH_CONNECTIONS）
+        "fetch_connections": (int, 1),
+        # ヘッダーの解析に使うプロセス数（0の場合は取得するプロセスで解析する。
+        # IMAPのみ。プロセスはすべてのアカウントで共有する）
+        "decode_workers": (int, 0),
+        # サーバーがCOMPRESS=DEFLATE（RFC 4978）に対応していれば通信を圧縮する（IMAPのみ）
+        "compress": (bool, True),
+        # 送信者の評判（src.reputation）で判定する信頼度（0.5〜1。Noneの場合は
+        # 記録だけしてルールで判定する）
+        "reputation_threshold": (float | None, None),
+    }
+    __slots__ = tuple(FIELDS)
+
+    def __repr__(self) -> str:
+        # ログにパスワードを出さない
+        values = {**self.to_dict(), "password": "**********"}
+        attrs = ", ".join(f"{name}={value!r}" for name,
+                          value in values.items())
+        return f"{type(self).__name__}({attrs})"
 
 
 class EmailClient:
+    # 接続を維持したまま新着メールを待てるか
+    supports_idle = False
+    # メールをフォルダに移動できるか（できない場合、判定して記録したメールを処理済みとする）
+    supports_move = False
+    # 処理時間や転送量の計測先（既定では計測しない）
+    metrics = NULL_METRICS
+
     def __init__(self, email_account: EmailAccount):
         self.email_account = email_account
         self.email_client = None
+        # 選択中のメールボックスのUIDVALIDITY（IMAPのみ）
+        self.uid_validity = None
+        # 同期状態に記録するHIGHESTMODSEQ（CONDSTOREに対応したIMAPサーバーのみ）
+        self.highest_modseq = None
+        # 前回の同期から削除されたUIDの範囲（QRESYNCに対応したIMAPサーバーのみ）
+        self.vanished: list[tuple[int, int]] = []
+        self.connection_stats = ConnectionStats()
+        # サーバーごとの接続数・コマンド速度の予算（制限しない場合はNone）
+        self.budget: HostBudget | None = None
+        # サーバーに制限されたか（スケジューラーが処理し直すかの判定に使う）
+        self.throttled = False
+        # 直前のget_emails_details_bulkで取得・解析できなかったメールID
+        # （同期状態をこれより先に進めず、次回処理し直す）
+        self.failed_ids: list = []
 
     def connect_to_server(self): ...
 
-    def get_emails(self): ...
+    def get_emails(self, sync_state=None): ...
 
     def get_email_details(self, msg_id): ...
 
+    def advance_sync_state(self, sync_state, msg_ids, complete: bool = False) -> None:
+        """処理したメールまで同期状態のチェックポイントを進める
+
+        completeは取得したメールをすべて処理したことを表し、その場合だけ
+        HIGHESTMODSEQも記録する（途中で記録すると未処理のメールを見落とす）。
+        """
+        sync_state.advance(
+            self.uid_validity, msg_ids, self.highest_modseq if complete else None)
+
+    def search_emails(self, criteria: str, msg_ids):
+        """msg_idsのうちサーバー側でcriteriaにマッチするものを返す
+
+        サーバー側で検索できない場合はNoneを返す。
+        """
+        return None
+
+    def get_header_fields(self, msg_ids, fields: list[str]) -> dict:
+        """msg_idsのメールのfieldsのヘッダーだけを取得して{メールID: ヘッダー}を返す
+
+        まとめて取得できないプロトコルでは空の辞書を返す。
+        """
+        return {}
+
+    def get_email_body(self, msg_id, max_bytes=BODY_FETCH_BYTES) -> str:
+        """メール本文の先頭を取得する（未対応のプロトコルでは空文字）"""
+        return ""
+
+    def prefetch_bodies(self, emails, needs_body, batch_size=FETCH_CHUNK_SIZE):
+        """needs_bodyが真になるメールの本文をまとめて取得しながら順に返す
+
+        まとめて取得できないプロトコルでは何もしない（本文は判定時に1通ずつ取得する）。
+        """
+        return emails
+
+    def get_emails_details_bulk(self, msg_ids, chunk_size=FETCH_CHUNK_SIZE):
+        """複数のメールの詳細情報を順に取得する（失敗したものはfailed_idsに記録する）"""
+        self.failed_ids = []
+        for msg_id in msg_ids:
+            email_data = self.get_email_details(msg_id)
+            if email_data:
+                yield email_data
+            else:
+                self.failed_ids.append(msg_id)
+
+    def prepare_folders(self, folders) -> None:
+        """移動先のフォルダを事前に用意する（フォルダのないプロトコルでは何もしない）"""
+
     def move_emails_to_folder(self, message_ids, folder): ...
 
     def delete_emails(self, message_ids): ...
 
+    def _limit_commands(self, connection) -> None:
+        if self.budget is not None:
+            limit_commands(connection, self.budget, self._report_throttling)
+
+    def _report_throttling(self, reason: str) -> None:
+        self.throttled = True
+        if self.budget is not None:
+            self.budget.throttled(reason)
+
+    def _check_connect_error(self, error: Exception) -> None:
+        # ログインの応答で既に知らされた場合は重ねて数えない
+        if not self.throttled and is_throttling_response(error):
+            self._report_throttling(str(error))
+
+    def wait_for_changes(self, timeout, stop_event=None) -> bool:
+        """新着メールを待つ（対応していないプロトコルでは待たない）"""
+        return False
+
     def logout(self): ...
 
 
 class EmailClientIMAP(EmailClient):
+    supports_idle = True
+    supports_move = True
+    # 接続に使うクラス（Noneの場合はimaplib.IMAP4_SSL。ベンチマークでは
+    # 偽のサーバーに差し替える）
+    imap_factory = None
+
+    def __init__(self, email_account: EmailAccount):
+        super().__init__(email_account)
+        # サーバーが対応している拡張
+        self.capabilities: set[str] = set()
+        # QRESYNC（RFC 7162）を有効にしたか
+        self.qresync = False
+        # 選択した時点のHIGHESTMODSEQ（最初のget_emailsでだけ使う）
+        self._selected_modseq = None
+        # UID MOVEで移動済み（削除不要）のUID
+        self._moved_uids: set[str] = set()
+        # 接続中のフォルダの一覧（接続するたびに作り直す）
+        self.folders: FolderRegistry | None = None
+
     def connect_to_server(self):
         """IMAPサーバーに接続してログインする"""
         try:
             server = self.email_account.imap_server
-            username = self.email_account.email
-            password = self.email_account.password.get_secret_value()
 
-            # IMAPサーバーに接続
-            self.email_client = imaplib.IMAP4_SSL(server)
+            # IMAPサーバーに接続してログイン
+            self.email_client = self._open_connection(self.connection_stats)
+            self.folders = FolderRegistry(self.email_client)
 
-            # ログイン
-            self.email_client.login(username, password)
+            # ログイン後に有効になる拡張もあるので改めて確認する
+            _, data = self.email_client.capability()
+            self.capabilities = set(data[0].decode().upper().split())
+            self._start_compression(self.email_client)
+            self._enable_qresync()
 
             # メールボックスを選択（デフォルトはINBOX）
             self.email_client.select("INBOX")
+            _, data = self.email_client.response("UIDVALIDITY")
+            self.uid_validity = int(data[0]) if data and data[0] else None
+            # CONDSTOREに対応していればHIGHESTMODSEQが返る（NOMODSEQの場合は返らない）
+            _, data = self.email_client.response("HIGHESTMODSEQ")
+            self._selected_modseq = int(data[0]) if data and data[0] else None
 
             logger.debug(f"接続成功: {server}")
             return True
         except Exception as e:
             logger.debug(f"接続エラー: {e}")
+            self._check_connect_error(e)
             self.email_client = None
             return False
 
-    def get_emails(self):
-        """メールを検索してメールIDのリストを取得する"""
+    def _open_connection(self, stats: ConnectionStats) -> "imaplib.IMAP4":
+        """新しい接続を開いてログインする"""
+        factory = self.imap_factory
+        if factory is None:
+            # 使わないプロトコルのモジュールは読み込まないように、ここで読み込む
+            import imaplib
+            factory = imaplib.IMAP4_SSL
+        connection = factory(
+            self.email_account.imap_server, timeout=self.email_account.timeout)
+        if self.metrics.enabled:
+            instrument_connection(connection, stats)
+        self._limit_commands(connection)
+        connection.login(
+            self.email_account.email,
+            self.email_account.password,
+        )
+        return connection
+
+    def _start_compression(self, connection) -> None:
+        """サーバーが対応していれば以降の通信を圧縮する（対応していなければそのまま）"""
+        if not self.email_account.compress or "COMPRESS=DEFLATE" not in self.capabilities:
+            return
+        # imaplibにCOMPRESSを登録するので、コマンドを送る前に読み込む
+        from src.compression import enable_deflate
+
+        try:
+            status, data = connection._simple_command("COMPRESS", "DEFLATE")
+        except connection.error as e:
+            # BADの場合は圧縮せずに続ける
+            status, data = "BAD", e
+        if status == "OK":
+            enable_deflate(connection)
+            logger.debug("通信の圧縮を開始しました")
+        else:
+            logger.debug(f"通信を圧縮できませんでした: {data}")
+
+    def _enable_qresync(self) -> None:
+        """サーバーが対応していればQRESYNCを有効にする（VANISHEDで削除を知るため）"""
+        if "QRESYNC" not in self.capabilities:
+            return
+        try:
+            status, data = self.email_client._simple_command(
+                "ENABLE", "QRESYNC")
+        except self.email_client.error as e:
+            status, data = "BAD", e
+        _, enabled = self.email_client.response("ENABLED")
+        self.qresync = status == "OK" and any(
+            b"QRESYNC" in item.upper() for item in enabled if item)
+        if not self.qresync:
+            logger.debug(f"QRESYNCを有効にできませんでした: {data}")
+
+    @property
+    def condstore(self) -> bool:
+        """CHANGEDSINCEで変更されたメールだけを取得できるか"""
+        return self.qresync or "CONDSTORE" in self.capabilities
+
+    def _open_fetch_connection(self, stats: ConnectionStats) -> "imaplib.IMAP4 | None":
+        """ヘッダーの並列取得用に、INBOXを読み取り専用で開いた接続を返す"""
+        try:
+            connection = self._open_connection(stats)
+            self._start_compression(connection)
+            connection.select("INBOX", readonly=True)
+            _, data = connection.response("UIDVALIDITY")
+            uid_validity = int(data[0]) if data and data[0] else None
+            if uid_validity != self.uid_validity:
+                # 接続の間にUIDが振り直された場合は使わない
+                _logout_quietly(connection)
+                return None
+            return connection
+        except Exception as e:
+            logger.debug(f"取得用の接続エラー: {e}")
+            return None
+
+    def get_emails(self, sync_state=None):
+        """メールを検索してメールのUIDのリストを取得する
+
+        sync_stateのチェックポイントが有効な場合は、前回処理したUIDより
+        新しいメールのみを取得する。サーバーがCONDSTOREに対応していれば、
+        前回からHIGHESTMODSEQが変わっていない場合は検索せず、変わっていれば
+        CHANGEDSINCEで変更分だけを取得する（QRESYNCでは削除されたUIDも）。
+        """
+        # 選択した時点の値は、同じ接続で2回目以降に呼ばれた場合には古い
+        selected_modseq, self._selected_modseq = self._selected_modseq, None
+        # ここまでに知らされた新着はこの検索で取得するので、新着の待機では使わない
+        self._take_new_mail_responses()
+        self.highest_modseq = selected_modseq
+        self.vanished = []
         try:
+            last_uid = 0
+            if sync_state and sync_state.is_valid_for(self.uid_validity):
+                # 前回処理したUIDより新しいメールを取得
+                last_uid = sync_state.last_uid
+                criteria = f"(UID {last_uid + 1}:*)"
+                if self.condstore and sync_state.highest_modseq:
+                    if selected_modseq == sync_state.highest_modseq:
+                        logger.debug("前回からメールボックスは変更されていません。")
+                        return []
+                    email_ids = self._fetch_changes(
+                        sync_state.highest_modseq, last_uid)
+                    if email_ids is not None:
+                        # 選択した時点までの変更はすべて受け取った
+                        self.highest_modseq = max(
+                            self.highest_modseq, selected_modseq or 0)
+                        return email_ids
+            else:
+                if sync_state and sync_state.last_uid:
+                    logger.debug("UIDVALIDITYが変わったため同期状態をリセットします。")
+                # 24時間以内に受信したメールを取得
+                since_date = (
+                    datetime.datetime.now() - datetime.timedelta(days=1)
+                ).strftime("%d-%b-%Y")
+                criteria = f'(SINCE "{since_date}")'
+
             # メールを検索
-            # 24時間以内に受信したメールを取得
-            since_date = (
-                datetime.datetime.now() - datetime.timedelta(days=1)
-            ).strftime("%d-%b-%Y")
-            result, data = self.email_client.search(
-                None, f'(SINCE "{since_date}")')
+            result, data = self.email_client.uid("SEARCH", None, criteria)
 
             if result != "OK":
                 logger.debug("メールの検索に失敗しました。")
                 return []
 
-            # メールIDのリストを取得
+            # メールのUIDのリストを取得
             email_ids = data[0].split()
 
+            # "UID n:*" は新着がなくても最大のUIDを返すので除外する
+            if last_uid:
+                email_ids = [uid for uid in email_ids if int(uid) > last_uid]
+
             return email_ids
         except Exception as e:
             logger.debug(f"メールの取得エラー: {e}")
             return []
 
+    def _fetch_changes(self, modseq: int, last_uid: int):
+        """modseqより後に追加・変更されたメールのうちlast_uidより新しいUIDを返す
+
+        QRESYNCではメールボックス全体を対象にして、削除されたUIDの範囲を
+        self.vanishedに記録する（失敗した場合はNone）。
+        """
+        try:
+            if self.qresync:
+                uid_set, modifier = "1:*", f"(CHANGEDSINCE {modseq} VANISHED)"
+            else:
+                # 古いメールのフラグの変更は使わないので、新しい範囲だけを対象にする
+                uid_set, modifier = f"{last_uid + 1}:*", f"(CHANGEDSINCE {modseq})"
+            result, data = self.email_client.uid(
+                "FETCH", uid_set, "(UID)", modifier)
+            if result != "OK":
+                logger.debug(f"変更されたメールの取得に失敗しました: {data}")
+                return None
+            _, vanished = self.email_client.response("VANISHED")
+        except Exception as e:
+            logger.debug(f"変更されたメールの取得エラー: {e}")
+            return None
+
+        # 削除されたメールのMODSEQは分からないので、応答から分かる最大値にとどめる
+        # （次回に同じ削除をもう一度受け取るだけで見落としはない）
+        highest_modseq = modseq
+        email_ids = set()
+        changed = 0
+        for item in data:
+            if isinstance(item, tuple):
+                item = item[0]
+            if not item:
+                continue
+            uid = FETCH_UID_PATTERN.search(item)
+            modseq_match = FETCH_MODSEQ_PATTERN.search(item)
+            if modseq_match:
+                highest_modseq = max(
+                    highest_modseq, int(modseq_match.group(1)))
+            if uid and int(uid.group(1)) > last_uid:
+                email_ids.add(int(uid.group(1)))
+            elif uid:
+                changed += 1
+        for item in vanished:
+            match = VANISHED_PATTERN.match(item or b"")
+            if match:
+                self.vanished.extend(_sequence_ranges(match.group(1).decode()))
+        self.highest_modseq = highest_modseq
+        logger.debug(
+            f"前回から新着{len(email_ids)}件、変更{changed}件、"
+            f"削除{sum(last - first + 1 for first, last in self.vanished)}件")
+        return [str(uid).encode() for uid in sorted(email_ids)]
+
+    def search_emails(self, criteria: str, msg_ids):
+        """msg_idsのうちサーバー側でcriteriaにマッチするUIDを返す"""
+        if not msg_ids:
+            return []
+        try:
+            # UIDの範囲で絞ってから、念のため候補との共通部分を取る
+            uids = [int(msg_id) for msg_id in msg_ids]
+            query = f"(UID {min(uids)}:{max(uids)} {criteria})"
+            result, data = self.email_client.uid("SEARCH", None, query)
+            if result != "OK":
+                logger.debug("サーバー側の検索に失敗しました。")
+                return None
+            hits = {int(uid) for uid in data[0].split()}
+            return [msg_id for msg_id, uid in zip(msg_ids, uids) if uid in hits]
+        except Exception as e:
+            logger.debug(f"サーバー側の検索エラー: {e}")
+            return None
+
+    def get_header_fields(self, msg_ids, fields: list[str], chunk_size=FETCH_CHUNK_SIZE) -> dict:
+        """msg_idsのメールのfieldsのヘッダーだけをchunk_size件ごとに取得する
+
+        サーバー側の検索でマッチしなかったメールの確認に使う。
+        取得できなかったメールは含めない。
+        """
+        headers = {}
+        for start in range(0, len(msg_ids), chunk_size):
+            id_map, raw_headers = self._fetch_header_chunk(
+                self.email_client, msg_ids[start:start + chunk_size], " ".join(fields))
+            if raw_headers is None:
+                continue
+            for uid, msg_id in id_map.items():
+                if uid in raw_headers:
+                    headers[msg_id] = raw_headers[uid]
+        return headers
+
     def get_email_details(self, msg_id):
         """メールの詳細情報を取得する"""
         try:
-            status, msg_data = self.email_client.fetch(msg_id, "(BODY.PEEK[])")
+            status, msg_data = self.email_client.uid(
+                "FETCH", msg_id, "(BODY.PEEK[])")
 
             if status != "OK":
                 logger.debug(f"メール取得エラー: メッセージID {msg_id}")
@@ -95,47 +466,255 @@ class EmailClientIMAP(EmailClient):
 
             # メールの内容を解析
             raw_email = msg_data[0][1]
-            msg = email.message_from_bytes(raw_email)
-
-            # 件名を取得してデコード
-            subject = decode_header(msg["Subject"])
-            if subject[0][1] is not None:
-                # エンコーディングが指定されている場合はデコード
-                subject = subject[0][0].decode(subject[0][1], errors="ignore")
-            else:
-                # エンコーディングが指定されていない場合はそのまま
-                subject = subject[0][0]
-                if isinstance(subject, bytes):
-                    subject = subject.decode("utf-8", errors="ignore")
-
-            # 送信者を取得
-            sender = msg.get("From", "")
-
-            # To, CCを取得
-            to = msg.get("To", "")
-            cc = msg.get("Cc", "")
-
-            # 日付を取得
-            date = msg.get("Date", "")
-
-            # 結合文字列を除去
-            subject = remove_combining_characters(subject)
-            sender = remove_combining_characters(sender)
-            to = remove_combining_characters(to)
-            cc = remove_combining_characters(cc)
-
-            return {
-                "id": msg_id,
-                "subject": subject,
-                "from": sender,
-                "to": to,
-                "cc": cc,
-                "date": date,
-            }
+            email_data = parse_email_details(msg_id, raw_email)
+            # 本文は本文ルールの判定時に必要になった場合だけ取得する
+            email_data["load_body"] = functools.partial(
+                self.get_email_body, msg_id)
+            return email_data
         except Exception as e:
             logger.debug(f"メール解析エラー: {e}")
             return None
 
+    def get_email_body(self, msg_id, max_bytes=BODY_FETCH_BYTES) -> str:
+        """メール本文の先頭max_bytesバイトを取得してデコードする
+
+        BODYSTRUCTUREから最初のtext/plainパートを探し、そのパートの先頭だけを
+        取得するので、大きな添付ファイルがあっても転送量は増えない。
+        """
+        try:
+            status, msg_data = self.email_client.uid(
+                "FETCH", msg_id, "(BODYSTRUCTURE)")
+            if status != "OK":
+                logger.debug(f"本文構造の取得エラー: メッセージID {msg_id}")
+                return ""
+            part = _find_text_part(_parse_bodystructure(msg_data))
+            if part is None:
+                # 構造が分からない場合は本文全体の先頭をそのまま使う
+                part = TextPart("TEXT", "7bit", "utf-8")
+
+            status, msg_data = self.email_client.uid(
+                "FETCH", msg_id, f"(BODY.PEEK[{part.section}]<0.{max_bytes}>)"
+            )
+            if status != "OK":
+                logger.debug(f"本文の取得エラー: メッセージID {msg_id}")
+                return ""
+            raw_body = _parse_fetch_response(
+                msg_data).get(_to_str(msg_id), b"")
+
+            body = decode_partial_body(raw_body, part.encoding, part.charset)
+            return remove_combining_characters(body)
+        except Exception as e:
+            logger.debug(f"本文の取得エラー: {e}")
+            return ""
+
+    def prefetch_bodies(self, emails, needs_body, batch_size=FETCH_CHUNK_SIZE):
+        """needs_bodyが真になるメールの本文をbatch_size件ごとにまとめて取得する
+
+        1通ずつ取得するとBODYSTRUCTUREと本文の2往復がかかるので、
+        BODYSTRUCTUREを1回のFETCHで取得し、本文は同じセクションのメールごとに
+        1回のFETCHで取得する。取得できなかったメールは判定時に1通ずつ取得する。
+        """
+        batch = []
+        for email_data in emails:
+            batch.append(email_data)
+            if len(batch) >= batch_size:
+                self._fetch_bodies([e for e in batch if needs_body(e)])
+                yield from batch
+                batch = []
+        self._fetch_bodies([e for e in batch if needs_body(e)])
+        yield from batch
+
+    def _fetch_bodies(self, emails, max_bytes=BODY_FETCH_BYTES) -> None:
+        """emailsの本文の先頭を取得してemail_data["body"]に設定する"""
+        if not emails:
+            return
+        by_uid = {_to_str(email_data["id"])
+                          : email_data for email_data in emails}
+        try:
+            status, msg_data = self.email_client.uid(
+                "FETCH", _sequence_set(by_uid), "(BODYSTRUCTURE)")
+            if status != "OK":
+                logger.debug(f"{len(emails)}件の本文構造を取得できませんでした: {msg_data}")
+                return
+            sections: dict[str, list[tuple[str, TextPart]]] = {}
+            for uid, structure in _parse_bodystructures(msg_data).items():
+                if uid not in by_uid:
+                    continue
+                part = _find_text_part(structure)
+                if part is None:
+                    # 構造が分からない場合は本文全体の先頭をそのまま使う
+                    part = TextPart("TEXT", "7bit", "utf-8")
+                sections.setdefault(part.section, []).append((uid, part))
+
+            for section, parts in sections.items():
+                status, msg_data = self.email_client.uid(
+                    "FETCH", _sequence_set(uid for uid, _ in parts),
+                    f"(BODY.PEEK[{section}]<0.{max_bytes}>)",
+                )
+                if status != "OK":
+                    logger.debug(f"{len(parts)}件の本文を取得できませんでした: {msg_data}")
+                    continue
+                raw_bodies = _parse_fetch_response(msg_data)
+                for uid, part in parts:
+                    raw_body = raw_bodies.get(uid)
+                    if raw_body is None:
+                        continue
+                    body = decode_partial_body(
+                        raw_body, part.encoding, part.charset)
+                    by_uid[uid]["body"] = remove_combining_characters(body)
+        except Exception as e:
+            logger.debug(f"本文の取得エラー: {e}")
+
+    def get_emails_details_bulk(self, msg_ids, chunk_size=FETCH_CHUNK_SIZE):
+        """複数のメールのヘッダーをまとめて取得する
+
+        chunk_size件ごとに1回のFETCHでヘッダーのみを取得し、
+        get_email_detailsと同じ形式のEmailDetailsを順に返す。
+        fetch_connectionsが2以上の場合は複数の接続で並列に取得し、
+        decode_workersが1以上の場合は別のプロセスで解析するが、
+        返す順序はmsg_idsの順序のまま変わらない。
+        取得・解析できなかったメールはfailed_idsに記録する。
+        """
+        self.failed_ids = []
+        parse = self.metrics.accumulator("parse")
+        chunks = [
+            msg_ids[start:start + chunk_size]
+            for start in range(0, len(msg_ids), chunk_size)
+        ]
+        connections = min(
+            self.email_account.fetch_connections, MAX_FETCH_CONNECTIONS, len(chunks))
+        try:
+            if connections > 1:
+                fetched = self._fetch_header_chunks_parallel(
+                    chunks, connections)
+            else:
+                fetched = (
+                    self._fetch_header_chunk(self.email_client, chunk)
+                    for chunk in chunks
+                )
+            if self.email_account.decode_workers > 0:
+                from src.decoding import parse_headers
+
+                batches = (
+                    self._header_batch(id_map, raw_headers)
+                    for id_map, raw_headers in fetched
+                )
+                for email_data in parse_headers(
+                        batches, self.email_account.decode_workers, parse, self.failed_ids):
+                    email_data["load_body"] = functools.partial(
+                        self.get_email_body, email_data.id)
+                    yield email_data
+            else:
+                for id_map, raw_headers in fetched:
+                    yield from self._parse_header_chunk(id_map, raw_headers, parse)
+        finally:
+            parse.record()
+
+    def _fetch_header_chunk(self, connection, chunk, fields=HEADER_FIELDS):
+        """1回のFETCHでchunkのメールのヘッダー（fieldsの項目）を取得する"""
+        # レスポンスのUIDから元のメールIDを引けるようにする
+        id_map = {_to_str(msg_id): msg_id for msg_id in chunk}
+        try:
+            status, msg_data = connection.uid(
+                "FETCH", _sequence_set(
+                    id_map), f"(BODY.PEEK[HEADER.FIELDS ({fields})])"
+            )
+        except Exception as e:
+            logger.warning(f"{len(chunk)}件のヘッダーを取得できませんでした: {e}")
+            return id_map, None
+
+        if status != "OK":
+            logger.warning(f"{len(chunk)}件のヘッダーを取得できませんでした: {msg_data}")
+            return id_map, None
+        return id_map, _parse_fetch_response(msg_data)
+
+    def _fetch_header_chunks_parallel(self, chunks, connections):
+        """取得専用の接続でチャンクを並列に取得し、元の順序で返す
+
+        メインの接続は本文の取得と移動・削除に使うので、ここでは使わない。
+        サーバーの接続数の予算が空いている分だけ接続を開く（空きを待たない）。
+        """
+        opened = []
+        budget = self.budget
+        try:
+            for _ in range(connections):
+                if budget is not None and not budget.try_acquire_connection():
+                    logger.debug(f"接続数の予算が空いていないので{len(opened)}本で取得します。")
+                    break
+                stats = ConnectionStats()
+                connection = self._open_fetch_connection(stats)
+                if connection is None:
+                    if budget is not None:
+                        budget.release_connection()
+                    continue
+                opened.append((connection, stats))
+            if not opened:
+                # 追加の接続を開けない場合はメインの接続で順に取得する
+                for chunk in chunks:
+                    yield self._fetch_header_chunk(self.email_client, chunk)
+                return
+
+            idle = queue.SimpleQueue()
+            for connection, _ in opened:
+                idle.put(connection)
+
+            def fetch(chunk):
+                connection = idle.get()
+                try:
+                    return self._fetch_header_chunk(connection, chunk)
+                finally:
+                    idle.put(connection)
+
+            workers = len(opened)
+            with ThreadPoolExecutor(workers, thread_name_prefix="imap-fetch") as executor:
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(executor.submit(fetch, chunk))
+                    # 先読みは接続数の2倍までにしてメモリを抑える
+                    if len(pending) >= workers * 2:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+        finally:
+            for connection, stats in opened:
+                _logout_quietly(connection)
+                self.connection_stats.add(stats)
+                if budget is not None:
+                    budget.release_connection()
+
+    def _header_batch(self, id_map, raw_headers) -> list[tuple]:
+        """取得したヘッダーを[(メールID, ヘッダー)]としてmsg_idsの順に返す
+
+        取得できなかったメール（raw_headersがNoneの場合はすべて）はfailed_idsに記録する。
+        """
+        if raw_headers is None:
+            self.failed_ids.extend(id_map.values())
+            return []
+        batch = []
+        for uid, msg_id in id_map.items():
+            raw_email = raw_headers.get(uid)
+            if raw_email is None:
+                logger.debug(f"メール取得エラー: メッセージID {msg_id}")
+                self.failed_ids.append(msg_id)
+                continue
+            batch.append((msg_id, raw_email))
+        return batch
+
+    def _parse_header_chunk(self, id_map, raw_headers, parse):
+        """取得したヘッダーを解析してメールの詳細情報を返す"""
+        for msg_id, raw_email in self._header_batch(id_map, raw_headers):
+            try:
+                with parse:
+                    email_data = parse_email_details(msg_id, raw_email)
+                parse.messages += 1
+            except Exception as e:
+                logger.debug(f"メール解析エラー: {e}")
+                self.failed_ids.append(msg_id)
+                continue
+            email_data["load_body"] = functools.partial(
+                self.get_email_body, msg_id)
+            yield email_data
+
     def move_emails_to_folder(self, message_ids, folder) -> list[int]:
         """指定したメールを指定フォルダに移動する"""
 
@@ -145,26 +724,14 @@ class EmailClientIMAP(EmailClient):
 
         ret = []
         try:
-            status, folders = self.email_client.list()
-            if status != "OK":
-                logger.debug("フォルダの取得に失敗しました。")
-                return []
-
-            decoded_folders = [f.decode().split(' "." ')[-1] for f in folders]
-            if folder not in decoded_folders:
-                logger.debug(f"フォルダ '{folder}' は存在しません。新規作成します。")
-                self.email_client.create(folder)
-
-            total = len(message_ids)
-
-            for i, msg_id in enumerate(message_ids):
-                # 進捗表示
-                if (i + 1) % 10 == 0 or i + 1 == total:
-                    logger.debug(f"処理中... {i+1}/{total}")
+            # 通常はprepare_foldersで作成済みなので、LISTもCREATEも送らない
+            self.folders.ensure([folder])
 
-                # メールを指定フォルダに移動
-                if _move_email_to_folder(self.email_client, msg_id, folder):
-                    ret.append(msg_id)
+            for start in range(0, len(message_ids), COMMAND_CHUNK_SIZE):
+                chunk = message_ids[start:start + COMMAND_CHUNK_SIZE]
+                # メールをまとめて指定フォルダに移動
+                ret.extend(self._move_chunk_to_folder(chunk, folder))
+                logger.debug(f"処理中... {start + len(chunk)}/{len(message_ids)}")
 
             logger.debug(f"{len(ret)}件のメールを '{folder}' に移動しました")
             return ret
@@ -172,24 +739,179 @@ class EmailClientIMAP(EmailClient):
             logger.debug(f"メール移動エラー: {e}")
             return ret
 
+    def prepare_folders(self, folders) -> None:
+        """1回のLISTでフォルダの一覧を取得し、存在しない移動先をまとめて作成する"""
+        try:
+            self.folders.ensure(folders)
+        except Exception as e:
+            logger.debug(f"フォルダの準備エラー: {e}")
+
+    def _move_chunk_to_folder(self, message_ids, folder) -> list:
+        """メールをまとめて移動し、移動できたメールIDを返す
+
+        MOVE拡張（RFC 6851）があればUID MOVEで移動し、
+        なければUID COPYでコピーする（削除はdelete_emailsで行う）。
+        """
+        sequence_set = _sequence_set(message_ids)
+        use_move = "MOVE" in self.capabilities
+        command = "MOVE" if use_move else "COPY"
+        status, response = self.email_client.uid(
+            command, sequence_set, quote_mailbox_name(folder))
+        # MOVEのCOPYUIDは非タグ付き応答で返ってくる
+        _, copyuid = self.email_client.response("COPYUID")
+
+        if status != "OK":
+            logger.debug(
+                f"メール{command}エラー: メッセージID {sequence_set}, レスポンス: {response}")
+            return []
+
+        # UIDPLUS拡張のCOPYUIDがあれば実際に移動したUIDだけを成功とする
+        # （既に存在しないUIDは無視されるため）
+        moved = _copyuid_source_uids(response, copyuid)
+        if moved is not None:
+            message_ids = [
+                msg_id for msg_id in message_ids if int(msg_id) in moved
+            ]
+
+        if use_move:
+            self._moved_uids.update(_to_str(msg_id) for msg_id in message_ids)
+        return message_ids
+
     def delete_emails(self, message_ids):
         """指定したメールを削除する"""
         if not message_ids:
             logger.debug("削除するメールがありません")
             return 0
 
-        try:
-            for msg_id in message_ids:
-                # メールに削除フラグを設定
-                self.email_client.store(msg_id, "+FLAGS", "\\Deleted")
+        # UID MOVEで移動したメールは既に削除されている
+        # （数えたUIDは記録から除き、デーモンとして動かし続けても増え続けないようにする）
+        moved_count = 0
+        remaining = []
+        for msg_id in message_ids:
+            uid = _to_str(msg_id)
+            if uid in self._moved_uids:
+                self._moved_uids.discard(uid)
+                moved_count += 1
+            else:
+                remaining.append(msg_id)
+        message_ids = remaining
+        if not message_ids:
+            logger.debug(f"{moved_count}件のメールを削除しました")
+            return moved_count
 
-            # 削除フラグが設定されたメールを完全に削除
-            self.email_client.expunge()
-            logger.debug(f"{len(message_ids)}件のメールを削除しました")
-            return len(message_ids)
+        try:
+            for start in range(0, len(message_ids), COMMAND_CHUNK_SIZE):
+                sequence_set = _sequence_set(
+                    message_ids[start:start + COMMAND_CHUNK_SIZE])
+                # メールにまとめて削除フラグを設定
+                self.email_client.uid(
+                    "STORE", sequence_set, "+FLAGS.SILENT", "(\\Deleted)")
+
+                # UIDPLUS拡張があれば対象のメールだけを完全に削除
+                if "UIDPLUS" in self.capabilities:
+                    self.email_client.uid("EXPUNGE", sequence_set)
+
+            if "UIDPLUS" not in self.capabilities:
+                # 削除フラグが設定されたメールを完全に削除
+                self.email_client.expunge()
+            logger.debug(f"{len(message_ids) + moved_count}件のメールを削除しました")
+            return len(message_ids) + moved_count
         except Exception as e:
             logger.debug(f"メール削除エラー: {e}")
-            return 0
+            return moved_count
+
+    def wait_for_changes(self, timeout, stop_event=None) -> bool:
+        """新着メールが届くまで最大timeout秒待つ
+
+        IDLE拡張があればIDLEで待ち、なければNOOPでポーリングする。
+        新着があればTrue、タイムアウトまたは停止した場合はFalseを返す。
+        """
+        # 処理中のコマンドの応答で新着が知らされていれば待たない
+        if self._take_new_mail_responses():
+            return True
+        if "IDLE" in self.capabilities:
+            return self._idle(timeout, stop_event)
+        return self._poll(timeout, stop_event)
+
+    def _idle(self, timeout, stop_event) -> bool:
+        """IDLEで新着メールを待つ"""
+        client = self.email_client
+        tag = client._new_tag()
+        client.send(tag + b" IDLE\r\n")
+
+        changed = False
+        try:
+            # 継続応答 "+ idling" を待つ
+            while True:
+                line = client.readline()
+                if not line:
+                    raise client.abort("IDLE中に切断されました")
+                if line.startswith(b"+"):
+                    break
+                if line.startswith(tag):
+                    # IDLEを拒否された場合はポーリングに切り替える
+                    logger.debug(f"IDLEに失敗しました: {line!r}")
+                    client.tagged_commands.pop(tag, None)
+                    self.capabilities.discard("IDLE")
+                    if changed:
+                        return True
+                    return self._poll(timeout, stop_event)
+                changed = changed or bool(NEW_MAIL_PATTERN.match(line))
+
+            deadline = time.monotonic() + timeout
+            while not changed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (stop_event and stop_event.is_set()):
+                    break
+                # 停止要求に気付けるように1秒ごとに確認する
+                if not _wait_readable(client, min(remaining, 1.0)):
+                    continue
+                line = client.readline()
+                if not line or line.startswith(b"* BYE"):
+                    raise client.abort("IDLE中に切断されました")
+                changed = bool(NEW_MAIL_PATTERN.match(line))
+        except Exception:
+            client.tagged_commands.pop(tag, None)
+            raise
+
+        # IDLEを終了してタグ付き応答を読み捨てる
+        client.send(b"DONE\r\n")
+        while True:
+            line = client.readline()
+            if not line:
+                raise client.abort("IDLE中に切断されました")
+            if line.startswith(tag):
+                break
+            changed = changed or bool(NEW_MAIL_PATTERN.match(line))
+        client.tagged_commands.pop(tag, None)
+        return changed
+
+    def _poll(self, timeout, stop_event) -> bool:
+        """NOOPを定期的に送って新着メールを確認する"""
+        client = self.email_client
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            wait = min(remaining, NOOP_POLL_INTERVAL)
+            if stop_event:
+                if stop_event.wait(wait):
+                    return False
+            else:
+                time.sleep(wait)
+
+            client.noop()
+            if self._take_new_mail_responses():
+                return True
+
+    def _take_new_mail_responses(self) -> bool:
+        """受け取ったEXISTSとRECENTの応答を取り除き、あったかどうかを返す"""
+        changed = False
+        for response in ("EXISTS", "RECENT"):
+            _, data = self.email_client.response(response)
+            changed = changed or bool(data and data[0] is not None)
+        return changed
 
     def logout(self):
         """IMAPサーバーからログアウトする"""
@@ -202,15 +924,30 @@ class EmailClientIMAP(EmailClient):
 
 
 class EmailClientPOP3(EmailClient):
+    # 接続に使うクラス（Noneの場合はpoplib.POP3_SSL。ベンチマークでは
+    # 偽のサーバーに差し替える）
+    pop3_factory = None
+
+    def __init__(self, email_account: EmailAccount):
+        super().__init__(email_account)
+        # メール番号とUIDLの対応（UIDLに対応していないサーバーではNone）
+        self.uidls: dict[str, str] | None = None
+
     def connect_to_server(self):
         """POP3サーバーに接続してログインする"""
         try:
             server = self.email_account.imap_server
             username = self.email_account.email
-            password = self.email_account.password.get_secret_value()
+            password = self.email_account.password
+            factory = self.pop3_factory
+            if factory is None:
+                import poplib
+                factory = poplib.POP3_SSL
 
             # POP3サーバーに接続
-            self.email_client = poplib.POP3_SSL(server)
+            self.email_client = factory(
+                server, timeout=self.email_account.timeout)
+            self._limit_commands(self.email_client)
 
             # ログイン
             self.email_client.user(username)
@@ -220,72 +957,93 @@ class EmailClientPOP3(EmailClient):
             return True
         except Exception as e:
             print(f"接続エラー: {e}")
+            self._check_connect_error(e)
             self.email_client = None
             return False
 
-    def get_emails(self):
-        """メールを取得する"""
-        try:
-            # メールのリストを取得
-            num_messages = len(self.email_client.list()[1])
+    def get_emails(self, sync_state=None):
+        """未処理のメールの番号を取得する
 
-            # メールIDのリストを生成
-            email_ids = [str(i + 1) for i in range(num_messages)]
+        UIDLに対応したサーバーでは、sync_stateに記録済みのUIDLのメールを除く。
+        """
+        import poplib
 
-            return email_ids
+        try:
+            try:
+                response = self.email_client.uidl()[1]
+            except poplib.error_proto:
+                # UIDLに対応していないサーバーでは毎回すべてのメールを対象にする
+                self.uidls = None
+                num_messages = len(self.email_client.list()[1])
+                return [str(i + 1) for i in range(num_messages)]
+
+            # メール番号とUIDLの対応
+            self.uidls = {}
+            for line in response:
+                msg_num, _, uidl = line.decode(
+                    "ascii", errors="replace").partition(" ")
+                self.uidls[msg_num] = uidl.strip()
+
+            seen = set(sync_state.seen_uidls) if sync_state else set()
+            return [msg_num for msg_num, uidl in self.uidls.items() if uidl not in seen]
         except Exception as e:
             print(f"メールの取得エラー: {e}")
             return []
 
+    def advance_sync_state(self, sync_state, msg_ids, complete: bool = False) -> None:
+        """処理したメールのUIDLを記録する"""
+        if self.uidls is None:
+            return
+        sync_state.advance_uidls(
+            self.uidls.values(),
+            [self.uidls[msg_id] for msg_id in msg_ids if msg_id in self.uidls],
+        )
+
     def get_email_details(self, msg_id):
-        """メールの詳細情報を取得する"""
+        """メールのヘッダーだけを取得して詳細情報を返す"""
+        import poplib
+
         try:
-            # メールを取得
-            msg_data = self.email_client.retr(msg_id)[1]
+            try:
+                # 本文は0行、つまりヘッダーのみを取得
+                msg_data = self.email_client.top(msg_id, 0)[1]
+            except poplib.error_proto:
+                # TOPに対応していないサーバーではメール全体を取得する
+                msg_data = self.email_client.retr(msg_id)[1]
 
             # メールの内容を解析
             raw_email = b"\n".join(msg_data)
-            msg = email.message_from_bytes(raw_email)
-
-            # 件名を取得してデコード
-            subject = decode_header(msg["Subject"])
-            if subject[0][1] is not None:
-                # エンコーディングが指定されている場合はデコード
-                subject = subject[0][0].decode(subject[0][1], errors="ignore")
-            else:
-                # エンコーディングが指定されていない場合はそのまま
-                subject = subject[0][0]
-                if isinstance(subject, bytes):
-                    subject = subject.decode("utf-8", errors="ignore")
-
-            # 送信者を取得
-            sender = msg.get("From", "")
-
-            # To, CCを取得
-            to = msg.get("To", "")
-            cc = msg.get("Cc", "")
-
-            # 日付を取得
-            date = msg.get("Date", "")
-
-            return {
-                "id": msg_id,
-                "subject": subject,
-                "from": sender,
-                "to": to,
-                "cc": cc,
-                "date": date,
-            }
+            email_data = parse_email_details(msg_id, raw_email)
+            # 本文は本文ルールの判定時に必要になった場合だけ取得する
+            email_data["load_body"] = functools.partial(
+                self.get_email_body, msg_id)
+            return email_data
         except Exception as e:
             print(f"メール解析エラー: {e}")
             return None
 
+    def get_email_body(self, msg_id, max_bytes=BODY_FETCH_BYTES) -> str:
+        """メール本文の先頭をTOPで取得してデコードする"""
+        import poplib
+
+        try:
+            lines = max_bytes // BODY_LINE_BYTES + 1
+            try:
+                msg_data = self.email_client.top(msg_id, lines)[1]
+            except poplib.error_proto:
+                msg_data = self.email_client.retr(msg_id)[1]
+            body = decode_message_body(b"\r\n".join(msg_data), max_bytes)
+            return remove_combining_characters(body)
+        except Exception as e:
+            print(f"本文の取得エラー: {e}")
+            return ""
+
     def move_emails_to_folder(self, message_ids, archive_folder="Spam"):
         """指定したメールをスパムフォルダに移動する"""
 
         if not message_ids:
             print("移動するメールがありません")
-            return 0
+            return []
 
         moved_count = 0
 
@@ -302,10 +1060,11 @@ class EmailClientPOP3(EmailClient):
                 # moved_count += 1
 
             print(f"{moved_count}件のメールを '{archive_folder}' に移動しました")
-            return moved_count
+            # POP3にはフォルダがないので移動できたメールはない
+            return []
         except Exception as e:
             print(f"メール移動エラー: {e}")
-            return 0
+            return []
 
     def delete_emails(self, message_ids):
         """指定したメールを削除する"""
@@ -343,33 +1102,260 @@ setattr(
 
 
 def load_email_account(setting_dir: str) -> EmailAccount:
-    path = f"settings/{setting_dir}/email_account.yaml"
-    with open(path, "r") as f:
-        email_account_dict = yaml.safe_load(f)
-    return EmailAccount(**email_account_dict)
+    """検証済みのスナップショットからアカウントの設定を読み込む（src.config）
+
+    パスワードはスナップショットにないので、email_account.yamlから読む。
+    """
+    account = src.config.get_account_config(setting_dir)["account"]
+    return EmailAccount(**account, password=src.config.get_password(setting_dir))
 
 
-def _move_email_to_folder(email_client, msg_id, folder_name):
-    """メールを指定したフォルダに移動する"""
+def _logout_quietly(connection) -> None:
     try:
-        # メールを指定フォルダにコピー
-        status, response = email_client.copy(msg_id, folder_name)
+        connection.logout()
+    except Exception:
+        pass
 
-        if status != "OK":
-            logger.debug(f"メールコピーエラー: メッセージID {msg_id}, レスポンス: {response}")
-            return False
 
-        # 元のメールに削除フラグを設定
-        email_client.store(msg_id, "+FLAGS", "\\Deleted")
+def _wait_readable(client, timeout: float) -> bool:
+    """サーバーからの応答が届くまで最大timeout秒待つ"""
+    sock = client.sock
+    # 読み込み済みのデータはselect()では分からない（圧縮中はpendingに含まれる）
+    if _has_buffered_data(client):
         return True
-    except Exception as e:
-        logger.debug(f"メール移動エラー: {e}")
-        return False
+    # SSLの内部バッファに復号済みのデータがあればすぐに読める
+    pending = getattr(sock, "pending", None)
+    if pending and pending():
+        return True
+    readable, _, _ = select.select([sock], [], [], timeout)
+    return bool(readable)
 
 
-def remove_combining_characters(text):
-    """正規化で結合文字を分解し、結合文字でないものだけを返す"""
-    return ''.join(
-        char for char in unicodedata.normalize('NFD', text)
-        if not unicodedata.combining(char)
+def _has_buffered_data(client) -> bool:
+    """imaplibのファイル（BufferedReader）に読み込み済みで未処理のデータがあるか
+
+    サーバーが複数の行を1度に送ると、readline()で読んだ行の後ろが
+    バッファに残る。peek()はバッファが空だと受信を待つので、その間だけ
+    ソケットをノンブロッキングにする。
+    """
+    peek = getattr(client.file, "peek", None)
+    if peek is None:
+        return False
+    sock = client.sock
+    timeout = sock.gettimeout()
+    sock.settimeout(0.0)
+    try:
+        return bool(peek(1))
+    except OSError:
+        # 受信するデータがない（SSLではSSLWantReadError）
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+
+def _sequence_set(msg_ids) -> str:
+    """メールIDのリストを "1:3,5,7:9" 形式のシーケンスセットにまとめる"""
+    ids = sorted({int(msg_id) for msg_id in msg_ids})
+    ranges = []
+    start = prev = None
+    for msg_id in ids:
+        if prev is not None and msg_id == prev + 1:
+            prev = msg_id
+            continue
+        if start is not None:
+            ranges.append(f"{start}:{prev}" if start != prev else str(start))
+        start = prev = msg_id
+    if start is not None:
+        ranges.append(f"{start}:{prev}" if start != prev else str(start))
+    return ",".join(ranges)
+
+
+def _copyuid_source_uids(response, copyuid) -> set[int] | None:
+    """COPYUID応答コードからコピー元のUIDを取り出す（なければNone）"""
+    codes = [data for data in copyuid if data]
+    for data in response:
+        # タグ付き応答では "[COPYUID 38505 304,319:320 3956:3958] Done" の形式
+        if data and data.startswith(b"[COPYUID "):
+            codes.append(data[len(b"[COPYUID "):])
+
+    uids = None
+    for code in codes:
+        match = COPYUID_PATTERN.match(code)
+        if match:
+            uids = (uids or set()) | _expand_sequence_set(
+                match.group(1).decode())
+    return uids
+
+
+def _expand_sequence_set(sequence_set: str) -> set[int]:
+    """シーケンスセットを個々のIDの集合に展開する"""
+    ids = set()
+    for first, last in _sequence_ranges(sequence_set):
+        ids.update(range(first, last + 1))
+    return ids
+
+
+def _sequence_ranges(sequence_set: str) -> list[tuple[int, int]]:
+    """シーケンスセットを(最初, 最後)の組のリストにする"""
+    ranges = []
+    for part in sequence_set.split(","):
+        if ":" in part:
+            first, last = sorted(int(n) for n in part.split(":"))
+            ranges.append((first, last))
+        elif part:
+            ranges.append((int(part), int(part)))
+    return ranges
+
+
+def _to_str(msg_id) -> str:
+    """メールIDを文字列に変換する"""
+    if isinstance(msg_id, (bytes, bytearray)):
+        return msg_id.decode()
+    return str(msg_id)
+
+
+def _parse_fetch_response(msg_data) -> dict[str, bytes]:
+    """UID FETCHのレスポンスからUIDごとのデータを取り出す"""
+    ret = {}
+    uid = None
+    data = None
+    for item in msg_data:
+        # データ本体はタプル、閉じ括弧などはbytesで返ってくる
+        if isinstance(item, tuple):
+            head, data = item
+        else:
+            head = item
+        if not head:
+            continue
+        # UIDはデータの前後どちらに来るかサーバーによって異なる
+        match = FETCH_UID_PATTERN.search(head)
+        if match:
+            uid = match.group(1).decode()
+        if uid is not None and data is not None:
+            ret[uid] = data
+            uid = None
+            data = None
+    return ret
+
+
+class TextPart(NamedTuple):
+    """本文として扱うパートの情報"""
+
+    section: str
+    encoding: str
+    charset: str
+
+
+def _parse_bodystructure(msg_data) -> list | None:
+    """FETCH (BODYSTRUCTURE) のレスポンスを入れ子のリストに変換する"""
+    # リテラルを含む場合はタプルに分割されているので結合する
+    raw = b"".join(
+        b"".join(item) if isinstance(item, tuple) else item
+        for item in msg_data if item
     )
+    start = raw.find(b"BODYSTRUCTURE (")
+    if start < 0:
+        return None
+    value, _ = _parse_imap_value(raw, start + len(b"BODYSTRUCTURE "))
+    return value
+
+
+def _parse_bodystructures(msg_data) -> dict[str, list]:
+    """複数のメールのFETCH (UID BODYSTRUCTURE) のレスポンスをUIDごとに変換する"""
+    ret = {}
+    message = []
+    for item in msg_data:
+        if not item:
+            continue
+        head = item[0] if isinstance(item, tuple) else item
+        # 次のメールのレスポンス（"<番号> (" で始まる）が来たら前のメールを解析する
+        if message and FETCH_START_PATTERN.match(head):
+            _add_bodystructure(ret, message)
+            message = []
+        message.append(item)
+    if message:
+        _add_bodystructure(ret, message)
+    return ret
+
+
+def _add_bodystructure(ret: dict, message: list) -> None:
+    raw = b"".join(
+        b"".join(item) if isinstance(item, tuple) else item for item in message)
+    start = raw.find(b"BODYSTRUCTURE (")
+    if start < 0:
+        return
+    structure, end = _parse_imap_value(raw, start + len(b"BODYSTRUCTURE "))
+    # UIDはBODYSTRUCTUREの前後どちらにも来る（構造の中の文字列は見ない）
+    match = FETCH_UID_PATTERN.search(raw[:start] + raw[end:])
+    if match:
+        ret[match.group(1).decode()] = structure
+
+
+def _parse_imap_value(raw: bytes, pos: int):
+    """IMAPのS式を1つ解析して (値, 次の位置) を返す"""
+    while raw[pos:pos + 1] == b" ":
+        pos += 1
+    char = raw[pos:pos + 1]
+    if char == b"(":
+        values = []
+        pos += 1
+        while True:
+            while raw[pos:pos + 1] == b" ":
+                pos += 1
+            if raw[pos:pos + 1] in (b")", b""):
+                return values, pos + 1
+            value, pos = _parse_imap_value(raw, pos)
+            values.append(value)
+    if char == b'"':
+        end = pos + 1
+        chars = bytearray()
+        while end < len(raw) and raw[end:end + 1] != b'"':
+            if raw[end:end + 1] == b"\\":
+                end += 1
+            chars += raw[end:end + 1]
+            end += 1
+        return chars.decode(errors="replace"), end + 1
+    if char == b"{":
+        # リテラル {n}\r\n に続くnバイト
+        end = raw.index(b"}", pos)
+        size = int(raw[pos + 1:end])
+        start = end + 1
+        if raw[start:start + 2] == b"\r\n":
+            start += 2
+        return raw[start:start + size].decode(errors="replace"), start + size
+    end = pos
+    while end < len(raw) and raw[end:end + 1] not in b" ()":
+        end += 1
+    atom = raw[pos:end].decode(errors="replace")
+    return (None if atom.upper() == "NIL" else atom), end
+
+
+def _find_text_part(structure, section: str = "") -> TextPart | None:
+    """BODYSTRUCTUREから最初のtext/plainパートを探す"""
+    if not isinstance(structure, list) or not structure:
+        return None
+
+    if isinstance(structure[0], list):
+        # マルチパート: 子パートの後にサブタイプが続く
+        for i, child in enumerate(structure):
+            if not isinstance(child, list):
+                break
+            child_section = f"{section}.{i + 1}" if section else str(i + 1)
+            part = _find_text_part(child, child_section)
+            if part is not None:
+                return part
+        return None
+
+    media_type = (structure[0] or "").lower()
+    subtype = (structure[1] or "").lower() if len(structure) > 1 else ""
+    if media_type != "text" or subtype != "plain":
+        return None
+
+    params = structure[2] if len(structure) > 2 and isinstance(
+        structure[2], list) else []
+    params = {
+        str(key).lower(): value for key, value in zip(params[::2], params[1::2])
+    }
+    encoding = structure[5] if len(structure) > 5 and structure[5] else "7bit"
+    # マルチパートでないメールは本文全体がパートになる
+    return TextPart(section or "TEXT", encoding.lower(), params.get("charset") or "utf-8")
@@ -0,0 +1,156 @@
+import base64
+import re
+
+from loguru import logger
+
+# LISTの応答の1行: (属性) 区切り文字 フォルダ名
+LIST_RESPONSE_PATTERN = re.compile(
+    rb'^\((?P<flags>[^)]*)\)\s+(?:NIL|"(?P<delimiter>\\.|[^"\\])")\s+(?P<name>.*)$',
+    re.IGNORECASE,
+)
+# 移動先にできないフォルダの属性
+UNSELECTABLE_FLAGS = {b"\\noselect", b"\\nonexistent"}
+
+
+class FolderRegistry:
+    """接続ごとのフォルダの一覧
+
+    最初に必要になったときに1回だけLISTで取得し、以降はフォルダの有無を
+    この一覧で判定する。作成したフォルダも一覧に加えるので、同じ接続で
+    LISTやCREATEを繰り返さない。
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        # 階層の区切り文字（サーバーが返さない場合はNone）
+        self.delimiter: str | None = None
+        # 存在するフォルダ名（LISTするまではNone）
+        self._names: set[str] | None = None
+        # 作成に失敗したフォルダ（同じ接続では作成し直さない）
+        self._failed: set[str] = set()
+
+    def __contains__(self, folder: str) -> bool:
+        return self._names is not None and _normalize(folder) in self._names
+
+    def load(self) -> bool:
+        """LISTでフォルダの一覧を取得する"""
+        status, data = self.connection.list()
+        if status != "OK":
+            logger.debug(f"フォルダの取得に失敗しました: {data}")
+            return False
+        names = set()
+        for item in data:
+            parsed = parse_list_response(item)
+            if parsed is None:
+                continue
+            flags, delimiter, name = parsed
+            if self.delimiter is None:
+                self.delimiter = delimiter
+            if not flags & UNSELECTABLE_FLAGS:
+                names.add(_normalize(name))
+        self._names = names
+        logger.debug(f"{len(names)}個のフォルダがあります（区切り文字: {self.delimiter!r}）")
+        return True
+
+    def ensure(self, folders) -> None:
+        """foldersのうち存在しないフォルダをまとめて作成する"""
+        if self._names is None and not self.load():
+            return
+        for folder in dict.fromkeys(folders):
+            normalized = _normalize(folder)
+            if normalized in self._names or normalized in self._failed:
+                continue
+            logger.debug(f"フォルダ '{folder}' は存在しません。新規作成します。")
+            status, data = self.connection.create(quote_mailbox_name(folder))
+            if status == "OK":
+                self._names.add(normalized)
+            else:
+                logger.warning(f"フォルダ '{folder}' を作成できませんでした: {data}")
+                self._failed.add(normalized)
+
+
+def parse_list_response(item) -> tuple[set[bytes], str | None, str] | None:
+    """imaplibのLISTの応答1件から(属性, 区切り文字, フォルダ名)を取り出す"""
+    literal = None
+    if isinstance(item, tuple):
+        # フォルダ名がリテラル（{n}）で返された場合
+        item, literal = item
+    if not item:
+        return None
+    match = LIST_RESPONSE_PATTERN.match(item)
+    if not match:
+        return None
+    flags = {flag.lower() for flag in match.group("flags").split()}
+    delimiter = match.group("delimiter")
+    if delimiter is not None:
+        delimiter = delimiter[-1:].decode("ascii")
+    if literal is not None:
+        raw_name = literal
+    else:
+        raw_name = match.group("name").strip()
+        if raw_name.startswith(b'"') and raw_name.endswith(b'"') and len(raw_name) >= 2:
+            raw_name = re.sub(rb"\\(.)", rb"\1", raw_name[1:-1])
+    return flags, delimiter, decode_mailbox_name(raw_name)
+
+
+def encode_mailbox_name(name: str) -> str:
+    """フォルダ名を修正UTF-7（RFC 3501 5.1.3）にエンコードする"""
+    encoded = []
+    pending = []
+
+    def flush_pending():
+        if pending:
+            data = "".join(pending).encode("utf-16-be")
+            encoded.append(
+                "&" + base64.b64encode(data).decode("ascii").rstrip("=").replace("/", ",") + "-")
+            pending.clear()
+
+    for char in name:
+        if "\x20" <= char <= "\x7e":
+            flush_pending()
+            encoded.append("&-" if char == "&" else char)
+        else:
+            pending.append(char)
+    flush_pending()
+    return "".join(encoded)
+
+
+def decode_mailbox_name(raw_name: bytes | str) -> str:
+    """修正UTF-7のフォルダ名をデコードする"""
+    if isinstance(raw_name, bytes):
+        raw_name = raw_name.decode("utf-8", errors="replace")
+    if "&" not in raw_name:
+        return raw_name
+    decoded = []
+    pos = 0
+    while pos < len(raw_name):
+        start = raw_name.find("&", pos)
+        end = raw_name.find("-", start + 1) if start != -1 else -1
+        if start == -1 or end == -1:
+            decoded.append(raw_name[pos:])
+            break
+        decoded.append(raw_name[pos:start])
+        chunk = raw_name[start + 1:end]
+        if not chunk:
+            decoded.append("&")
+        else:
+            chunk = chunk.replace(",", "/")
+            try:
+                data = base64.b64decode(chunk + "=" * (-len(chunk) % 4))
+                decoded.append(data.decode("utf-16-be"))
+            except ValueError:
+                # 不正なエンコードはそのまま残す
+                decoded.append(raw_name[start:end + 1])
+        pos = end + 1
+    return "".join(decoded)
+
+
+def quote_mailbox_name(name: str) -> str:
+    """コマンドの引数に使えるように、エンコードして引用符で囲む"""
+    encoded = encode_mailbox_name(name)
+    return '"' + encoded.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _normalize(name: str) -> str:
+    # INBOXだけは大文字小文字を区別しない
+    return "INBOX" if name.upper() == "INBOX" else name
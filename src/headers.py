@@ -0,0 +1,145 @@
+import functools
+import re
+import unicodedata
+
+# 振り分けに使うヘッダー（小文字）
+HEADER_NAMES = ("subject", "from", "to", "cc", "date", "message-id")
+
+# 折り返された行の継続（改行の直後が空白）
+FOLDING_PATTERN = re.compile(r"\r?\n(?=[ \t])")
+
+
+class EmailDetails:
+    """振り分けに使うメールの情報
+
+    メールごとにdictを作らないように__slots__で持つ。
+    振り分けのコードからはdictと同じくemail_data["subject"]や
+    email_data.get("from")で参照できる。
+    """
+
+    __slots__ = (
+        "id", "subject", "sender", "to", "cc", "date", "message_id",
+        "body", "load_body", "spam_score",
+    )
+
+    # dictとして参照する場合のキーと属性名が異なるもの
+    _ATTRIBUTES = {"from": "sender"}
+
+    def __init__(self, msg_id, subject="", sender="", to="", cc="", date="", message_id=""):
+        self.id = msg_id
+        self.subject = subject
+        self.sender = sender
+        self.to = to
+        self.cc = cc
+        self.date = date
+        self.message_id = message_id
+        # 本文は必要になった場合だけload_bodyで取得する
+        self.body = None
+        self.load_body = None
+        # 統計モデルで判定した迷惑メールらしさ（判定しない場合はNone）
+        self.spam_score = None
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, self._ATTRIBUTES.get(key, key))
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        try:
+            setattr(self, self._ATTRIBUTES.get(key, key), value)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key) -> bool:
+        return getattr(self, self._ATTRIBUTES.get(key, key), None) is not None
+
+    def get(self, key, default=None):
+        value = getattr(self, self._ATTRIBUTES.get(key, key), None)
+        return default if value is None else value
+
+    def __repr__(self) -> str:
+        return f"EmailDetails(id={self.id!r}, subject={self.subject!r}, from={self.sender!r})"
+
+
+def parse_email_details(msg_id, raw_email: bytes) -> EmailDetails:
+    """メールの生データ（ヘッダーのみでもよい）から振り分けに必要な情報を取り出す"""
+    headers = parse_header_block(raw_email)
+    return EmailDetails(
+        msg_id,
+        subject=decode_header_value(headers.get("subject", "")),
+        sender=clean_header_value(headers.get("from", "")),
+        to=clean_header_value(headers.get("to", "")),
+        cc=clean_header_value(headers.get("cc", "")),
+        date=headers.get("date", ""),
+        message_id=headers.get("message-id", ""),
+    )
+
+
+def parse_header_block(raw_email: bytes, names=HEADER_NAMES) -> dict[str, str]:
+    """ヘッダー部分だけを読み、namesのヘッダーの値を返す（同名のものは最初の値）"""
+    end = raw_email.find(b"\n\n")
+    crlf_end = raw_email.find(b"\r\n\r\n")
+    if crlf_end != -1 and (end == -1 or crlf_end < end):
+        end = crlf_end
+    block = raw_email if end == -1 else raw_email[:end]
+
+    if block.isascii():
+        text = block.decode("ascii")
+    else:
+        # 8bitのヘッダーはUTF-8として扱う
+        text = block.decode("utf-8", errors="replace")
+
+    headers = {}
+    for line in FOLDING_PATTERN.sub("", text).split("\n"):
+        name, sep, value = line.partition(":")
+        if not sep:
+            continue
+        name = name.strip().lower()
+        if name in names and name not in headers:
+            headers[name] = value.strip()
+    return headers
+
+
+def decode_header_value(value: str) -> str:
+    """RFC 2047でエンコードされた部分をデコードし、結合文字を除去する"""
+    if value.isascii() and "=?" not in value:
+        # ASCIIのみのヘッダーはデコードも結合文字の除去も不要
+        return value
+    return _decode_header_value(value)
+
+
+@functools.lru_cache(maxsize=8192)
+def _decode_header_value(value: str) -> str:
+    # email.headerは読み込みが重く、ASCIIのみのヘッダーでは使わないので、ここで読み込む
+    from email.header import decode_header
+
+    decoded = []
+    for word, charset in decode_header(value):
+        if isinstance(word, bytes):
+            try:
+                word = word.decode(charset or "utf-8", errors="ignore")
+            except LookupError:
+                word = word.decode("utf-8", errors="ignore")
+        decoded.append(word)
+    return remove_combining_characters("".join(decoded))
+
+
+def clean_header_value(value: str) -> str:
+    """デコードせずに結合文字だけを除去する（送信者・宛先用）"""
+    if value.isascii():
+        return value
+    return _remove_combining_characters_cached(value)
+
+
+@functools.lru_cache(maxsize=8192)
+def _remove_combining_characters_cached(value: str) -> str:
+    return remove_combining_characters(value)
+
+
+def remove_combining_characters(text):
+    """正規化で結合文字を分解し、結合文字でないものだけを返す"""
+    return ''.join(
+        char for char in unicodedata.normalize('NFD', text)
+        if not unicodedata.combining(char)
+    )
@@ -0,0 +1,321 @@
+import json
+import math
+import os
+import threading
+import time
+
+# 処理時間のヒストグラムのバケット（秒）
+DURATION_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0,
+                    10.0, 30.0, 60.0, 300.0, math.inf)
+
+METRIC_PREFIX = "imap_spam_cleaner"
+
+
+class ConnectionStats:
+    """接続で送受信したバイト数と往復回数"""
+
+    __slots__ = ("bytes_in", "bytes_out", "round_trips")
+
+    def __init__(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.round_trips = 0
+
+    def snapshot(self) -> tuple[int, int, int]:
+        return self.bytes_in, self.bytes_out, self.round_trips
+
+    def add(self, other: "ConnectionStats") -> None:
+        self.bytes_in += other.bytes_in
+        self.bytes_out += other.bytes_out
+        self.round_trips += other.round_trips
+
+
+def instrument_connection(connection, stats: ConnectionStats) -> None:
+    """imaplibの接続の送受信をstatsに数えるようにする
+
+    メトリクスが有効な場合だけ呼ぶので、無効な場合の負荷はない。
+    ソケットとその読み込み用のファイルで数えるので、通信を圧縮した
+    場合も実際に送受信したバイト数になる。
+    """
+    command = connection._command
+
+    def counting_command(name, *args):
+        stats.round_trips += 1
+        return command(name, *args)
+
+    connection.sock = _CountingSocket(connection.sock, stats)
+    connection.file = _CountingReader(connection.file, stats)
+    connection._command = counting_command
+
+
+class _CountingSocket:
+    """送受信したバイト数を数えるソケットのラッパー"""
+
+    def __init__(self, sock, stats: ConnectionStats):
+        self._sock = sock
+        self._stats = stats
+
+    def sendall(self, data) -> None:
+        self._stats.bytes_out += len(data)
+        self._sock.sendall(data)
+
+    def recv(self, size: int) -> bytes:
+        data = self._sock.recv(size)
+        self._stats.bytes_in += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+class _CountingReader:
+    """読み込んだバイト数を数えるファイルのラッパー"""
+
+    def __init__(self, file, stats: ConnectionStats):
+        self._file = file
+        self._stats = stats
+
+    def read(self, size: int) -> bytes:
+        data = self._file.read(size)
+        self._stats.bytes_in += len(data)
+        return data
+
+    def readline(self, limit: int = -1) -> bytes:
+        line = self._file.readline(limit)
+        self._stats.bytes_in += len(line)
+        return line
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(DURATION_BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.total += value
+        self.count += 1
+
+
+class Metrics:
+    """1回の実行のカウンターとヒストグラムを集計する"""
+
+    enabled = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self.histograms: dict[tuple[str, tuple], Histogram] = {}
+
+    def bind(self, **labels) -> "BoundMetrics":
+        return BoundMetrics(self, labels)
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def summary(self) -> dict:
+        """アカウント・処理ごとの集計結果を返す"""
+        phases: dict[tuple, dict] = {}
+        with self._lock:
+            for (name, labels), histogram in self.histograms.items():
+                if name != "phase_duration_seconds":
+                    continue
+                entry = phases.setdefault(labels, dict(labels))
+                entry["duration_seconds"] = histogram.total
+                entry["calls"] = histogram.count
+            actions = []
+            for (name, labels), value in self.counters.items():
+                if name == "actions_total":
+                    actions.append({**dict(labels), "count": value})
+                elif "phase" in dict(labels):
+                    entry = phases.setdefault(labels, dict(labels))
+                    entry[name.removesuffix("_total")] = value
+
+        for entry in phases.values():
+            duration = entry.get("duration_seconds", 0.0)
+            messages = entry.get("messages", 0)
+            entry["messages_per_second"] = messages / \
+                duration if duration else 0.0
+        return {
+            "generated_at": time.time(),
+            "phases": sorted(phases.values(), key=lambda e: (e.get("account", ""), e.get("phase", ""))),
+            "actions": actions,
+        }
+
+    def write_json(self, path: str) -> None:
+        _write_atomic(path, json.dumps(
+            self.summary(), ensure_ascii=False, indent=2))
+
+    def write_prometheus(self, path: str) -> None:
+        """node_exporterのtextfile形式で書き出す"""
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self.counters}):
+                metric = f"{METRIC_PREFIX}_{name}"
+                lines.append(f"# TYPE {metric} counter")
+                for (counter_name, labels), value in sorted(self.counters.items()):
+                    if counter_name == name:
+                        lines.append(
+                            f"{metric}{_format_labels(labels)} {value}")
+            for name in sorted({name for name, _ in self.histograms}):
+                metric = f"{METRIC_PREFIX}_{name}"
+                lines.append(f"# TYPE {metric} histogram")
+                for (histogram_name, labels), histogram in sorted(self.histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(DURATION_BUCKETS, histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == math.inf else repr(bound)
+                        lines.append(
+                            f"{metric}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+                    lines.append(
+                        f"{metric}_sum{_format_labels(labels)} {histogram.total}")
+                    lines.append(
+                        f"{metric}_count{_format_labels(labels)} {histogram.count}")
+        _write_atomic(path, "\n".join(lines) + "\n")
+
+
+class BoundMetrics:
+    """ラベル（アカウントなど）を固定したメトリクス"""
+
+    enabled = True
+
+    def __init__(self, metrics: Metrics, labels: dict):
+        self.metrics = metrics
+        self.labels = labels
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        self.metrics.inc(name, value, **self.labels, **labels)
+
+    def phase(self, name: str, stats: ConnectionStats | None = None) -> "Phase":
+        """with文の範囲を1回の処理として記録する"""
+        return Phase(self, name, stats, record_on_exit=True)
+
+    def accumulator(self, name: str, stats: ConnectionStats | None = None) -> "Phase":
+        """with文の範囲を何度も足し合わせ、record()で記録する"""
+        return Phase(self, name, stats, record_on_exit=False)
+
+
+class Phase:
+    """処理時間・メール数・転送量を計測する"""
+
+    def __init__(self, metrics: BoundMetrics, name: str, stats, record_on_exit: bool):
+        self.metrics = metrics
+        self.name = name
+        self.stats = stats
+        self.record_on_exit = record_on_exit
+        self.messages = 0
+        self.duration = 0.0
+        self.traffic = [0, 0, 0]
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        if self.stats is not None:
+            self._start_stats = self.stats.snapshot()
+        return self
+
+    def __exit__(self, *exc):
+        self.duration += time.perf_counter() - self._start
+        if self.stats is not None:
+            for i, (start, end) in enumerate(zip(self._start_stats, self.stats.snapshot())):
+                self.traffic[i] += end - start
+        if self.record_on_exit:
+            self.record()
+        return False
+
+    def record(self) -> None:
+        labels = {**self.metrics.labels, "phase": self.name}
+        metrics = self.metrics.metrics
+        metrics.observe("phase_duration_seconds", self.duration, **labels)
+        metrics.inc("messages_total", self.messages, **labels)
+        if self.stats is not None:
+            bytes_in, bytes_out, round_trips = self.traffic
+            metrics.inc("bytes_received_total", bytes_in, **labels)
+            metrics.inc("bytes_sent_total", bytes_out, **labels)
+            metrics.inc("round_trips_total", round_trips, **labels)
+
+
+class _NullPhase:
+    """何も計測しないPhase"""
+
+    __slots__ = ()
+    messages = 0
+    duration = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+    def record(self) -> None:
+        pass
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class NullMetrics:
+    """メトリクスを集計しない場合の実装（呼び出しの負荷をほぼなくす）"""
+
+    enabled = False
+
+    def bind(self, **labels) -> "NullMetrics":
+        return self
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        pass
+
+    def phase(self, name: str, stats: ConnectionStats | None = None) -> _NullPhase:
+        return _NULL_PHASE
+
+    def accumulator(self, name: str, stats: ConnectionStats | None = None) -> _NullPhase:
+        return _NULL_PHASE
+
+
+NULL_METRICS = NullMetrics()
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(
+        f'{key}="{_escape_label(value)}"' for key, value in labels)
+    return "{" + pairs + "}"
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _write_atomic(path: str, text: str) -> None:
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
@@ -0,0 +1,158 @@
+import contextlib
+import random
+import re
+import threading
+import time
+
+from loguru import logger
+
+# サーバーが混雑・制限を知らせる応答（RFC 5530、RFC 2449/3206など）
+THROTTLE_PATTERN = re.compile(
+    r"\[(?:UNAVAILABLE|LIMIT|INUSE|IN-USE|SYS/TEMP|LOGIN-DELAY|THROTTLED)\]"
+    r"|throttl|too many (?:connections|simultaneous|requests)",
+    re.IGNORECASE,
+)
+# 制限された場合に待つ秒数（制限されるたびに倍にする）
+MIN_BACKOFF_SECONDS = 5.0
+MAX_BACKOFF_SECONDS = 300.0
+# 制限された場合にコマンドの速度を下げる下限（設定した速度に対する割合）
+MIN_RATE_RATIO = 0.125
+
+
+class TokenBucket:
+    """一定の速度でトークンがたまるバケツ（rateが0以下なら制限しない）"""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        """トークンがたまるまで待ってから使う"""
+        while self.rate > 0:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class HostBudget:
+    """1つのサーバーへの同時接続数とコマンドの速度の予算
+
+    サーバーから制限の応答があると、しばらく新しい接続とコマンドを止め、
+    コマンドの速度を半分にする。待つ時間は制限が続くほど長くなり、
+    制限されずに処理できるたびに元の速度に戻していく。
+    """
+
+    def __init__(self, host: str, max_connections: int, commands_per_second: float):
+        self.host = host
+        self.commands_per_second = commands_per_second
+        self.commands = TokenBucket(commands_per_second)
+        self.backoff = 0.0
+        self._connections = threading.BoundedSemaphore(max(1, max_connections))
+        self._resume_at = 0.0
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """接続数の予算を1つ使う（制限中は解除されるまで待つ）"""
+        self.wait()
+        with self._connections:
+            yield self
+
+    def try_acquire_connection(self) -> bool:
+        """接続数の予算が空いていれば1つ使う（待たない。制限中は使わない）
+
+        使った予算はrelease_connectionで返す。
+        """
+        if self._resume_at > time.monotonic():
+            return False
+        return self._connections.acquire(blocking=False)
+
+    def release_connection(self) -> None:
+        """try_acquire_connectionで使った接続数の予算を返す"""
+        self._connections.release()
+
+    def acquire_command(self) -> None:
+        """コマンド1回分の予算を使う"""
+        self.wait()
+        self.commands.acquire()
+
+    def wait(self) -> None:
+        delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def throttled(self, reason: str) -> None:
+        """サーバーに制限されたことを記録して間隔を空ける"""
+        with self._lock:
+            self.backoff = min(
+                max(self.backoff * 2, MIN_BACKOFF_SECONDS), MAX_BACKOFF_SECONDS)
+            # 同時に待っている接続が一斉に再開しないように少しずらす
+            delay = self.backoff * random.uniform(1.0, 1.25)
+            self._resume_at = max(self._resume_at, time.monotonic() + delay)
+            if self.commands_per_second > 0:
+                self.commands.rate = max(
+                    self.commands_per_second * MIN_RATE_RATIO, self.commands.rate / 2)
+        logger.warning(f"{self.host}に制限されました。{delay:.1f}秒待ちます: {reason}")
+
+    def succeeded(self) -> None:
+        """制限されずに処理できたので予算を少しずつ戻す"""
+        with self._lock:
+            self.backoff = self.backoff / 2 if self.backoff > MIN_BACKOFF_SECONDS else 0.0
+            if self.commands_per_second > 0:
+                self.commands.rate = min(
+                    self.commands_per_second, self.commands.rate * 1.25)
+
+
+def is_throttling_response(response) -> bool:
+    """サーバーの応答やエラーが制限によるものか判定する"""
+    if isinstance(response, (list, tuple)):
+        return any(is_throttling_response(item) for item in response)
+    if isinstance(response, (bytes, bytearray)):
+        response = response.decode("utf-8", errors="replace")
+    return bool(THROTTLE_PATTERN.search(str(response)))
+
+
+def limit_commands(connection, budget: HostBudget, on_throttled) -> None:
+    """接続のコマンドごとにbudgetを使い、制限の応答をon_throttledに知らせる"""
+    if not hasattr(connection, "_command"):
+        # POP3はコマンドの送信だけを制限する（制限の応答は例外で分かる）
+        putcmd = connection._putcmd
+
+        def limited_putcmd(line):
+            budget.acquire_command()
+            return putcmd(line)
+
+        connection._putcmd = limited_putcmd
+        return
+
+    command = connection._command
+    command_complete = connection._command_complete
+
+    def limited_command(name, *args):
+        budget.acquire_command()
+        return command(name, *args)
+
+    def checked_command_complete(name, tag):
+        try:
+            typ, data = command_complete(name, tag)
+        except connection.abort as e:
+            # BYEで切断された場合
+            if is_throttling_response(e):
+                on_throttled(str(e))
+            raise
+        if typ == "NO" and is_throttling_response(data):
+            on_throttled(f"{name} {data}")
+        return typ, data
+
+    connection._command = limited_command
+    connection._command_complete = checked_command_complete
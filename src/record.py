@@ -0,0 +1,40 @@
+class Record:
+    """設定や状態の値のまとまり
+
+    サブクラスはFIELDSに{名前: (型, 既定値)}を書き、__slots__をその名前にする
+    （既定値が...のものは必須）。作成時に型を検証しないのでpydanticのモデルより
+    ずっと速く、pydanticも読み込まない。設定ファイルの検証はsrc.configが
+    FIELDSから作ったpydanticのモデルで行う。
+    """
+
+    __slots__ = ()
+    FIELDS: dict[str, tuple] = {}
+
+    def __init__(self, **values):
+        for name, (_, default) in self.FIELDS.items():
+            value = values.pop(name, default)
+            if value is ...:
+                raise TypeError(
+                    f"{type(self).__name__}: missing field {name!r}")
+            if isinstance(value, list):
+                # 既定値のリストを共有しない
+                value = list(value)
+            setattr(self, name, value)
+        if values:
+            raise TypeError(
+                f"{type(self).__name__}: unknown fields {sorted(values)}")
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    def copy(self, **changes):
+        """一部の値を変えた複製を返す"""
+        return type(self)(**{**self.to_dict(), **changes})
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and self.to_dict() == other.to_dict()
+
+    def __repr__(self) -> str:
+        attrs = ", ".join(f"{name}={value!r}" for name,
+                          value in self.to_dict().items())
+        return f"{type(self).__name__}({attrs})"
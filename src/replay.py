@@ -0,0 +1,299 @@
+"""保存してあるメールでのルールの試験（サーバーには接続しない）
+
+filtering_rules.yamlを変えたときに、mboxやMaildirのメールに同じ振り分けの
+ルールを適用して、ルールごとのマッチ数とメールごとの判定を書き出す。
+メールの移動も、同期状態・キャッシュ・送信者の評判の更新も行わない。
+
+mboxはmmapで開いて"From "の行で区切り、ワーカーにはメールの位置だけを渡す
+（メールのデータはプロセス間で受け渡さない）。ヘッダーの部分だけを読み、本文は
+本文の条件を持つルールが候補に残った場合だけデコードする。Maildirはcur/とnew/
+（サブフォルダのものを含む）のファイルを読む。判定はプロセスプールで並列に行う。
+
+    python -m src.replay <setting_dir> <mboxかMaildir>... [--workers 8]
+        [--report report.json] [--decisions decisions.jsonl]
+"""
+import argparse
+import functools
+import json
+import mmap
+import os
+import sys
+import time
+
+from loguru import logger
+
+from src.decoding import decode_message_body
+from src.emails import BODY_FETCH_BYTES
+from src.headers import parse_email_details, remove_combining_characters
+
+# 1つのタスクで判定するメールの数と大きさの上限
+BATCH_MESSAGES = 1000
+BATCH_BYTES = 64 * 1024 * 1024
+# 本文の判定に読む大きさ（本文のパートの前にあるパートのヘッダーや、
+# base64で増える分を見込んで、IMAPで取得する本文の大きさより多めに読む）
+BODY_READ_BYTES = 2 * BODY_FETCH_BYTES
+
+# ワーカーのプロセスごとに読み込んだルール
+_rules = None
+
+
+def mbox_spans(buf) -> list[tuple[int, int]]:
+    """mboxの各メールの(開始, 終了)の位置を返す（"From "の行は含めない）
+
+    bufはmmapでもbytesでもよい。本文中の"From "で始まる行は">From "に
+    エスケープされている前提で、行頭の"From "だけを区切りとして扱う。
+    """
+    if buf[:5] == b"From ":
+        start = 0
+    else:
+        # 先頭の"From "の行より前にあるものはメールとして扱わない
+        start = buf.find(b"\nFrom ") + 1
+        if not start:
+            return []
+    spans = []
+    size = len(buf)
+    while start < size:
+        line_end = buf.find(b"\n", start)
+        if line_end == -1:
+            break
+        end = buf.find(b"\nFrom ", line_end)
+        if end == -1:
+            end = size
+        spans.append((line_end + 1, end))
+        start = end + 1
+    return spans
+
+
+def maildir_files(root: str) -> list[str]:
+    """Maildirのcur/とnew/にあるメールのファイルを返す（tmp/は書き込み中なので除く）"""
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        if os.path.basename(dirpath) in ("cur", "new"):
+            paths.extend(os.path.join(dirpath, name) for name in sorted(filenames)
+                         if not name.startswith("."))
+    return paths
+
+
+def _header_end(buf, start: int, end: int) -> int:
+    """ヘッダーの終わり（空行の直後）の位置を返す"""
+    lf = buf.find(b"\n\n", start, end)
+    crlf = buf.find(b"\r\n\r\n", start, end)
+    if crlf != -1 and (lf == -1 or crlf < lf):
+        return crlf + 4
+    return end if lf == -1 else lf + 2
+
+
+def _load_body(buf, start: int, end: int, header_end: int) -> str:
+    raw_email = buf[start:min(end, header_end + BODY_READ_BYTES)]
+    return remove_combining_characters(decode_message_body(raw_email, BODY_FETCH_BYTES))
+
+
+def _parse(buf, start: int, end: int, msg_id):
+    """buf[start:end]のメールのヘッダーだけをコピーして解析する"""
+    header_end = _header_end(buf, start, end)
+    email_data = parse_email_details(msg_id, buf[start:header_end])
+    email_data["load_body"] = functools.partial(
+        _load_body, buf, start, end, header_end)
+    return email_data
+
+
+def _init_worker(setting_dir: str) -> None:
+    global _rules
+    from src.rules import load_rules
+
+    _rules = load_rules(setting_dir)
+
+
+def _classify(emails: list) -> list[tuple]:
+    """(ID, ルールの位置, 送信者, 件名, 日付, Message-ID, スコア)のリストを返す"""
+    rules = _rules
+    if rules.spam_model is not None:
+        rules.spam_model.score_batch(emails)
+    return [
+        (email_data.id, rules.match_index(email_data), email_data.sender,
+         email_data.subject, email_data.date, email_data.message_id, email_data.spam_score)
+        for email_data in emails
+    ]
+
+
+def _classify_task(task: tuple) -> list[tuple]:
+    """ワーカーで1つのタスクのメールを判定する"""
+    kind, path, items = task
+    if kind == "mbox":
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            # 本文はmatch_indexの中で読むので、閉じる前に判定まで済ませる
+            return _classify([_parse(buf, start, end, start) for start, end in items])
+
+    emails = []
+    for file_path in items:
+        with open(file_path, "rb") as f:
+            raw_email = f.read()
+        emails.append(_parse(raw_email, 0, len(raw_email),
+                      os.path.relpath(file_path, path)))
+    return _classify(emails)
+
+
+def _batches(spans: list[tuple[int, int]]):
+    batch = []
+    size = 0
+    for span in spans:
+        batch.append(span)
+        size += span[1] - span[0]
+        if len(batch) >= BATCH_MESSAGES or size >= BATCH_BYTES:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+
+def plan_tasks(sources: list[str]) -> tuple[list[tuple], int]:
+    """ワーカーに渡すタスクと、対象のメールの合計の大きさを返す"""
+    tasks = []
+    total_bytes = 0
+    for source in sources:
+        if os.path.isdir(source):
+            paths = maildir_files(source)
+            total_bytes += sum(os.path.getsize(path) for path in paths)
+            tasks.extend(
+                ("maildir", source, paths[i:i + BATCH_MESSAGES])
+                for i in range(0, len(paths), BATCH_MESSAGES)
+            )
+            count = len(paths)
+        elif os.path.getsize(source) == 0:
+            count = 0
+        else:
+            with open(source, "rb") as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                spans = mbox_spans(buf)
+                total_bytes += len(buf)
+            tasks.extend(("mbox", source, batch) for batch in _batches(spans))
+            count = len(spans)
+        if not count:
+            logger.warning(f"{source}: メールが見つかりませんでした")
+        logger.info(f"{source}: {count}通")
+    return tasks, total_bytes
+
+
+def _run_tasks(setting_dir: str, tasks: list[tuple], workers: int):
+    """タスクを順に判定した結果を(タスク, 結果)として、タスクの順に返す"""
+    if workers <= 1:
+        _init_worker(setting_dir)
+        for task in tasks:
+            yield task, _classify_task(task)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(
+        workers, initializer=_init_worker, initargs=(setting_dir,)
+    ) as executor:
+        yield from zip(tasks, executor.map(_classify_task, tasks))
+
+
+def replay(
+    setting_dir: str, sources: list[str], workers: int = 1, decisions_file=None
+) -> dict:
+    """sourcesのメールにアカウントのルールを適用して、結果の集計を返す
+
+    decisions_fileを指定すると、メールごとの判定をJSON Linesで書き出す。
+    """
+    import src.config
+    from src.rules import SPAM_FOLDER, load_rules
+
+    rules = load_rules(setting_dir)
+    # ワーカーが設定のYAMLを読み直さないように、検証した設定を保存しておく
+    src.config.save_snapshot()
+
+    started = time.perf_counter()
+    tasks, total_bytes = plan_tasks(sources)
+    hits = [0] * len(rules)
+    unmatched = 0
+    messages = 0
+    for (_, source, _), results in _run_tasks(setting_dir, tasks, workers):
+        for msg_id, rule_index, sender, subject, date, message_id, spam_score in results:
+            messages += 1
+            if rule_index is None:
+                unmatched += 1
+                action = folder = None
+            else:
+                hits[rule_index] += 1
+                rule = rules[rule_index]
+                action = rule.action
+                folder = {"deny": SPAM_FOLDER,
+                          "move": rule.move_to}.get(action)
+            if decisions_file is not None:
+                decisions_file.write(json.dumps({
+                    "source": source,
+                    "id": msg_id,
+                    "message_id": message_id,
+                    "date": date,
+                    "rule_index": rule_index,
+                    "action": action,
+                    "folder": folder,
+                    "from": sender,
+                    "subject": subject,
+                    "spam_score": spam_score,
+                }, ensure_ascii=False) + "\n")
+    elapsed = time.perf_counter() - started
+
+    return {
+        "setting_dir": setting_dir,
+        "sources": sources,
+        "messages": messages,
+        "bytes": total_bytes,
+        "elapsed_seconds": round(elapsed, 3),
+        "workers": workers,
+        "unmatched": unmatched,
+        "rules": [
+            {"index": index, "rule": str(
+                rule), "action": rule.action, "hits": hits[index]}
+            for index, rule in enumerate(rules)
+        ],
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="保存してあるメールにルールを適用して結果を集計する")
+    parser.add_argument("setting_dir", help="settings/以下のアカウントのディレクトリ名")
+    parser.add_argument("sources", nargs="+", help="mboxのファイルかMaildirのディレクトリ")
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1, help="判定に使うプロセスの数")
+    parser.add_argument("--report", help="集計をJSONで書き出すファイル")
+    parser.add_argument("--decisions", help="メールごとの判定をJSON Linesで書き出すファイル")
+    args = parser.parse_args(argv)
+
+    for source in args.sources:
+        if not os.path.exists(source):
+            logger.error(f"{source}: 見つかりません")
+            return 1
+
+    decisions_file = None
+    try:
+        if args.decisions:
+            decisions_file = open(args.decisions, "w", encoding="utf-8")
+        report = replay(args.setting_dir, args.sources,
+                        max(args.workers, 1), decisions_file)
+    finally:
+        if decisions_file is not None:
+            decisions_file.close()
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    elapsed = report["elapsed_seconds"]
+    logger.info(
+        f"{report['messages']}通（{report['bytes'] / 1e6:.1f}MB）を{elapsed:.1f}秒で判定しました"
+        f"（{report['messages'] / max(elapsed, 1e-9):.0f}通/秒）"
+    )
+    print(f"{'#':>4}{'hits':>10}  rule")
+    for entry in report["rules"]:
+        print(f"{entry['index']:>4}{entry['hits']:>10}  {entry['rule']}")
+    print(f"{'-':>4}{report['unmatched']:>10}  （マッチなし）")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,301 @@
+"""送信者の評判の記録
+
+振り分けの結果を、送信者のアドレスと登録可能なドメインごとに数えておく。
+同じ結果が続いているアドレスのメールは、辞書を1回引いて許可（何もしない）か
+拒否（Spamフォルダへ移動）かを判定する。この判定で省くのは判定と同じ結果に
+なるルールだけで、違う結果になるルールは評価し、マッチすればルールの判定を使う。
+ドメインの記録は確認のためのもので、判定には使わない。
+判定の重みは時間とともに減衰し、古くなった記録や上限を超えた分は削除する。
+ルールが変わると以前の結果は当てにならないので、記録を消して数え直す。
+
+email_account.yamlで reputation_threshold を指定したアカウントだけが
+この判定を使う（記録はどのアカウントでも行う）。記録の確認と削除は
+
+    python -m src.reputation <setting_dir> [--limit 20] [--sender <アドレスかドメイン>]
+    python -m src.reputation <setting_dir> --prune [--forget <アドレスかドメイン>]
+
+で行う。
+"""
+import argparse
+import functools
+import os
+import re
+import sqlite3
+import sys
+import time
+
+from loguru import logger
+
+# 判定の重みが半分になるまでの時間（秒）
+HALF_LIFE_SECONDS = 30 * 24 * 60 * 60
+# 判定に使うのに必要な重み（これより少ない送信者はルールで判定する）
+MIN_WEIGHT = 5.0
+# 重みがこれより小さくなった記録は削除する
+MIN_KEEP_WEIGHT = 0.05
+# 保持する送信者の数の上限（重みの小さいものから削除する）
+MAX_ENTRIES = 100_000
+# 3つのラベルで登録可能なドメインになる第2レベルのラベル（.co.jp、.ac.ukなど）
+# Public Suffix Listは使わず、国別のドメインでよく使われるものだけを扱う
+SECOND_LEVEL_LABELS = frozenset(
+    ["ac", "ad", "co", "com", "ed", "edu", "go", "gov", "gr", "lg", "ne", "net", "or", "org"])
+
+ADDRESS_PATTERN = re.compile(
+    r"([^<>()\s\"',;:@]+)@([A-Za-z0-9.-]+\.[A-Za-z]{2,})")
+
+
+@functools.lru_cache(maxsize=8192)
+def sender_keys(sender: str) -> tuple[str, ...]:
+    """Fromヘッダーから記録のキー（アドレスと "@登録可能なドメイン"）を返す"""
+    # 表示名にアドレスが書かれていることがあるので、<>の中を優先する
+    _, bracket, inner = sender.rpartition("<")
+    match = ADDRESS_PATTERN.search(inner if bracket else sender)
+    if not match:
+        return ()
+    # サブアドレス（user+tag@）は同じ送信者として扱う
+    local = match.group(1).lower().split("+", 1)[0]
+    domain = match.group(2).lower().rstrip(".")
+    return (f"{local}@{domain}", "@" + registrable_domain(domain))
+
+
+def registrable_domain(domain: str) -> str:
+    """サブドメインを除いたドメイン（mail.example.co.jp → example.co.jp）"""
+    labels = domain.split(".")
+    if len(labels) >= 3 and len(labels[-1]) == 2 and labels[-2] in SECOND_LEVEL_LABELS:
+        return ".".join(labels[-3:])
+    return ".".join(labels[-2:])
+
+
+def _decay(age: float, half_life: float = HALF_LIFE_SECONDS) -> float:
+    return 0.5 ** (max(age, 0.0) / half_life)
+
+
+class SenderReputation:
+    """送信者ごとの振り分け結果（拒否・許可・移動）の重み
+
+    判定はthreshold以上の割合で同じ結果になっている送信者のアドレスだけに返す。
+    登録可能なドメインの記録は確認のためのもので、判定には使わない。
+    記録はrecordでためておき、commitでまとめて書き込む。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        fingerprint: str | None = None,
+        threshold: float | None = None,
+        half_life: float = HALF_LIFE_SECONDS,
+        max_entries: int = MAX_ENTRIES,
+    ):
+        self.threshold = threshold
+        self.half_life = half_life
+        self.max_entries = max_entries
+        self._connection = sqlite3.connect(path)
+        self._connection.create_function(
+            "decay", 1, lambda age: _decay(age, half_life), deterministic=True)
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS senders (
+                sender TEXT PRIMARY KEY,
+                denied REAL NOT NULL,
+                kept REAL NOT NULL,
+                moved REAL NOT NULL,
+                updated_at REAL NOT NULL
+            ) WITHOUT ROWID
+            """
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        if fingerprint is not None:
+            self._check_fingerprint(fingerprint)
+        # 送信者ごとの未保存の[拒否, 許可, 移動]の件数
+        self._pending: dict[str, list[float]] = {}
+        self._verdicts = self._load_verdicts() if threshold is not None else {}
+
+    def _check_fingerprint(self, fingerprint: str) -> None:
+        row = self._connection.execute(
+            "SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+        if row and row[0] == fingerprint:
+            return
+        if row:
+            logger.debug("ルールが変わったので送信者の評判を数え直します。")
+        self._connection.execute("DELETE FROM senders")
+        self._connection.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (fingerprint,))
+        self._connection.commit()
+
+    def _load_verdicts(self) -> dict[str, str]:
+        """判定に使える送信者を読み込む（1通ごとにSQLiteを引かないように）"""
+        verdicts = {}
+        for sender, denied, kept, moved, weight in self.entries():
+            if sender.startswith("@"):
+                continue
+            verdict = self.verdict_for(denied, kept, moved, weight)
+            if verdict:
+                verdicts[sender] = verdict
+        return verdicts
+
+    def verdict_for(self, denied: float, kept: float, moved: float, weight: float) -> str | None:
+        """減衰させた重みから判定を決める（判定できない場合はNone）"""
+        if self.threshold is None or weight < MIN_WEIGHT:
+            return None
+        total = denied + kept + moved
+        # 閾値が0.5以下でも、過半数でない結果は返さない
+        if denied >= total * self.threshold and denied * 2 > total:
+            return "deny"
+        if kept >= total * self.threshold and kept * 2 > total:
+            return "allow"
+        return None
+
+    def verdict(self, email_data: dict) -> str | None:
+        """"deny"か"allow"を返す（ルールで判定すべき場合はNone）
+
+        同じドメインでも送信者ごとに結果は違う（gmail.comなど）ので、
+        判定にはアドレスの記録だけを使う。
+        """
+        if not self._verdicts:
+            return None
+        keys = sender_keys(email_data.get("from") or "")
+        return self._verdicts.get(keys[0]) if keys else None
+
+    def record(self, email_data: dict, action: str | None) -> None:
+        """ルールで判定した結果を記録する（actionはdeny、move、allow、None）"""
+        column = {"deny": 0, "move": 2}.get(action, 1)
+        for key in sender_keys(email_data.get("from") or ""):
+            counts = self._pending.setdefault(key, [0.0, 0.0, 0.0])
+            counts[column] += 1
+
+    def commit(self) -> None:
+        """ためておいた結果を減衰させた重みに加えて保存する"""
+        now = time.time()
+        self._connection.executemany(
+            """
+            INSERT INTO senders VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (sender) DO UPDATE SET
+                denied = denied * decay(excluded.updated_at - updated_at) + excluded.denied,
+                kept = kept * decay(excluded.updated_at - updated_at) + excluded.kept,
+                moved = moved * decay(excluded.updated_at - updated_at) + excluded.moved,
+                updated_at = excluded.updated_at
+            """,
+            ((sender, *counts, now)
+             for sender, counts in self._pending.items()),
+        )
+        self._connection.commit()
+        self._pending.clear()
+
+    def entries(self, limit: int | None = None, sender: str | None = None):
+        """(送信者, 拒否, 許可, 移動, 重み)を現在まで減衰させて重い順に返す"""
+        query = (
+            "SELECT sender, denied * f, kept * f, moved * f, (denied + kept + moved) * f"
+            " FROM (SELECT *, decay(? - updated_at) AS f FROM senders"
+        )
+        params: list = [time.time()]
+        if sender is not None:
+            query += " WHERE sender = ?"
+            params.append(sender)
+        query += ") ORDER BY 5 DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        return self._connection.execute(query, params).fetchall()
+
+    def forget(self, sender: str) -> int:
+        """送信者の記録を削除して、削除した数を返す"""
+        cursor = self._connection.execute(
+            "DELETE FROM senders WHERE sender = ?", (sender,))
+        self._connection.commit()
+        return cursor.rowcount
+
+    def prune(self) -> int:
+        """減衰して重みがなくなった記録と、上限を超えた分を削除する"""
+        connection = self._connection
+        now = time.time()
+        removed = connection.execute(
+            "DELETE FROM senders WHERE (denied + kept + moved) * decay(? - updated_at) < ?",
+            (now, MIN_KEEP_WEIGHT),
+        ).rowcount
+        count, = connection.execute("SELECT COUNT(*) FROM senders").fetchone()
+        if count > self.max_entries:
+            removed += connection.execute(
+                """
+                DELETE FROM senders WHERE sender IN (
+                    SELECT sender FROM senders
+                    ORDER BY (denied + kept + moved) * decay(? - updated_at) LIMIT ?
+                )
+                """,
+                (now, count - self.max_entries),
+            ).rowcount
+        return removed
+
+    def close(self, prune: bool = True) -> None:
+        """ためておいた結果を保存し、古い記録を削除して閉じる"""
+        try:
+            self.commit()
+            if prune:
+                self.prune()
+                self._connection.commit()
+        finally:
+            self._connection.close()
+
+
+def get_reputation_path(setting_dir: str) -> str:
+    return f"state/{setting_dir}/sender_reputation.sqlite3"
+
+
+def open_sender_reputation(
+    setting_dir: str, fingerprint: str | None = None, threshold: float | None = None
+) -> SenderReputation | None:
+    """アカウントの送信者の評判を開く（開けない場合はNone）"""
+    path = get_reputation_path(setting_dir)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return SenderReputation(path, fingerprint, threshold)
+    except sqlite3.Error as e:
+        logger.warning(f"送信者の評判を開けませんでした: {e}")
+        return None
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="送信者の評判を確認・削除する")
+    parser.add_argument("setting_dir", help="settings/以下のアカウントのディレクトリ名")
+    parser.add_argument("--limit", type=int, default=20, help="表示する送信者の数")
+    parser.add_argument("--sender", help="このアドレスか@ドメインの記録だけを表示する")
+    parser.add_argument(
+        "--threshold", type=float, default=0.95, help="判定を表示する信頼度")
+    parser.add_argument("--prune", action="store_true",
+                        help="古い記録と上限を超えた分を削除する")
+    parser.add_argument("--forget", action="append",
+                        default=[], help="この送信者の記録を削除する")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(get_reputation_path(args.setting_dir)):
+        logger.error(f"{args.setting_dir}: 送信者の評判の記録がありません")
+        return 1
+    reputation = open_sender_reputation(
+        args.setting_dir, threshold=args.threshold)
+    if reputation is None:
+        return 1
+    try:
+        if args.forget or args.prune:
+            for sender in args.forget:
+                removed = reputation.forget(sender.lower())
+                logger.info(f"{sender}: {removed}件削除しました。")
+            if args.prune:
+                logger.info(f"{reputation.prune()}件削除しました。")
+            return 0
+
+        print(f"{'sender':<40}{'deny':>9}{'allow':>9}{'move':>9}{'weight':>9}  verdict")
+        for sender, denied, kept, moved, weight in reputation.entries(
+                args.limit, args.sender and args.sender.lower()):
+            verdict = None
+            if not sender.startswith("@"):
+                verdict = reputation.verdict_for(denied, kept, moved, weight)
+            verdict = verdict or "-"
+            print(
+                f"{sender:<40}{denied:>9.1f}{kept:>9.1f}{moved:>9.1f}{weight:>9.1f}  {verdict}")
+        return 0
+    finally:
+        # 表示するだけの場合は記録を変えない
+        reputation.close(prune=False)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
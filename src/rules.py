@@ -1,55 +1,77 @@
-import os
+import functools
+import hashlib
+import json
 import re
+from collections import deque
 from typing import Literal
 
-import pydantic
-import yaml
-
-
-class Rule(pydantic.BaseModel):
+import src.config
+from src.record import Record
+
+# <hoge@fuga.com>の括弧の中
+SENDER_PATTERN = re.compile(r"<([^>]+)>")
+# =? .... ?= の部分
+MIME_WORD_PATTERN = re.compile(r"(=\?[^?]+\?[BbQq]\?[^?]+\?=)")
+# IMAPのSEARCHに引用符付き文字列として渡せる文字（制御文字を除くASCII）
+SEARCHABLE_PATTERN = re.compile(r"^[\x20-\x7e]+$")
+# str.lower()でASCIIの文字になる非ASCII文字がある文字（KELVIN SIGN→k、İ→i̇）
+# サーバーのASCIIの大文字小文字の同一視ではマッチしないので検索語から除く
+UNSAFE_FOLD_PATTERN = re.compile(r"[ik]")
+# これより短い検索語は絞り込みの効果が薄いので使わない
+MIN_SEARCH_FRAGMENT = 3
+# denyのルールにマッチしたメールの移動先
+SPAM_FOLDER = "Spam"
+
+
+class Rule(Record):
     """Email filtering rule."""
 
-    action: Literal["allow", "deny", "move"]
-    move_to: str | None = None
-    sender_top_level_domain: str | None = None
-    sender_name: list[str] | str | None = None
-    body_contains: str | None = None
-    subject_contains: list[str] | str | None = None
-    to_contains: list[str] | str | None = None
-    cc_contains: list[str] | str | None = None
+    FIELDS = {
+        "action": (Literal["allow", "deny", "move"], ...),
+        "move_to": (str | None, None),
+        "sender_top_level_domain": (str | None, None),
+        "sender_name": (list[str] | str | None, None),
+        "body_contains": (str | None, None),
+        "subject_contains": (list[str] | str | None, None),
+        "to_contains": (list[str] | str | None, None),
+        "cc_contains": (list[str] | str | None, None),
+        # 学習したモデルによる迷惑メールらしさ（0〜1）がこの値を超える
+        "spam_score_above": (float | None, None),
+    }
+    __slots__ = tuple(FIELDS)
 
     def validate(self) -> None:
         """Validate the rule."""
         if self.action == "move" and not self.move_to:
             raise ValueError("move_to must be specified when action is 'move'")
+        if self.spam_score_above is not None and not 0 <= self.spam_score_above <= 1:
+            raise ValueError("spam_score_above must be between 0 and 1")
 
     def __str__(self) -> str:
         """String representation of the rule."""
-        attrs = self.model_dump(exclude_none=True)
+        attrs = {k: v for k, v in self.to_dict().items() if v is not None}
         class_name = self.__class__.__name__
         attrs_str = ", ".join(f"{k}={v}" for k, v in attrs.items())
         return f"{class_name}({attrs_str})"
 
 
-def load_rules(setting_dir: str) -> list[Rule]:
-    """Load rules from a YAML file."""
-    path_template = "settings/{setting_dir}/filtering_rules.yaml"
-    path = path_template.format(setting_dir=setting_dir)
-    # settings/{setting_dir}/filtering_rules.yamlが存在するか確認
-    if not os.path.exists(path):
-        # デフォルトの設定を使用
-        path = path_template.format(setting_dir="default")
-        if not os.path.exists(path):
-            raise FileNotFoundError(f"Settings file not found: {path}")
+def load_rules(setting_dir: str, load_model: bool = True) -> "CompiledRuleSet":
+    """Load the account's rules.
 
-    # settings/{setting_dir}/filtering_rules.yamlを読み込む
-    with open(path, "r") as f:
-        rules = yaml.safe_load(f)
+    The rules come from the validated config snapshot, so the YAML file is
+    only parsed and validated again after it changes (see ``src.config``).
+    If any rule uses ``spam_score_above``, the account's trained spam model
+    is loaded too unless ``load_model`` is False.
+    """
+    rules = [Rule(**rule)
+             for rule in src.config.get_account_config(setting_dir)["rules"]]
 
-    # ルールを検証
-    for rule in rules:
-        Rule(**rule).validate()
-    return [Rule(**rule) for rule in rules]
+    spam_model = None
+    if load_model and any(rule.spam_score_above is not None for rule in rules):
+        # NumPyは統計的な判定を使う場合だけ必要なので、ここで読み込む
+        from src.scoring import load_spam_model
+        spam_model = load_spam_model(setting_dir)
+    return CompiledRuleSet(rules, spam_model)
 
 
 def match_rule(rule: Rule, email_data: dict) -> bool:
@@ -80,13 +102,30 @@ def match_rule(rule: Rule, email_data: dict) -> bool:
         if not contains_all_words(cc, rule.cc_contains):
             return False
 
+    if rule.spam_score_above is not None:
+        # モデルがない場合は判定できないのでマッチしない
+        score = email_data.get("spam_score")
+        if score is None or score <= rule.spam_score_above:
+            return False
+
+    # 本文は他の条件をすべて満たした場合だけ取得する
     if rule.body_contains:
-        # 未実装
-        return False
+        body = get_email_body(email_data)
+        if not contains_all_words(body, rule.body_contains):
+            return False
 
     return True
 
 
+def get_email_body(email_data: dict) -> str:
+    """Return the email body, loading and caching it on first use."""
+    if "body" not in email_data:
+        load_body = email_data.get("load_body")
+        # 同じメールに複数の本文ルールがあっても取得は1回だけ
+        email_data["body"] = load_body() if load_body else ""
+    return email_data["body"]
+
+
 def contains_all_words(base_str: str, words: list[str] | str):
     """The string contains all words."""
     if isinstance(words, str):
@@ -117,12 +156,11 @@ def decode_mime_words(s: str) -> str:
     return decoded_string
 
 
+@functools.lru_cache(maxsize=8192)
 def export_sender(email: str) -> str:
     """Export sender from email address."""
     # <hoge@fuga.com>の括弧の中を正規表現でマッチさせる
-    pattern = re.compile(r"<([^>]+)>")
-    # マッチした部分を取得
-    match = pattern.search(email)
+    match = SENDER_PATTERN.search(email)
     if match:
         # マッチした部分を返す
         return match.group(1).strip()
@@ -130,12 +168,12 @@ def export_sender(email: str) -> str:
     return email
 
 
+# 同じ送信者からのメールが多いので、デコード結果を使い回す
+@functools.lru_cache(maxsize=8192)
 def export_sender_name(sender: str) -> str:
     """Export sender name from email address."""
-    # =? .... ?= の部分をマッチさせる
-    pattern = re.compile(r"(=\?[^?]+\?[BbQq]\?[^?]+\?=)")
-    # すべてのマッチを取得
-    matches = pattern.findall(sender)
+    # すべての =? .... ?= の部分を取得
+    matches = MIME_WORD_PATTERN.findall(sender)
     # デコードされた文字列を格納するリスト
     decoded_strings = []
     # マッチした部分をデコード
@@ -149,3 +187,357 @@ def export_sender_name(sender: str) -> str:
         decoded_sender = sender.split(" <")[0].strip()
 
     return decoded_sender
+
+
+class CompiledRuleSet:
+    """Ordered rules indexed for fast first-match lookup.
+
+    Behaves like the list of rules it was built from, and ``match`` returns
+    the same rule as running ``match_rule`` over the list in order.
+    """
+
+    def __init__(self, rules: list[Rule], spam_model=None):
+        self.rules = list(rules)
+        # spam_score_aboveの判定に使うモデル（src.scoring.SpamModel）
+        self.spam_model = spam_model
+        self._all_mask = (1 << len(self.rules)) - 1
+
+        self._domain_index = _SuffixIndex(
+            [rule.sender_top_level_domain for rule in self.rules]
+        )
+        self._contains_indexes = [
+            (_ContainsIndex([getattr(rule, attr)
+             for rule in self.rules]), getter)
+            for attr, getter in (
+                ("sender_name", lambda d: export_sender_name(d["from"])),
+                ("subject_contains", lambda d: d.get("subject", "")),
+                ("to_contains", lambda d: d.get("to", "")),
+                ("cc_contains", lambda d: d.get("cc", "")),
+            )
+        ]
+        self._body_index = _ContainsIndex(
+            [rule.body_contains for rule in self.rules])
+        # 本文の条件を持つルールがあるか（なければ本文を先読みしない）
+        self.has_body_rules = bool(
+            self._all_mask & ~self._body_index.free_mask)
+        self._score_thresholds = [
+            (1 << i, rule.spam_score_above)
+            for i, rule in enumerate(self.rules)
+            if rule.spam_score_above is not None
+        ]
+        self._score_free_mask = self._all_mask
+        for bit, _ in self._score_thresholds:
+            self._score_free_mask &= ~bit
+        self.search_plan = SearchPlan(self.rules)
+        # actionごとのルールのビットマスク
+        self.action_masks = {"allow": 0, "deny": 0, "move": 0}
+        for i, rule in enumerate(self.rules):
+            self.action_masks[rule.action] |= 1 << i
+        # 移動先のフォルダ（振り分けの前にまとめて作成する）
+        self.destination_folders = list(dict.fromkeys(
+            SPAM_FOLDER if rule.action == "deny" else rule.move_to
+            for rule in self.rules
+            if rule.action != "allow"
+        ))
+        # ルールの内容と順序のハッシュ（ルールが変わったことの検出に使う）
+        self.fingerprint = hashlib.sha256(
+            json.dumps([rule.to_dict() for rule in self.rules],
+                       ensure_ascii=False, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        if spam_model is not None:
+            # モデルを学習し直した場合も以前の判定は使わない
+            self.fingerprint += ":" + spam_model.digest
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def __getitem__(self, index):
+        return self.rules[index]
+
+    def match(self, email_data: dict) -> Rule | None:
+        """Return the first rule that matches the email, if any."""
+        index = self.match_index(email_data)
+        if index is None:
+            return None
+        return self.rules[index]
+
+    def match_index(self, email_data: dict, candidates: int | None = None) -> int | None:
+        """Return the position of the first rule that matches the email.
+
+        ``candidates`` is a bitmask that limits the rules to evaluate.
+        """
+        candidates = self._header_candidates(email_data, candidates)
+        if not candidates:
+            return None
+
+        # 最初の候補が本文の条件を持つ場合だけ本文を取得して絞り込む
+        body_index = self._body_index
+        if candidates & -candidates & ~body_index.free_mask:
+            candidates &= body_index.match_mask(get_email_body(email_data))
+            if not candidates:
+                return None
+
+        # 最初にマッチしたルールの位置を返す
+        return (candidates & -candidates).bit_length() - 1
+
+    def needs_body(self, email_data: dict) -> bool:
+        """Return whether ``match_index`` would load the email body."""
+        candidates = self._header_candidates(email_data)
+        return bool(candidates & -candidates & ~self._body_index.free_mask)
+
+    def _header_candidates(self, email_data: dict, candidates: int | None = None) -> int:
+        """本文以外の条件にマッチするルールのビットマスクを返す"""
+        if candidates is None:
+            candidates = self._all_mask
+
+        domain_index = self._domain_index
+        if candidates & ~domain_index.free_mask:
+            sender = export_sender(email_data["from"])
+            candidates &= domain_index.match_mask(sender)
+
+        for index, getter in self._contains_indexes:
+            # 残りの候補がこの項目を条件に持たなければ評価しない
+            if not candidates & ~index.free_mask:
+                continue
+            candidates &= index.match_mask(getter(email_data))
+
+        if candidates & ~self._score_free_mask:
+            score = email_data.get("spam_score")
+            mask = self._score_free_mask
+            if score is not None:
+                for bit, threshold in self._score_thresholds:
+                    if score > threshold:
+                        mask |= bit
+            candidates &= mask
+        return candidates
+
+
+class SearchPlan:
+    """IMAP SEARCH criteria that narrow down the messages worth fetching.
+
+    Each rule that can move or delete mail becomes a conjunction of SUBJECT,
+    TO, CC and FROM keys, and the rules are OR-ed together. The keys are
+    chosen so that the server result is a superset of the messages the rule
+    matches locally (RFC 3501 SEARCH is a case-insensitive substring match on
+    the decoded header), so matches are still confirmed with ``match`` and a
+    message the server does not return cannot match any such rule.
+
+    Only plain ASCII words are pushed down: non-ASCII words depend on the
+    server's charset and case-folding support. ``criteria`` is None when some
+    rule has nothing that can be pushed down (e.g. only ``sender_name`` or
+    ``body_contains``), in which case every message has to be fetched.
+
+    Locally, headers are MIME-decoded and combining marks are stripped
+    ("Fre\u0301e" and "Frée" match "free"), and the server does neither the
+    same way. So a message the server does not return is only known not to
+    match when the searched ``fields`` are plain ASCII text (``is_exact``);
+    otherwise it has to be matched locally.
+    """
+
+    def __init__(self, rules: list[Rule]):
+        conjunctions = []
+        fields = set()
+        for rule in rules:
+            if rule.action == "allow":
+                # allowだけにマッチするメールは何もしないので取得不要
+                continue
+            keys = _rule_search_keys(rule)
+            if not keys:
+                conjunctions = None
+                break
+            conjunctions.append(" ".join(keys))
+            fields.update(key.split(" ", 1)[0] for key in keys)
+        self.criteria = f"({_or_criteria(conjunctions)})" if conjunctions else None
+        # 検索に使うヘッダー（検索でマッチしなかったメールの確認に使う）
+        self.fields = sorted(fields) if conjunctions else []
+
+    def is_exact(self, raw_header: bytes) -> bool:
+        """Return whether the server's SEARCH sees the searched fields of
+        ``raw_header`` as ``match_rule`` does.
+
+        Non-ASCII text, MIME encoded-words and folded lines may differ after
+        local decoding and normalization.
+        """
+        searched = False
+        for line in raw_header.split(b"\n"):
+            if line[:1] in (b" ", b"\t"):
+                # 折り返された行
+                if searched:
+                    return False
+                continue
+            name, colon, value = line.partition(b":")
+            searched = bool(colon) and name.strip().upper().decode(
+                "ascii", errors="replace") in self.fields
+            if searched and (not value.isascii() or b"=?" in value):
+                return False
+        return True
+
+
+def _rule_search_keys(rule: Rule) -> list[str]:
+    """ルールにマッチするメールが必ず満たすSEARCHのキーを返す"""
+    keys = []
+    domain = rule.sender_top_level_domain
+    if domain and SEARCHABLE_PATTERN.match(domain):
+        # ドメインは大文字小文字を区別して比較するので、そのまま検索できる
+        keys.append(f"FROM {_quote_search_string(domain)}")
+    for key, words in (
+        ("SUBJECT", rule.subject_contains),
+        ("TO", rule.to_contains),
+        ("CC", rule.cc_contains),
+    ):
+        if not words:
+            continue
+        if isinstance(words, str):
+            words = [words]
+        for word in words:
+            fragment = _search_fragment(word)
+            if fragment:
+                keys.append(f"{key} {_quote_search_string(fragment)}")
+    return list(dict.fromkeys(keys))
+
+
+def _search_fragment(word: str) -> str | None:
+    """wordを含む文字列がサーバーの検索でも必ず含むASCIIの部分文字列を返す"""
+    if not SEARCHABLE_PATTERN.match(word):
+        return None
+    fragment = max(UNSAFE_FOLD_PATTERN.split(word.lower()), key=len)
+    if len(fragment.strip()) < MIN_SEARCH_FRAGMENT:
+        return None
+    return fragment
+
+
+def _quote_search_string(text: str) -> str:
+    escaped = text.replace("\\", "\\\\").replace('"', '\\"')
+    return f'"{escaped}"'
+
+
+def _or_criteria(criteria: list[str]) -> str:
+    """条件をORでまとめる（入れ子が深くならないように二分する）"""
+    if len(criteria) == 1:
+        return criteria[0]
+    middle = len(criteria) // 2
+    left = _or_criteria(criteria[:middle])
+    right = _or_criteria(criteria[middle:])
+    return f"OR ({left}) ({right})"
+
+
+class _SuffixIndex:
+    """Reversed-suffix trie matching ``str.endswith`` for many suffixes."""
+
+    def __init__(self, suffixes: list[str | None]):
+        # ノードは [子ノードのdict, このノードで終わるルールのマスク]
+        self._root = [{}, 0]
+        self.free_mask = 0
+        for i, suffix in enumerate(suffixes):
+            if not suffix:
+                self.free_mask |= 1 << i
+                continue
+            node = self._root
+            for char in reversed(suffix):
+                node = node[0].setdefault(char, [{}, 0])
+            node[1] |= 1 << i
+
+    def match_mask(self, text: str) -> int:
+        """Return the rules whose suffix ``text`` ends with."""
+        mask = self.free_mask
+        node = self._root
+        for char in reversed(text):
+            node = node[0].get(char)
+            if node is None:
+                break
+            mask |= node[1]
+        return mask
+
+
+class _ContainsIndex:
+    """Multi-pattern index matching ``contains_all_words`` for many rules."""
+
+    def __init__(self, conditions: list[list[str] | str | None]):
+        self.free_mask = 0
+        word_ids: dict[str, int] = {}
+        self._rules_by_word: list[list[int]] = []
+        self._required: dict[int, int] = {}
+
+        for i, words in enumerate(conditions):
+            if not words:
+                self.free_mask |= 1 << i
+                continue
+            if isinstance(words, str):
+                words = [words]
+            # 空文字は常に含まれるので条件から除く
+            required = {word.lower() for word in words} - {""}
+            if not required:
+                self.free_mask |= 1 << i
+                continue
+            for word in required:
+                if word not in word_ids:
+                    word_ids[word] = len(word_ids)
+                    self._rules_by_word.append([])
+                self._rules_by_word[word_ids[word]].append(i)
+            self._required[i] = len(required)
+
+        self._matcher = _AhoCorasick(list(word_ids))
+
+    def match_mask(self, text: str) -> int:
+        """Return the rules whose words are all contained in ``text``."""
+        mask = self.free_mask
+        hits: dict[int, int] = {}
+        for word_id in self._matcher.find(text.lower()):
+            for i in self._rules_by_word[word_id]:
+                hits[i] = hits.get(i, 0) + 1
+                if hits[i] == self._required[i]:
+                    mask |= 1 << i
+        return mask
+
+
+class _AhoCorasick:
+    """Aho-Corasick automaton reporting which patterns occur in a text."""
+
+    def __init__(self, patterns: list[str]):
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._output: list[tuple[int, ...]] = [()]
+
+        for pattern_id, pattern in enumerate(patterns):
+            node = 0
+            for char in pattern:
+                next_node = self._goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(())
+                    self._goto[node][char] = next_node
+                node = next_node
+            self._output[node] += (pattern_id,)
+
+        # 幅優先で失敗遷移を構築する（ルート直下の失敗遷移はルート）
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, next_node in self._goto[node].items():
+                queue.append(next_node)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[next_node] = fail
+                self._output[next_node] += self._output[fail]
+
+    def find(self, text: str) -> set[int]:
+        """Return the ids of all patterns occurring in ``text``."""
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        found: set[int] = set()
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node]:
+                found.update(output[node])
+        return found
@@ -0,0 +1,102 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+import src.emails
+import src.state
+from src.ratelimit import HostBudget
+
+# 制限された場合に1つのアカウントを処理し直す回数の上限
+MAX_ATTEMPTS = 3
+
+
+class Scheduler:
+    """多数のアカウントを、サーバーごとの予算の範囲で優先度の高いものから処理する
+
+    優先度は前回の実行から経った時間と、前回見つかった未処理のメールの数で決める。
+    同じサーバーのアカウントばかりが並んでワーカーが接続待ちで埋まらないように、
+    サーバーごとの順番を保ったまま交互に並べて投入する。
+    """
+
+    def __init__(
+        self,
+        concurrency: int,
+        max_connections_per_host: int,
+        commands_per_second: float,
+        max_attempts: int = MAX_ATTEMPTS,
+    ):
+        self.concurrency = max(1, concurrency)
+        self.max_connections_per_host = max_connections_per_host
+        self.commands_per_second = commands_per_second
+        self.max_attempts = max(1, max_attempts)
+        self._budgets: dict[str, HostBudget] = {}
+        self._lock = threading.Lock()
+
+    def budget(self, host: str) -> HostBudget:
+        with self._lock:
+            if host not in self._budgets:
+                self._budgets[host] = HostBudget(
+                    host, self.max_connections_per_host, self.commands_per_second)
+            return self._budgets[host]
+
+    def order(self, setting_dirs: list[str]) -> list[tuple[str, str]]:
+        """(アカウント, サーバー)を処理する順に並べる"""
+        now = time.time()
+        by_host: dict[str, list[tuple[float, str]]] = {}
+        for setting_dir in setting_dirs:
+            host, priority = _describe_account(setting_dir, now)
+            by_host.setdefault(host, []).append((priority, setting_dir))
+
+        queues = [
+            [(setting_dir, host)
+             for _, setting_dir in sorted(accounts, key=lambda a: -a[0])]
+            for host, accounts in sorted(
+                by_host.items(), key=lambda item: -max(p for p, _ in item[1]))
+        ]
+        ordered = []
+        for i in range(max((len(queue) for queue in queues), default=0)):
+            ordered.extend(queue[i] for queue in queues if i < len(queue))
+        return ordered
+
+    def run(self, setting_dirs: list[str], handler) -> list:
+        """handler(setting_dir, budget)ですべてのアカウントを処理し、結果を返す
+
+        結果のthrottledが真の場合は、間隔を空けてmax_attempts回まで処理し直す。
+        結果はsetting_dirsと同じ順に返す。
+        """
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {
+                setting_dir: executor.submit(
+                    self._run_account, setting_dir, host, handler)
+                for setting_dir, host in self.order(setting_dirs)
+            }
+            return [futures[setting_dir].result() for setting_dir in setting_dirs]
+
+    def _run_account(self, setting_dir: str, host: str, handler):
+        budget = self.budget(host)
+        for attempt in range(1, self.max_attempts + 1):
+            result = handler(setting_dir, budget)
+            if not result.throttled:
+                budget.succeeded()
+                return result
+            if attempt < self.max_attempts:
+                logger.info(
+                    f"{setting_dir}: 制限されたので処理し直します（{attempt}/{self.max_attempts}）")
+        return result
+
+
+def _describe_account(setting_dir: str, now: float) -> tuple[str, float]:
+    """アカウントのサーバーと優先度を返す"""
+    try:
+        host = src.emails.load_email_account(setting_dir).imap_server
+    except Exception:
+        # 設定を読めないアカウントは処理の中でエラーとして報告する
+        host = ""
+    sync_state = src.state.load_sync_state(setting_dir)
+    if not sync_state.last_run_at:
+        # 一度も処理していないアカウントを最初に処理する
+        return host, float("inf")
+    # 未処理のメールが多く、前回から時間が経っているものほど先に処理する
+    return host, (now - sync_state.last_run_at) * (1 + sync_state.backlog)
@@ -0,0 +1,257 @@
+"""ヘッダーの単語から迷惑メールらしさを判定する統計モデル
+
+Spamフォルダのメールと、INBOXに残す（ルールで移動しない）メールから
+ナイーブベイズのモデルを学習する。特徴量は単語をハッシュした番号なので、
+モデルは重みの配列1つで、読み込みも判定もNumPyでまとめて行える。
+
+    python -m src.scoring <setting_dir> [<setting_dir> ...]
+
+で学習し、state/<setting_dir>/spam_model.npz に保存する。
+filtering_rules.yamlで spam_score_above を指定したルールがある場合だけ使う。
+"""
+import argparse
+import functools
+import hashlib
+import os
+import re
+import sys
+import zlib
+
+from loguru import logger
+
+try:
+    import numpy as np
+except ImportError:  # 統計的な判定を使わない場合はNumPyは不要
+    np = None
+
+# 特徴量のハッシュの桁数（2**18個の重み、float32で1MB）
+FEATURE_BITS = 18
+FEATURE_MASK = (1 << FEATURE_BITS) - 1
+# 学習に使うメールの件数の上限（それぞれ新しいものから）
+MAX_TRAINING_MESSAGES = 20_000
+# ラプラス平滑化の係数
+SMOOTHING = 1.0
+
+# ASCIIの単語
+WORD_PATTERN = re.compile(r"[a-z0-9][a-z0-9'$%-]*[a-z0-9$%]|[a-z0-9]")
+# 日本語など空白で区切られない部分は2文字ずつに区切る
+NON_ASCII_PATTERN = re.compile(r"[^\x00-\x7f\s]+")
+SENDER_DOMAIN_PATTERN = re.compile(r"@([^>\s]+)")
+
+
+class SpamModel:
+    """ハッシュした特徴量のナイーブベイズモデル"""
+
+    def __init__(self, weights, bias: float, digest: str):
+        self.weights = weights
+        self.bias = bias
+        # モデルの版（判定キャッシュのキーに使う）
+        self.digest = digest
+
+    def score_batch(self, emails: list) -> None:
+        """メールのまとまりを判定し、それぞれのspam_scoreに0〜1の値を設定する"""
+        if not emails:
+            return
+        features = []
+        counts = []
+        for email_data in emails:
+            email_features = extract_features(email_data)
+            features.extend(email_features)
+            counts.append(len(email_features))
+        # 特徴量の重みをメールごとに合計する
+        owners = np.repeat(np.arange(len(emails)), counts)
+        weights = self.weights[np.asarray(features, dtype=np.intp)]
+        logits = np.bincount(owners, weights=weights, minlength=len(emails))
+        scores = 1.0 / (1.0 + np.exp(-(logits + self.bias)))
+        for email_data, score in zip(emails, scores.tolist()):
+            email_data["spam_score"] = score
+
+    def score_stream(self, emails, batch_size: int):
+        """メールをbatch_size件ずつまとめて判定しながら順に返す"""
+        batch = []
+        for email_data in emails:
+            batch.append(email_data)
+            if len(batch) >= batch_size:
+                self.score_batch(batch)
+                yield from batch
+                batch = []
+        self.score_batch(batch)
+        yield from batch
+
+
+def extract_features(email_data) -> frozenset[int]:
+    """メールのヘッダーから特徴量（単語のハッシュ値）を取り出す"""
+    features = _subject_features(email_data.get("subject") or "")
+    features = features | _sender_features(email_data.get("from") or "")
+    if not email_data.get("to"):
+        features = features | _NO_TO_FEATURE
+    if email_data.get("cc"):
+        features = features | _CC_FEATURE
+    return features
+
+
+# 同じ件名・送信者のメールは多いので、特徴量を使い回す
+@functools.lru_cache(maxsize=65536)
+def _subject_features(subject: str) -> frozenset[int]:
+    tokens = set()
+    _add_words(tokens, "s:", subject.lower())
+    return _hash_tokens(tokens)
+
+
+@functools.lru_cache(maxsize=65536)
+def _sender_features(sender: str) -> frozenset[int]:
+    tokens = set()
+    sender = sender.lower()
+    match = SENDER_DOMAIN_PATTERN.search(sender)
+    if match:
+        # 送信者のドメインとその上位のドメイン
+        labels = match.group(1).split(".")
+        for i in range(len(labels) - 1):
+            tokens.add("d:" + ".".join(labels[i:]))
+    _add_words(tokens, "n:", sender.split("<", 1)[0])
+    return _hash_tokens(tokens)
+
+
+def _hash_tokens(tokens) -> frozenset[int]:
+    return frozenset(zlib.crc32(token.encode("utf-8")) & FEATURE_MASK for token in tokens)
+
+
+def _add_words(tokens: set, prefix: str, text: str) -> None:
+    for word in WORD_PATTERN.findall(text):
+        tokens.add(prefix + word)
+    for run in NON_ASCII_PATTERN.findall(text):
+        if len(run) == 1:
+            tokens.add(prefix + run)
+        for i in range(len(run) - 1):
+            tokens.add(prefix + run[i:i + 2])
+
+
+_NO_TO_FEATURE = _hash_tokens(["t:none"])
+_CC_FEATURE = _hash_tokens(["c:some"])
+
+
+def train(spam_emails: list, ham_emails: list) -> SpamModel:
+    """迷惑メールとそうでないメールからモデルを学習する"""
+    _require_numpy()
+    size = FEATURE_MASK + 1
+    spam_counts = _count_features(spam_emails, size)
+    ham_counts = _count_features(ham_emails, size)
+    spam_prob = (spam_counts + SMOOTHING) / \
+        (spam_counts.sum() + SMOOTHING * size)
+    ham_prob = (ham_counts + SMOOTHING) / (ham_counts.sum() + SMOOTHING * size)
+    weights = (np.log(spam_prob) - np.log(ham_prob)).astype(np.float32)
+    bias = float(np.log(max(len(spam_emails), 1) / max(len(ham_emails), 1)))
+    digest = hashlib.sha256(
+        weights.tobytes() + repr(bias).encode()).hexdigest()[:16]
+    return SpamModel(weights, bias, digest)
+
+
+def _count_features(emails: list, size: int):
+    features = [
+        feature for email_data in emails for feature in extract_features(email_data)]
+    return np.bincount(np.asarray(features, dtype=np.int64), minlength=size).astype(np.float64)
+
+
+def get_model_path(setting_dir: str) -> str:
+    return f"state/{setting_dir}/spam_model.npz"
+
+
+def save_spam_model(setting_dir: str, model: SpamModel) -> None:
+    path = get_model_path(setting_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # 書き込み途中で中断しても壊れないように一時ファイルから置き換える
+    tmp_path = f"{path}.tmp.npz"
+    np.savez(tmp_path, weights=model.weights, bias=np.float64(model.bias),
+             digest=np.str_(model.digest))
+    os.replace(tmp_path, path)
+
+
+def load_spam_model(setting_dir: str) -> SpamModel | None:
+    """学習済みのモデルを読み込む（ない場合や読み込めない場合はNone）"""
+    path = get_model_path(setting_dir)
+    if np is None:
+        logger.warning("spam_score_aboveを使うにはNumPyが必要です（pip install numpy）")
+        return None
+    if not os.path.exists(path):
+        logger.warning(f"迷惑メール判定のモデルがありません: {path}")
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            weights = data["weights"]
+            if weights.shape != (FEATURE_MASK + 1,):
+                raise ValueError(f"unexpected weights shape {weights.shape}")
+            return SpamModel(weights, float(data["bias"]), str(data["digest"]))
+    except Exception as e:
+        logger.warning(f"迷惑メール判定のモデルの読み込みに失敗しました: {e}")
+        return None
+
+
+def _require_numpy() -> None:
+    if np is None:
+        raise RuntimeError(
+            "NumPy is required for spam scoring: pip install numpy")
+
+
+def fetch_training_emails(setting_dir: str) -> tuple[list, list]:
+    """Spamフォルダのメールと、INBOXのうちルールで移動しないメールを取得する"""
+    import src.emails
+    import src.rules
+
+    email_account = src.emails.load_email_account(setting_dir)
+    if email_account.protocol != "IMAP":
+        raise ValueError("training needs an IMAP account with a Spam folder")
+    # 学習ではSpamフォルダも読むので、INBOX用の並列取得は使わない
+    email_account = email_account.copy(fetch_connections=1)
+    # モデルを使うルールはまだ判定できないので、モデルなしでルールを読む
+    rules = src.rules.load_rules(setting_dir, load_model=False)
+
+    client = src.emails.EmailClient.from_email_account(email_account)
+    if not client.connect_to_server():
+        raise ConnectionError(
+            f"could not connect to {email_account.imap_server}")
+    try:
+        spam = list(client.get_emails_details_bulk(
+            _latest_uids(client, "Spam")))
+        ham = []
+        for email_data in client.get_emails_details_bulk(_latest_uids(client, "INBOX")):
+            rule_index = rules.match_index(email_data)
+            if rule_index is None or rules[rule_index].action == "allow":
+                ham.append(email_data)
+        return spam, ham
+    finally:
+        client.logout()
+
+
+def _latest_uids(client, folder: str) -> list:
+    status, _ = client.email_client.select(folder, readonly=True)
+    if status != "OK":
+        logger.warning(f"フォルダを開けませんでした: {folder}")
+        return []
+    status, data = client.email_client.uid("SEARCH", None, "ALL")
+    if status != "OK":
+        return []
+    return data[0].split()[-MAX_TRAINING_MESSAGES:]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="迷惑メール判定のモデルを学習する")
+    parser.add_argument("setting_dirs", nargs="+",
+                        help="settings/以下のアカウントのディレクトリ名")
+    args = parser.parse_args(argv)
+    _require_numpy()
+
+    for setting_dir in args.setting_dirs:
+        spam, ham = fetch_training_emails(setting_dir)
+        if not spam or not ham:
+            logger.error(
+                f"{setting_dir}: 学習するメールが足りません（spam={len(spam)}, ham={len(ham)}）")
+            return 1
+        model = train(spam, ham)
+        save_spam_model(setting_dir, model)
+        logger.info(
+            f"{setting_dir}: spam={len(spam)}件, ham={len(ham)}件で学習しました。")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
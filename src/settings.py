@@ -11,9 +11,13 @@ def get_setting_dirs():
     setting_dirs = []
 
     # デフォルトの設定ディレクトリ以外の設定ディレクトリを取得
-    for dirpath, dirnames, filenames in os.walk("settings"):
-        for dirname in dirnames:
-            if dirname != "default":
-                setting_dirs.append(dirname)
+    # （settings直下だけを見る。os.walkのように下の階層まで辿らない）
+    try:
+        with os.scandir("settings") as entries:
+            for entry in entries:
+                if entry.is_dir() and entry.name != "default":
+                    setting_dirs.append(entry.name)
+    except FileNotFoundError:
+        pass
 
     return setting_dirs
@@ -0,0 +1,85 @@
+import json
+import os
+
+from loguru import logger
+
+from src.record import Record
+
+
+class SyncState(Record):
+    """メールボックスの差分同期のチェックポイント"""
+
+    FIELDS = {
+        "uid_validity": (int | None, None),
+        "last_uid": (int, 0),
+        # POP3で処理済みのメールのUIDL（メールボックスに残っているもののみ）
+        "seen_uidls": (list[str], []),
+        # 前回制限されずに最後まで処理した時刻と、そのときに処理できずに残ったメールの数
+        # （スケジューラーが処理する順番を決めるのに使う）
+        "last_run_at": (float, 0.0),
+        "backlog": (int, 0),
+        # 前回最後まで処理した時点のHIGHESTMODSEQ（CONDSTORE、RFC 7162）
+        # これが変わっていなければメールボックスは変更されていない
+        "highest_modseq": (int, 0),
+    }
+    __slots__ = tuple(FIELDS)
+
+    def is_valid_for(self, uid_validity: int | None) -> bool:
+        """チェックポイントが現在のメールボックスに対して有効か判定する"""
+        return (
+            uid_validity is not None
+            and self.uid_validity == uid_validity
+            and self.last_uid > 0
+        )
+
+    def advance(self, uid_validity: int | None, uids, highest_modseq: int | None = None) -> None:
+        """処理済みのUIDまでチェックポイントを進める"""
+        if uid_validity is None:
+            return
+        if self.uid_validity != uid_validity:
+            # UIDVALIDITYが変わった場合は以前のUIDもMODSEQも無効
+            self.uid_validity = uid_validity
+            self.last_uid = 0
+            self.highest_modseq = 0
+        for uid in uids:
+            self.last_uid = max(self.last_uid, int(uid))
+        if highest_modseq is not None:
+            self.highest_modseq = highest_modseq
+
+    def advance_uidls(self, present_uidls, processed_uidls) -> None:
+        """処理済みのUIDLを記録する（メールボックスから消えたものは忘れる）"""
+        present = set(present_uidls)
+        seen = {uidl for uidl in self.seen_uidls if uidl in present}
+        seen.update(processed_uidls)
+        self.seen_uidls = sorted(seen)
+
+
+def get_state_path(setting_dir: str) -> str:
+    return f"state/{setting_dir}/sync_state.json"
+
+
+def load_sync_state(setting_dir: str) -> SyncState:
+    """保存されたチェックポイントを読み込む"""
+    path = get_state_path(setting_dir)
+    if not os.path.exists(path):
+        return SyncState()
+
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return SyncState(**json.loads(f.read()))
+    except Exception as e:
+        # 壊れたチェックポイントは破棄して最初から同期する
+        logger.warning(f"同期状態の読み込みに失敗しました: {e}")
+        return SyncState()
+
+
+def save_sync_state(setting_dir: str, state: SyncState) -> None:
+    """チェックポイントを保存する"""
+    path = get_state_path(setting_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # 書き込み途中で中断しても壊れないように一時ファイルから置き換える
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(state.to_dict()))
+    os.replace(tmp_path, path)